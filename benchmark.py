@@ -0,0 +1,1312 @@
+""" Benchmarks for iTermocil. These don't need iTerm (or even a Mac) to
+    run, so can be used to spot performance regressions anywhere.
+
+    $ python benchmark.py yaml
+    $ python benchmark.py generate --json results.json
+    $ python benchmark.py generate --baseline results.json
+
+    Except for 'launch', which really opens the layouts in iTerm, to
+    compare end-to-end launch time of the different ways of driving it.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import yaml
+
+import itermocil
+
+
+# Every layout understood by Itermocil.arrange_panes.
+LAYOUTS = ['even-horizontal', 'even-vertical', 'main-vertical',
+           'main-vertical-flipped', 'main-horizontal', 'double-main-horizontal',
+           'double-main-vertical', 'tiled', '3_columns', 'grid']
+
+# iTerm versions to generate scripts for: one new and one old.
+ITERM_VERSIONS = {'new': '3.4', 'old': '2.1'}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEST_LAYOUTS = sorted(glob.glob(os.path.join(HERE, 'test_layouts', '*.yml')))
+
+
+def synthetic_config(windows=1, panes=4, layout='tiled'):
+    """ Build a teamocil config with the given number of windows, each
+        with the given number of panes.
+    """
+
+    return {
+        'windows': [
+            {
+                'name': 'window-%d' % w,
+                'root': '~/Code/window-%d' % w,
+                'layout': layout,
+                'panes': [
+                    {'commands': ['echo "window %d pane %d"' % (w, p), 'git status'],
+                     'name': 'pane-%d' % p}
+                    for p in range(panes)
+                ],
+            }
+            for w in range(windows)
+        ]
+    }
+
+
+def write_config(directory, name, config):
+    """ Save a config as a YAML layout file, returning its path.
+    """
+
+    path = os.path.join(directory, name + '.yml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+    return path
+
+
+def time_call(fn, repeat=5):
+    """ Return the best wall time (in seconds) of calling fn.
+    """
+
+    number = 1
+    # Scale up the number of calls for quick functions so we're not just
+    # measuring timer resolution.
+    while True:
+        t = timeit.timeit(fn, number=number)
+        if t > 0.05 or number >= 10000:
+            break
+        number *= 10
+
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def bench_yaml(args):
+    """ Compare the YAML loaders (and the parsed-config cache) on the test
+        layouts and on synthetic layouts with thousands of panes.
+    """
+
+    loaders = [('Loader', yaml.Loader), ('SafeLoader', yaml.SafeLoader)]
+    if hasattr(yaml, 'CSafeLoader'):
+        loaders.append(('CSafeLoader', yaml.CSafeLoader))
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    try:
+        files = list(TEST_LAYOUTS)
+        for panes in args.panes:
+            config = synthetic_config(windows=args.windows, panes=panes)
+            files.append(write_config(tmp, 'synthetic_%d_x_%d' % (args.windows, panes), config))
+
+        header = '%-40s' % 'layout' + ''.join('%14s' % name for name, _ in loaders) + '%14s' % 'cached'
+        print(header)
+
+        for path in files:
+            with open(path, 'r') as f:
+                text = f.read()
+
+            row = '%-40s' % os.path.basename(path)[:40]
+            for _, loader in loaders:
+                t = time_call(lambda: yaml.load(text, Loader=loader), args.repeat)
+                row += '%12.3fms' % (t * 1000)
+
+            itermocil.load_config(path)
+            t = time_call(lambda: itermocil.load_config(path), args.repeat)
+            row += '%12.3fms' % (t * 1000)
+
+            print(row)
+    finally:
+        shutil.rmtree(tmp)
+
+
+class OfflineItermocil(itermocil.Itermocil):
+    """ Old iTerm asks iTerm how many panes are open while generating the
+        script. Pretend there's just the one so no osascript is needed.
+    """
+
+    def get_num_panes_in_current_window(self):
+        return '1'
+
+
+def generate(path, iterm_version):
+    """ Generate the script for a layout file, as a launch would.
+    """
+
+    return OfflineItermocil(path, iterm_version=iterm_version).script()
+
+
+def count_splits(nodes):
+    """ Count the splits and keystrokes in a script's nodes. Old iTerm
+        splits with keystrokes (Cmd-D and Cmd-Shift-D).
+    """
+
+    splits = keystrokes = 0
+    for node in nodes:
+        if isinstance(node, itermocil.Split):
+            splits += 1
+        elif isinstance(node, itermocil.Keystroke):
+            keystrokes += 1
+            splits += node.key in ('d', 'D')
+        if isinstance(node, itermocil.Tell):
+            s, k = count_splits(node.body)
+            splits += s
+            keystrokes += k
+
+    return splits, keystrokes
+
+
+def measure_generate(path, iterm_version, repeat):
+    """ Return generation time, peak memory, script size and split and
+        keystroke counts for a layout.
+    """
+
+    # Warm the parsed-config cache so we're timing script generation,
+    # as a repeat launch of the layout would.
+    instance = OfflineItermocil(path, iterm_version=iterm_version)
+    script = instance.script()
+    splits, keystrokes = count_splits(instance.nodes())
+
+    tracemalloc.start()
+    generate(path, iterm_version)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'time': time_call(lambda: generate(path, iterm_version), repeat),
+        'peak_memory': peak,
+        'script_size': len(script.encode('utf-8')),
+        'splits': splits,
+        'keystrokes': keystrokes,
+    }
+
+
+# What generation makes, which is the same wherever it runs, so any
+# increase on the baseline is a regression. Time and peak memory depend
+# on the machine (and Python), so are only reported.
+DETERMINISTIC_METRICS = ('script_size', 'splits', 'keystrokes')
+MEASURED_METRICS = ('time', 'peak_memory')
+
+# The case every run also times, as a reference for the others' times.
+REFERENCE_CASE = ('tiled', 1, 16, 'new')
+
+
+def compare(results, baseline, tolerance, scale=1.0):
+    """ Compare results against a baseline. Returns messages describing
+        each regression (any increase in a deterministic metric), and
+        notes on measured metrics more than tolerance worse. Times are
+        scaled by scale first, the ratio of the baseline's reference time
+        to this run's, to allow for a faster or slower machine.
+    """
+
+    regressions, notes = [], []
+    for case, result in sorted(results.items()):
+        base = baseline.get(case)
+        if not base:
+            continue
+        for metric in DETERMINISTIC_METRICS:
+            if metric in base and result[metric] > base[metric]:
+                regressions.append('%s: %s %d -> %d' % (
+                    case, metric, base[metric], result[metric]))
+        for metric in MEASURED_METRICS:
+            value = result[metric] * (scale if metric == 'time' else 1)
+            if base[metric] and value > base[metric] * (1 + tolerance):
+                notes.append('%s: %s %.4g -> %.4g (+%.0f%%)' % (
+                    case, metric, base[metric], value,
+                    (value / float(base[metric]) - 1) * 100))
+
+    return regressions, notes
+
+
+def bench_keystrokes(args):
+    """ Count the keystrokes old iTerm needs to arrange each layout and
+        then focus the pane that takes most keystrokes to reach (focus
+        used to take one Cmd-] per pane), and estimate how long they
+        take. Compare against a --baseline saved with --json, to catch
+        regressions.
+    """
+
+    results = {}
+    for layout in LAYOUTS:
+        for panes in args.panes:
+            plan = itermocil.layout_plan(layout, panes)
+            arrange = itermocil.KeystrokePlanner(plan).arrange()
+            focus = max((itermocil.KeystrokePlanner(plan).navigate(1, p)
+                         for p in range(1, panes + 1)), key=len)
+            count, seconds = itermocil.KeystrokePlanner.estimate(arrange + focus)
+
+            case = '%s/%d' % (layout, panes)
+            results[case] = {'keystrokes': count, 'seconds': seconds,
+                             'focus_keystrokes': len(focus)}
+            if not args.quiet:
+                print('%-30s %6d keystrokes %8.2fs  focus: up to %d (was %d)' % (
+                    case, count, seconds, len(focus), panes - 1))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = ['%s: %d -> %d keystrokes' % (case, baseline[case]['keystrokes'], r['keystrokes'])
+                       for case, r in sorted(results.items())
+                       if case in baseline and r['keystrokes'] > baseline[case]['keystrokes']]
+        for r in regressions:
+            print('REGRESSION ' + r)
+        if regressions:
+            sys.exit(1)
+
+
+def bench_plans(args):
+    """ Time planning every layout for --max-panes panes, with and without
+        the plan already memoized. (tests/test_layout_plan.py checks the
+        plans, and tests/test_keystrokes.py old iTerm's keystrokes.)
+    """
+
+    def cold():
+        for key in [k for k in itermocil._memo if k[0] == 'layout_plan']:
+            del itermocil._memo[key]
+        for layout in LAYOUTS:
+            itermocil.layout_plan(layout, args.max_panes)
+
+    def warm():
+        for layout in LAYOUTS:
+            itermocil.layout_plan(layout, args.max_panes)
+
+    print('plan %d panes, all layouts: %.3fms, memoized %.4fms' % (
+        args.max_panes, time_call(cold) * 1000, time_call(warm) * 1000))
+
+
+def bench_grid(args):
+    """ Compare 'grid' with the fixed-column layouts for many panes: the
+        splits (and old iTerm keystrokes) needed, how long generating the
+        script takes, and the size of the smallest pane.
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    try:
+        old = OfflineItermocil(TEST_LAYOUTS[0], iterm_version=ITERM_VERSIONS['old'])
+
+        print('%-10s %6s %8s %10s %12s %14s' % ('layout', 'panes', 'splits', 'keystrokes',
+                                                'generate', 'smallest pane'))
+        for panes in args.panes:
+            for layout in ('tiled', '3_columns', 'grid'):
+                plan = itermocil.layout_plan(layout, panes)
+                geometry = itermocil.plan_geometry(plan)
+                width = min(w for x, y, w, h in geometry.values())
+                height = min(h for x, y, w, h in geometry.values())
+
+                old.applescript = []
+                old.arrange_panes_old_iterm(panes, layout)
+                keystrokes = len([n for n in old.applescript if isinstance(n, itermocil.Keystroke)])
+
+                path = write_config(tmp, '%s_%d' % (layout, panes),
+                                    synthetic_config(panes=panes, layout=layout))
+                t = measure_generate(path, ITERM_VERSIONS['new'], args.repeat)['time']
+
+                print('%-10s %6d %8d %10d %10.3fms %14s' % (
+                    layout, panes, len(plan), keystrokes, t * 1000,
+                    '1/%d x 1/%d' % (round(1 / width), round(1 / height))))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def typed_text(nodes):
+    """ Return how many 'write text's the nodes do, and how many bytes
+        they type (including the newline each one sends).
+    """
+
+    count = size = 0
+    for node in nodes:
+        if isinstance(node, itermocil.WriteText) and node.text is not None:
+            count += 1
+            size += len(node.text.encode('utf-8')) + 1
+        if isinstance(node, itermocil.Tell):
+            c, b = typed_text(node.body)
+            count += c
+            size += b
+
+    return count, size
+
+
+# Options that change what's typed into panes, for bench_typed.
+TYPED_VARIANTS = [
+    ('default', {}),
+    ('--split-cwd', {'split_cwd': True}),
+    ('--source-commands', {'source_commands': True}),
+    ('both', {'split_cwd': True, 'source_commands': True}),
+]
+
+
+def bench_typed(args):
+    """ Compare what --split-cwd and --source-commands type into panes
+        with the usual scripts, which type 'cd' (and 'export') and every
+        command into every pane: the bytes typed, and the script size.
+        (tests/test_typed.py checks neither option ever types more.)
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    cases = [(os.path.basename(path)[:-4], path) for path in TEST_LAYOUTS]
+    for panes in args.panes:
+        config = synthetic_config(windows=2, panes=panes)
+        for window in config['windows']:
+            window['root'] = '~/Code/My Project/' + window['name']
+            window['env'] = {'RAILS_ENV': 'development'}
+        cases.append(('env_2x%d' % panes, write_config(tmp, 'env_2x%d' % panes, config)))
+
+        # Panes with a long list of commands to get going
+        for window in config['windows']:
+            for pane in window['panes']:
+                pane['commands'] = ['source venv/bin/activate',
+                                    'export DJANGO_SETTINGS_MODULE=project.settings.development',
+                                    'pip install -q -r requirements.txt',
+                                    'python manage.py migrate --noinput'] + pane['commands']
+        cases.append(('bootstrap_2x%d' % panes, write_config(tmp, 'bootstrap_2x%d' % panes, config)))
+
+    try:
+        print('%-32s' % 'typed bytes (script bytes)' +
+              ''.join('%22s' % name for name, _ in TYPED_VARIANTS))
+        for name, path in cases:
+            results = []
+            for variant, options in TYPED_VARIANTS:
+                instance = OfflineItermocil(path, iterm_version=ITERM_VERSIONS['new'], **options)
+                script = instance.script()
+                results.append((typed_text(instance.nodes())[1], len(script.encode('utf-8'))))
+
+            print('%-32s' % name + ''.join('%22s' % ('%d (%d)' % r) for r in results))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# A pane's workload for bench_startup: log when it starts and finishes
+# a busy startup phase.
+STARTUP_WORKLOAD = """
+import sys, time
+with open(sys.argv[1], 'a') as f:
+    f.write('start %f\\n' % time.time())
+time.sleep(float(sys.argv[2]))
+with open(sys.argv[1], 'a') as f:
+    f.write('end %f\\n' % time.time())
+"""
+
+
+def peak_concurrency(log):
+    """ Return the most workloads that were running at once, and how
+        long it was from the first starting to the last finishing.
+    """
+
+    events = []
+    with open(log, 'r') as f:
+        for line in f:
+            what, when = line.split()
+            events.append((float(when), 1 if what == 'start' else -1))
+
+    # Finishing sorts before starting at the same moment.
+    events.sort()
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+
+    return peak, events[-1][0] - events[0][0]
+
+
+def pane_texts(instance):
+    """ Return the text typed into each pane of a layout, in order. """
+
+    texts = []
+
+    def collect(nodes):
+        for node in nodes:
+            if isinstance(node, itermocil.WriteText) and node.text:
+                texts.append(node.text)
+            if isinstance(node, itermocil.Tell):
+                collect(node.body)
+
+    collect(instance.nodes())
+    return texts
+
+
+def run_panes(instance, texts):
+    """ Run a layout's shell commands, then each pane's text as a local
+        shell, all at once (as iTerm would), and wait for them all.
+    """
+
+    for command in instance.shell_commands:
+        subprocess.check_call(['sh', '-c', command])
+
+    procs = [subprocess.Popen(['sh', '-c', text]) for text in texts]
+    for proc in procs:
+        proc.wait()
+
+
+def bench_startup(args):
+    """ Run a layout's panes as local shells (as iTerm would, all at once)
+        with a synthetic workload, with and without 'startup' settings,
+        and measure how many workloads were starting at the same time.
+        (tests/test_startup.py checks it's never more than max_concurrent.)
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    variants = [('no startup settings', None),
+                ('max_concurrent %d' % args.max_concurrent,
+                 {'max_concurrent': args.max_concurrent, 'warmup': args.work + 0.2}),
+                ('max_concurrent %d, stagger %gs' % (args.max_concurrent, args.stagger),
+                 {'max_concurrent': args.max_concurrent, 'warmup': args.work + 0.2,
+                  'stagger': args.stagger})]
+
+    try:
+        script = os.path.join(tmp, 'workload.py')
+        with open(script, 'w') as f:
+            f.write(STARTUP_WORKLOAD)
+
+        for name, startup in variants:
+            log = os.path.join(tmp, 'log')
+            if os.path.exists(log):
+                os.remove(log)
+
+            config = synthetic_config(panes=args.panes)
+            for window in config['windows']:
+                window['root'] = tmp
+                for pane in window['panes']:
+                    pane['commands'] = ['%s %s %s %s' % (sys.executable, script, log, args.work)]
+            if startup:
+                config['startup'] = startup
+            path = write_config(tmp, 'startup', config)
+
+            instance = OfflineItermocil(path, iterm_version=ITERM_VERSIONS['new'])
+
+            texts = pane_texts(instance)
+            run_panes(instance, texts)
+
+            peak, elapsed = peak_concurrency(log)
+            print('%-36s %d panes, peak %2d starting at once, all done in %.2fs' % (
+                name, len(texts), peak, elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# The panes' workloads for bench_depends, logging when each starts and
+# is ready: a server that takes a while to listen on a port, a service
+# that takes a while to log that it's listening, and a client.
+DEPENDS_WORKLOAD = """
+import socket, sys, time
+
+def log(what):
+    with open(sys.argv[1], 'a') as f:
+        f.write('%s %s %f\\n' % (what, sys.argv[3], time.time()))
+
+log('start')
+if sys.argv[2] == 'server':
+    time.sleep(float(sys.argv[4]))
+    server = socket.socket()
+    server.bind(('127.0.0.1', int(sys.argv[5])))
+    server.listen(5)
+    log('ready')
+    server.settimeout(0.1)
+    stop = time.time() + float(sys.argv[6])
+    while time.time() < stop:
+        try:
+            server.accept()[0].close()
+        except socket.timeout:
+            pass
+elif sys.argv[2] == 'service':
+    time.sleep(float(sys.argv[4]))
+    with open(sys.argv[5], 'a') as f:
+        f.write('Listening on 3000\\n')
+    log('ready')
+"""
+
+
+def free_port():
+    """ Return a local port nothing is listening on. """
+
+    import socket
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench_depends(args):
+    """ Run a layout of a database, an API that needs it, and a frontend
+        that needs the API (as local shells, all at once, as iTerm would),
+        once using 'depends_on' and 'ready' probes and once padding
+        commands with sleeps long enough to be safe. Measures how long
+        the frontend took to start, against the critical path.
+        (tests/test_startup.py checks panes wait for what they depend on.)
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    critical = args.db_delay + args.api_delay
+    try:
+        script = os.path.join(tmp, 'workload.py')
+        with open(script, 'w') as f:
+            f.write(DEPENDS_WORKLOAD)
+
+        for variant in ['depends_on', 'sleep padding']:
+            log = os.path.join(tmp, 'log')
+            api_log = os.path.join(tmp, 'api.log')
+            if os.path.exists(log):
+                os.remove(log)
+            # The api said it was listening last time too, which mustn't
+            # count this time.
+            with open(api_log, 'w') as f:
+                f.write('Listening on 3000\n')
+            port = free_port()
+
+            def command(*args):
+                return ' '.join([sys.executable, script, log] + [str(arg) for arg in args])
+
+            db = {'name': 'db', 'ready': {'port': port},
+                  'commands': [command('server', 'db', args.db_delay, port, critical + 2)]}
+            api = {'name': 'api', 'ready': {'log': 'api.log', 'match': 'Listening on'},
+                   'commands': [command('service', 'api', args.api_delay, api_log)]}
+            frontend = {'name': 'frontend', 'commands': [command('client', 'frontend')]}
+            if variant == 'depends_on':
+                api['depends_on'] = 'db'
+                frontend['depends_on'] = 'api'
+            else:
+                padding = args.padding * args.db_delay
+                api['commands'].insert(0, 'sleep %g' % padding)
+                frontend['commands'].insert(0, 'sleep %g' % (padding + args.padding * args.api_delay))
+
+            config = {'windows': [{'name': 'depends', 'root': tmp, 'layout': 'tiled',
+                                   'panes': [db, api, frontend]}]}
+            instance = OfflineItermocil(write_config(tmp, 'depends', config),
+                                        iterm_version=ITERM_VERSIONS['new'])
+
+            launched = time.time()
+            run_panes(instance, pane_texts(instance))
+
+            events = {}
+            with open(log, 'r') as f:
+                for line in f:
+                    what, name, when = line.split()
+                    events[(what, name)] = float(when)
+
+            frontend_start = events[('start', 'frontend')] - launched
+            print('%-14s frontend started after %.2fs (critical path %.2fs)'
+                  % (variant, frontend_start, critical))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_pre(args):
+    """ Time a layout's pre hooks (each sleeping a while) run one after
+        another, as the script used to run them, against PreHooks running
+        them alongside script generation. Exits non-zero if that's not
+        quicker.
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    try:
+        config = synthetic_config(panes=args.panes)
+        config['pre'] = ['sleep %g' % args.work] * args.hooks
+        path = write_config(tmp, 'pre', config)
+
+        start = time.time()
+        for hook in config['pre']:
+            subprocess.check_call(['sh', '-c', hook])
+        instance = OfflineItermocil(path, iterm_version=ITERM_VERSIONS['new'])
+        instance.script()
+        serial = time.time() - start
+
+        start = time.time()
+        timings = itermocil.Timings()
+        hooks = itermocil.PreHooks(timings)
+        hooks.add(itermocil.load_config(path).get('pre'), start=True)
+        instance = OfflineItermocil(path, iterm_version=ITERM_VERSIONS['new'],
+                                    timings=timings, pre_hooks=hooks)
+        instance.script()
+        instance.wait_for_hooks()
+        parallel = time.time() - start
+    finally:
+        shutil.rmtree(tmp)
+
+    print('%d hooks of %gs, %d panes' % (args.hooks, args.work, args.panes))
+    print('%-10s %7.2fs' % ('serial', serial))
+    print('%-10s %7.2fs  (%d at once)' % ('PreHooks', parallel, itermocil.PreHooks.max_workers))
+    for name, seconds, error in timings.pre_hooks:
+        print('  %-20s %7.2fs%s' % (name, seconds, ' failed: ' + error if error else ''))
+
+    if parallel >= serial:
+        print('FAIL running hooks in parallel was no quicker')
+        sys.exit(1)
+
+
+# Stands in for osascript in bench_reconcile: answers --reconcile's
+# query with the canned sessions in $ITERMOCIL_STUB_STATE, and anything
+# else with a version.
+STUB_OSASCRIPT = """#!/bin/sh
+script=$(cat)
+case "$script" in
+*user.itermocil*) cat "$ITERMOCIL_STUB_STATE" ;;
+*) echo 3.4.0 ;;
+esac
+"""
+
+
+def bench_reconcile(args):
+    """ Time generating --reconcile scripts for a layout against a stub
+        osascript serving canned iTerm state: nothing open, everything
+        open, and one pane of each window closed, with the tabs, splits
+        and text typed into panes each needs. (tests/test_osascript.py
+        checks only what's missing is made.)
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    os.environ['PATH'] = tmp + os.pathsep + os.environ['PATH']
+    state = os.environ['ITERMOCIL_STUB_STATE'] = os.path.join(tmp, 'state')
+
+    try:
+        stub = os.path.join(tmp, 'osascript')
+        with open(stub, 'w') as f:
+            f.write(STUB_OSASCRIPT)
+        os.chmod(stub, 0o755)
+        open(state, 'w').close()
+
+        config = synthetic_config(windows=args.windows, panes=args.panes)
+        path = write_config(tmp, 'reconcile', config)
+
+        # Every session a full launch makes, by tag.
+        instance = itermocil.Itermocil(path, iterm_version=None, reconcile=True)
+        tags = ['%s/%d/%d' % (instance.layout_id(), window, pane)
+                for window in range(1, args.windows + 1) for pane in range(1, args.panes + 1)]
+        closed = set('%s/%d/%d' % (instance.layout_id(), window, args.panes)
+                     for window in range(1, args.windows + 1))
+
+        scenarios = [('nothing open', []),
+                     ('everything open', tags),
+                     ('one pane per window closed', [t for t in tags if t not in closed])]
+
+        for name, live in scenarios:
+            with open(state, 'w') as f:
+                for num, tag in enumerate(live):
+                    f.write('session-%d\t%s\n' % (num, tag))
+
+            start = time.time()
+            instance = itermocil.Itermocil(path, iterm_version=None, reconcile=True)
+            script = instance.script()
+            elapsed = time.time() - start
+
+            counts = {'tabs': script.count('create tab'), 'splits': 0, 'typed': 0}
+
+            def collect(nodes):
+                for node in nodes:
+                    if isinstance(node, itermocil.Split):
+                        counts['splits'] += 1
+                    elif isinstance(node, itermocil.WriteText):
+                        counts['typed'] += node.text is not None
+                    if isinstance(node, itermocil.Tell):
+                        collect(node.body)
+
+            collect(instance.nodes())
+            print('%-28s %3d tabs %4d splits %4d panes typed into  %6.1fms'
+                  % (name, counts['tabs'], counts['splits'], counts['typed'], elapsed * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# Stands in for ssh (and sshd) in bench_ssh: a new connection takes
+# $FAKE_SSH_HANDSHAKE seconds (logged, for peak_concurrency), and is
+# refused if $FAKE_SSH_MAX_STARTUPS are already being made, as sshd's
+# MaxStartups would. One through an existing ControlPath socket is
+# instant. The remote command is run locally.
+FAKE_SSH = """
+import os, subprocess, sys, time
+
+args = sys.argv[1:]
+options = {}
+while args[0].startswith('-'):
+    if args[0] == '-o':
+        key, value = args[1].split('=', 1)
+        options[key] = value
+        args = args[2:]
+    else:
+        args = args[1:]
+
+def log(what, suffix=''):
+    with open(os.environ['FAKE_SSH_LOG'] + suffix, 'a') as f:
+        f.write('%s %f\\n' % (what, time.time()))
+
+socket = options.get('ControlPath')
+if not (socket and os.path.exists(socket)):
+    for slot in range(int(os.environ['FAKE_SSH_MAX_STARTUPS'])):
+        slot = os.path.join(os.environ['FAKE_SSH_SLOTS'], str(slot))
+        try:
+            os.close(os.open(slot, os.O_CREAT | os.O_EXCL))
+            break
+        except OSError:
+            pass
+    else:
+        log('refused', '.refused')
+        sys.exit(255)
+    log('start')
+    time.sleep(float(os.environ['FAKE_SSH_HANDSHAKE']))
+    log('end')
+    os.remove(slot)
+    if socket and options.get('ControlMaster') in ('auto', 'yes') and 'ControlPersist' in options:
+        open(socket, 'w').close()
+
+sys.exit(subprocess.call(['sh', '-c', ' '.join(args[1:])]))
+"""
+
+
+def bench_ssh(args):
+    """ Launch a layout whose panes all ssh to a few hosts (against a
+        stand-in ssh, as local shells, all at once, as iTerm would), once
+        with each pane running ssh itself and once with 'host', sharing
+        a master connection per host. Counts the handshakes made and how
+        many were at once or refused.
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    log = os.environ['FAKE_SSH_LOG'] = os.path.join(tmp, 'log')
+    os.environ['FAKE_SSH_HANDSHAKE'] = str(args.handshake)
+    os.environ['FAKE_SSH_MAX_STARTUPS'] = str(args.max_startups)
+    os.environ['FAKE_SSH_SLOTS'] = os.path.join(tmp, 'slots')
+    os.environ['PATH'] = tmp + os.pathsep + os.environ['PATH']
+    # The remote login shell each pane is left in.
+    os.environ['SHELL'] = '/bin/true'
+
+    hosts = ['host%d' % n for n in range(args.hosts)]
+    try:
+        fake = os.path.join(tmp, 'ssh')
+        with open(fake, 'w') as f:
+            f.write('#!' + sys.executable + '\n' + FAKE_SSH)
+        os.chmod(fake, 0o755)
+        os.mkdir(os.environ['FAKE_SSH_SLOTS'])
+
+        for variant in ['ssh in each pane', 'host']:
+            for path in (log, log + '.refused'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+            config = synthetic_config(panes=args.panes)
+            config['ssh'] = {'control_dir': os.path.join(tmp, variant.replace(' ', '-'))}
+            config['windows'][0]['root'] = tmp
+            for num, pane in enumerate(config['windows'][0]['panes']):
+                host = hosts[num % len(hosts)]
+                if variant == 'host':
+                    config['windows'][0]['panes'][num] = {'host': host, 'commands': ['true']}
+                else:
+                    config['windows'][0]['panes'][num] = {'commands': ['ssh -t %s true' % host]}
+            path = write_config(tmp, 'ssh', config)
+
+            start = time.time()
+            instance = OfflineItermocil(path, iterm_version=ITERM_VERSIONS['new'])
+            instance.wait_for_hooks()
+            run_panes(instance, pane_texts(instance))
+            elapsed = time.time() - start
+
+            handshakes = refused = 0
+            if os.path.exists(log):
+                with open(log, 'r') as f:
+                    handshakes = sum(1 for line in f if line.startswith('start'))
+            if os.path.exists(log + '.refused'):
+                with open(log + '.refused', 'r') as f:
+                    refused = sum(1 for line in f)
+            peak = peak_concurrency(log)[0] if handshakes else 0
+            print('%-18s %3d panes, %d hosts: %3d handshakes, %3d at once, %3d refused, '
+                  'all done in %.2fs' % (variant, args.panes, len(hosts), handshakes, peak,
+                                         refused, elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_tmux(args):
+    """ Launch layouts in a local tmux server of our own, with TmuxBackend
+        (one command file, run by a single tmux process after the one
+        making the session) and with a tmux process for each command,
+        and compare launch times. Exits non-zero if any launch ends up
+        with the wrong number of windows or panes.
+    """
+
+    if not shutil.which('tmux'):
+        print('tmux is not installed')
+        sys.exit(1)
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    # Servers of our own (a new one each launch, as one being killed can
+    # take a moment to go), which panes get big enough to split into.
+    os.environ.pop('TMUX', None)
+    os.environ['COLUMNS'], os.environ['LINES'] = '400', '200'
+
+    failures = []
+    try:
+        for layout in args.layouts:
+            for panes in args.panes:
+                config = synthetic_config(windows=args.windows, panes=panes, layout=layout)
+                for window in config['windows']:
+                    window['root'] = tmp
+                path = write_config(tmp, 'tmux', config)
+
+                times = {}
+                for variant in ['source-file', 'process per command']:
+                    best = None
+                    for _ in range(args.repeat):
+                        os.environ['TMUX_TMPDIR'] = tempfile.mkdtemp(dir=tmp)
+                        instance = itermocil.Itermocil(path, iterm_version='tmux', parallel=1,
+                                                       split_cwd=True)
+                        backend = itermocil.TmuxBackend(instance)
+                        start = time.time()
+                        if variant == 'source-file':
+                            backend.execute()
+                        else:
+                            subprocess.check_call(['tmux'] + backend.new_session())
+                            for command in backend.commands():
+                                subprocess.check_call(['tmux'] + command)
+                        elapsed = time.time() - start
+                        best = elapsed if best is None else min(best, elapsed)
+
+                        counts = subprocess.check_output(
+                            ['tmux', 'list-windows', '-a', '-F', '#{window_panes}'])
+                        counts = [int(n) for n in counts.split()]
+                        subprocess.call(['tmux', 'kill-server'])
+                        if counts != [panes] * args.windows:
+                            failures.append('%s, %d panes, %s: made windows of %s panes'
+                                            % (layout, panes, variant, counts))
+                    times[variant] = best
+
+                print('%-24s %4d panes x %d windows  source-file %7.1fms  '
+                      'process per command %7.1fms' % (
+                          layout, panes, args.windows, times['source-file'] * 1000,
+                          times['process per command'] * 1000))
+    finally:
+        if 'TMUX_TMPDIR' in os.environ:
+            subprocess.call(['tmux', 'kill-server'], stderr=subprocess.DEVNULL)
+        shutil.rmtree(tmp)
+
+    for failure in failures:
+        print('FAIL ' + failure)
+    if failures:
+        sys.exit(1)
+
+
+def bench_generate(args):
+    """ Time script generation for every layout, across pane and window
+        counts and both old and new iTerm, plus the test layouts. Compare
+        against a --baseline saved with --json: a bigger script, or more
+        splits or keystrokes, is a regression, while slower generation
+        (against a reference case timed in the same run) and more memory
+        are only noted.
+    """
+
+    tmp = tempfile.mkdtemp()
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+
+    cases = []
+    for path in TEST_LAYOUTS:
+        cases.append((os.path.basename(path)[:-4], path))
+
+    for layout in args.layouts:
+        for panes in args.panes:
+            for windows in args.windows:
+                name = '%s_%dx%d' % (layout, windows, panes)
+                config = synthetic_config(windows=windows, panes=panes, layout=layout)
+                cases.append((name, write_config(tmp, name, config)))
+
+    results = {}
+    try:
+        layout, windows, panes, iterm = REFERENCE_CASE
+        path = write_config(tmp, 'reference', synthetic_config(windows=windows, panes=panes,
+                                                               layout=layout))
+        reference = measure_generate(path, ITERM_VERSIONS[iterm], args.repeat)['time']
+
+        for name, path in cases:
+            for iterm, version in sorted(ITERM_VERSIONS.items()):
+                case = '%s/%s' % (iterm, name)
+                results[case] = measure_generate(path, version, args.repeat)
+                if not args.quiet:
+                    r = results[case]
+                    print('%-50s %10.3fms %10dKB %10dB %6d splits %6d keystrokes' % (
+                        case, r['time'] * 1000, r['peak_memory'] // 1024, r['script_size'],
+                        r['splits'], r['keystrokes']))
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'reference': reference,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        scale = baseline['reference'] / reference if 'reference' in baseline else 1.0
+        regressions, notes = compare(results, baseline['results'], args.tolerance, scale)
+        missing = sorted(set(baseline['results']) - set(results))
+        if missing:
+            print('NOTE %d cases in the baseline weren\'t run, e.g. %s' % (len(missing), missing[0]))
+        for n in notes:
+            print('NOTE ' + n)
+        for r in regressions:
+            print('REGRESSION ' + r)
+        if regressions:
+            sys.exit(1)
+
+
+def bench_launch(args):
+    """ Time launching layouts in iTerm, end to end, with each backend.
+        Needs a Mac with iTerm running (and the iterm2 package, for the
+        api backend).
+    """
+
+    files = args.files or TEST_LAYOUTS
+    script = os.path.join(HERE, 'itermocil.py')
+
+    print('%-40s' % 'layout' + ''.join('%14s' % b for b in args.backends))
+    for path in files:
+        row = '%-40s' % os.path.basename(path)[:40]
+        for backend in args.backends:
+            times = []
+            for _ in range(args.repeat):
+                start = time.time()
+                subprocess.check_call([sys.executable, script, '--no-cache', '--layout',
+                                       path, '--backend', backend])
+                times.append(time.time() - start)
+            row += '%12.0fms' % (min(times) * 1000)
+        print(row)
+
+
+def bench_daemon(args):
+    """ Compare the latency of the itermocil command with and without a
+        daemon running. Scripts are generated with --debug and a pinned
+        iTerm version, so this doesn't need iTerm.
+    """
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, ITERMOCIL_CACHE_DIR=tmp, ITERMOCIL_ITERM_VERSION='3.4')
+    client = os.path.join(HERE, 'itermocil')
+    files = args.files or TEST_LAYOUTS
+
+    def timed(command):
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, client] + command, env=env,
+                                  stdout=subprocess.DEVNULL)
+            times.append(time.time() - start)
+        return min(times)
+
+    commands = [['--version'], ['--list']]
+    commands += [['--debug', '--layout', path] for path in files]
+
+    try:
+        cold = [timed(c) for c in commands]
+
+        daemon = subprocess.Popen([sys.executable, os.path.join(HERE, 'itermocil.py'), '--daemon'],
+                                  env=env)
+        try:
+            while not os.path.exists(os.path.join(tmp, 'daemon.sock')):
+                time.sleep(0.01)
+            warm = [timed(c) for c in commands]
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+        print('%-40s %12s %12s' % ('command', 'cold', 'daemon'))
+        for command, c, w in zip(commands, cold, warm):
+            print('%-40s %10.1fms %10.1fms' % (os.path.basename(command[-1])[:40], c * 1000, w * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# Modules that quick commands (used by shell completion) must not import,
+# and how many milliseconds of imports each may take beyond the
+# interpreter's own.
+SLOW_MODULES = ['yaml', 'pickle', 'hashlib', 'json', 'threading', 'asyncio',
+                'concurrent.futures', 'iterm2', 'socket']
+# --edit has to start the editor, and subprocess brings threading with it.
+IMPORT_BUDGETS = [
+    (['--version'], 25, []),
+    (['--list'], 25, []),
+    (['--complete', '_t'], 25, []),
+    (['--show', '--layout', os.path.join(HERE, 'test_layouts', '_tiled_3_panes.yml')], 25, []),
+    (['--edit', '--layout', os.path.join(HERE, 'test_layouts', '_tiled_3_panes.yml')], 35,
+     ['threading']),
+]
+
+
+def import_times(command, env):
+    """ Run python -X importtime on a command (in a process of its own, as
+        the itermocil script would be), returning a dict of module name to
+        the time (in seconds) spent importing it, excluding its own
+        imports.
+    """
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + command, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    times = {}
+    for line in proc.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times[fields[2].strip()] = int(fields[0]) / 1000000.0
+        except (IndexError, ValueError):
+            continue
+
+    return times
+
+
+def bench_imports(args):
+    """ Time the imports of the quick commands, run through the itermocil
+        script (the entry point installed, which starts with the daemon
+        client), against their budgets, noting any slow modules imported
+        or osascript run. tests/test_imports.py checks them.
+    """
+
+    tmp = tempfile.mkdtemp()
+    marker = os.path.join(tmp, 'osascript-was-run')
+
+    # An osascript that leaves a mark if anything runs it.
+    bin_dir = os.path.join(tmp, 'bin')
+    os.mkdir(bin_dir)
+    with open(os.path.join(bin_dir, 'osascript'), 'w') as f:
+        f.write('#!/bin/sh\ntouch %s\n' % marker)
+    os.chmod(os.path.join(bin_dir, 'osascript'), 0o755)
+
+    # Some layouts to list, already indexed as they would be after the
+    # first --list.
+    home = os.path.join(tmp, 'home')
+    os.makedirs(os.path.join(home, '.itermocil'))
+    for path in TEST_LAYOUTS:
+        shutil.copy(path, os.path.join(home, '.itermocil'))
+
+    env = dict(os.environ, ITERMOCIL_CACHE_DIR=os.path.join(tmp, 'cache'),
+               PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+               EDITOR='true', HOME=home)
+    env.pop('ITERMOCIL_ITERM_VERSION', None)
+    # Compiled once (by the --list below), as an installed module would be.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPYCACHEPREFIX'] = os.path.join(tmp, 'pycache')
+
+    try:
+        subprocess.check_call([sys.executable, os.path.join(HERE, 'itermocil'), '--list'],
+                              env=env, stdout=subprocess.DEVNULL)
+
+        # Best of a few runs, to smooth out noise.
+        def best(command):
+            runs = [import_times(command, env) for _ in range(args.repeat)]
+            return dict((name, min(r.get(name, 0) for r in runs)) for name in runs[0])
+
+        interpreter = best(['-c', 'pass'])
+
+        for command, budget, allowed in IMPORT_BUDGETS:
+            times = best([os.path.join(HERE, 'itermocil')] + command)
+            extra = dict((k, v) for k, v in times.items() if k not in interpreter)
+            total = sum(extra.values()) * 1000
+            slow = [m for m in SLOW_MODULES if m in times and m not in allowed]
+            if os.path.exists(marker):
+                slow.append('(ran osascript)')
+                os.remove(marker)
+
+            print('%-10s %6.1fms (budget %dms)  %s' % (command[0], total, budget,
+                                                       ' '.join(slow) or ''))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_catalogue(args):
+    """ Time building the layout index from scratch, refreshing it when
+        nothing (or one file) has changed, and searching it, for a
+        directory of many layouts.
+    """
+
+    tmp = tempfile.mkdtemp()
+    saved_cache_dir = os.environ.get('ITERMOCIL_CACHE_DIR')
+    os.environ['ITERMOCIL_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    try:
+        layout_dir = os.path.join(tmp, 'layouts')
+        os.mkdir(layout_dir)
+        for n in range(args.layouts):
+            config = synthetic_config(windows=1 + n % 3, panes=1 + n % 8,
+                                      layout=LAYOUTS[n % len(LAYOUTS)])
+            write_config(layout_dir, 'project-%04d' % n, config)
+
+        index_path = os.path.join(tmp, 'index.tsv')
+
+        def cold():
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            itermocil._memo.clear()
+            itermocil.LayoutIndex(index_path, [layout_dir]).refresh()
+
+        def warm():
+            itermocil.LayoutIndex(index_path, [layout_dir]).refresh()
+
+        changed = os.path.join(layout_dir, 'project-0000.yml')
+
+        def one_changed():
+            os.utime(changed, None)
+            itermocil.LayoutIndex(index_path, [layout_dir]).refresh()
+
+        def search():
+            itermocil.LayoutIndex(index_path, [layout_dir]).refresh().search('pj12')
+
+        results = [('build index', time_call(cold, args.repeat)),
+                   ('refresh, unchanged', time_call(warm, args.repeat)),
+                   ('refresh, one changed', time_call(one_changed, args.repeat)),
+                   ('fuzzy search', time_call(search, args.repeat))]
+
+        print('%d layouts' % args.layouts)
+        for name, t in results:
+            print('  %-22s %8.2fms' % (name, t * 1000))
+    finally:
+        if saved_cache_dir is None:
+            del os.environ['ITERMOCIL_CACHE_DIR']
+        else:
+            os.environ['ITERMOCIL_CACHE_DIR'] = saved_cache_dir
+        shutil.rmtree(tmp)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark iTermocil.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    yaml_parser = subparsers.add_parser('yaml', help='compare YAML loading speed')
+    yaml_parser.add_argument('--panes', type=int, nargs='*', default=[100, 1000, 5000],
+                             help='pane counts for synthetic layouts')
+    yaml_parser.add_argument('--windows', type=int, default=1,
+                             help='windows in synthetic layouts')
+    yaml_parser.add_argument('--repeat', type=int, default=3)
+    yaml_parser.set_defaults(func=bench_yaml)
+
+    generate_parser = subparsers.add_parser('generate', help='time script generation')
+    generate_parser.add_argument('--layouts', nargs='*', default=LAYOUTS,
+                                 help='layouts for synthetic configs')
+    generate_parser.add_argument('--panes', type=int, nargs='*', default=[1, 4, 16, 64, 256],
+                                 help='panes per window for synthetic configs')
+    generate_parser.add_argument('--windows', type=int, nargs='*', default=[1, 10, 50],
+                                 help='windows for synthetic configs')
+    generate_parser.add_argument('--repeat', type=int, default=3)
+    generate_parser.add_argument('--json', help='save results as JSON to this file')
+    generate_parser.add_argument('--baseline', help='compare against results saved with --json')
+    generate_parser.add_argument('--tolerance', type=float, default=0.25,
+                                 help='slowdown relative to the baseline to note (0.25 = 25%%)')
+    generate_parser.add_argument('--quiet', action='store_true')
+    generate_parser.set_defaults(func=bench_generate)
+
+    launch_parser = subparsers.add_parser('launch', help='time launching layouts in iTerm')
+    launch_parser.add_argument('files', nargs='*', help='layout files (default: the test layouts)')
+    launch_parser.add_argument('--backends', nargs='*', default=['applescript', 'api'])
+    launch_parser.add_argument('--repeat', type=int, default=3)
+    launch_parser.set_defaults(func=bench_launch)
+
+    daemon_parser = subparsers.add_parser('daemon', help='compare latency with and without the daemon')
+    daemon_parser.add_argument('files', nargs='*', help='layout files (default: the test layouts)')
+    daemon_parser.add_argument('--repeat', type=int, default=5)
+    daemon_parser.set_defaults(func=bench_daemon)
+
+    startup_parser = subparsers.add_parser('startup', help='measure how many panes start at once')
+    startup_parser.add_argument('--panes', type=int, default=12)
+    startup_parser.add_argument('--max-concurrent', type=int, default=3)
+    startup_parser.add_argument('--stagger', type=float, default=0.2)
+    startup_parser.add_argument('--work', type=float, default=0.5,
+                                help='seconds each pane spends starting up')
+    startup_parser.set_defaults(func=bench_startup)
+
+    depends_parser = subparsers.add_parser('depends', help='compare depends_on with sleep padding')
+    depends_parser.add_argument('--db-delay', type=float, default=1.0,
+                                help='seconds the database takes to listen')
+    depends_parser.add_argument('--api-delay', type=float, default=0.5,
+                                help='seconds the API takes to listen, once started')
+    depends_parser.add_argument('--padding', type=float, default=2.0,
+                                help='how many times longer than needed sleeps are')
+    depends_parser.set_defaults(func=bench_depends)
+
+    pre_parser = subparsers.add_parser('pre', help='compare running pre hooks in turn and in parallel')
+    pre_parser.add_argument('--hooks', type=int, default=4)
+    pre_parser.add_argument('--work', type=float, default=0.5,
+                            help='seconds each hook takes')
+    pre_parser.add_argument('--panes', type=int, default=64)
+    pre_parser.set_defaults(func=bench_pre)
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='time --reconcile against '
+                                             'canned iTerm state')
+    reconcile_parser.add_argument('--windows', type=int, default=3)
+    reconcile_parser.add_argument('--panes', type=int, default=16)
+    reconcile_parser.set_defaults(func=bench_reconcile)
+
+    ssh_parser = subparsers.add_parser('ssh', help='count ssh handshakes with and without host')
+    ssh_parser.add_argument('--panes', type=int, default=20)
+    ssh_parser.add_argument('--hosts', type=int, default=3)
+    ssh_parser.add_argument('--handshake', type=float, default=0.3,
+                            help='seconds the stand-in ssh takes to connect')
+    ssh_parser.add_argument('--max-startups', type=int, default=10,
+                            help='connections the stand-in sshd accepts at once')
+    ssh_parser.set_defaults(func=bench_ssh)
+
+    tmux_parser = subparsers.add_parser('tmux', help='time launching layouts in a local tmux')
+    tmux_parser.add_argument('--layouts', nargs='*', default=['tiled', 'main-vertical', 'grid'])
+    tmux_parser.add_argument('--panes', type=int, nargs='*', default=[4, 16])
+    tmux_parser.add_argument('--windows', type=int, default=2)
+    tmux_parser.add_argument('--repeat', type=int, default=2)
+    tmux_parser.set_defaults(func=bench_tmux)
+
+    typed_parser = subparsers.add_parser('typed', help='compare what --split-cwd and '
+                                         '--source-commands type into panes')
+    typed_parser.add_argument('--panes', type=int, nargs='+', default=[4, 16, 64])
+    typed_parser.set_defaults(func=bench_typed)
+
+    grid_parser = subparsers.add_parser('grid', help='compare the grid layout with tiled and 3_columns')
+    grid_parser.add_argument('--panes', type=int, nargs='+', default=[4, 16, 36, 64, 144, 256, 400])
+    grid_parser.add_argument('--repeat', type=int, default=3)
+    grid_parser.set_defaults(func=bench_grid)
+
+    keystrokes_parser = subparsers.add_parser('keystrokes', help='count the keystrokes old iTerm needs')
+    keystrokes_parser.add_argument('--panes', type=int, nargs='+', default=[2, 4, 9, 16, 36, 64])
+    keystrokes_parser.add_argument('--json', help='save results to this file')
+    keystrokes_parser.add_argument('--baseline', help='compare with results saved by --json')
+    keystrokes_parser.add_argument('--quiet', action='store_true')
+    keystrokes_parser.set_defaults(func=bench_keystrokes)
+
+    plans_parser = subparsers.add_parser('plans', help='time planning layouts')
+    plans_parser.add_argument('--max-panes', type=int, default=256)
+    plans_parser.set_defaults(func=bench_plans)
+
+    catalogue_parser = subparsers.add_parser('catalogue', help='time indexing and searching layouts')
+    catalogue_parser.add_argument('--layouts', type=int, default=500)
+    catalogue_parser.add_argument('--repeat', type=int, default=3)
+    catalogue_parser.set_defaults(func=bench_catalogue)
+
+    imports_parser = subparsers.add_parser('imports', help='time quick commands\' imports against their budgets')
+    imports_parser.add_argument('--repeat', type=int, default=5)
+    imports_parser.set_defaults(func=bench_imports)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,1662 @@
 import argparse
 import os
 import re
-import subprocess
 import sys
-import yaml
+import time
 
 from math import ceil
 
+# Anything else (yaml, subprocess, json etc.) is imported where it is
+# used, so that --version, --list, --show and --edit, which shell
+# completion calls all the time, start as quickly as possible.
+
 
 __version__ = '1.0.3'
 
 
+# Where iTerm usually lives; its Info.plist changes whenever iTerm is
+# upgraded, so we use it to know when a cached version string is stale.
+ITERM_APP_PATHS = ['/Applications/iTerm.app',
+                   os.path.join(os.path.expanduser("~"), 'Applications', 'iTerm.app')]
+
+
+# Results (iTerm versions, parsed layouts) that are worth keeping for as
+# long as we're running, keyed by what they depend on. This matters for
+# the daemon (see serve), which handles many launches, so it's kept to
+# the latest result for each thing (see remember), and at most MEMO_SIZE.
+_memo = {}
+_memo_latest = {}
+MEMO_SIZE = 1024
+
+
+def remember(key, value, of=None):
+    """ Keep a result in _memo, and return it. A result for something
+        given by of (a layout's path, say) replaces any earlier one for
+        it, keyed by an older mtime. Beyond MEMO_SIZE results, the oldest
+        are dropped.
+    """
+
+    if of is not None:
+        old = _memo_latest.get(of)
+        if old is not None and old != key:
+            _memo.pop(old, None)
+        _memo_latest[of] = key
+
+    _memo[key] = value
+    while len(_memo) > MEMO_SIZE:
+        _memo.pop(next(iter(_memo)))
+
+    return value
+
+
+def cache_dir():
+    """ Return the directory itermocil keeps its caches in, creating it
+        if needed. Honours $ITERMOCIL_CACHE_DIR and $XDG_CACHE_HOME.
+    """
+
+    path = os.getenv('ITERMOCIL_CACHE_DIR')
+    if not path:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), '.cache')
+        path = os.path.join(base, 'itermocil')
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return path
+
+
+def iterm_bundle_stamp():
+    """ Return a string identifying the installed iTerm app bundle (its
+        Info.plist path, mtime and size), or None if it can't be found.
+    """
+
+    for app in ITERM_APP_PATHS:
+        plist = os.path.join(app, 'Contents', 'Info.plist')
+        try:
+            st = os.stat(plist)
+        except OSError:
+            continue
+        return '%s:%d:%d' % (plist, int(st.st_mtime), st.st_size)
+
+    return None
+
+
+# Applescript for tracing: the time (in seconds, with microseconds) since
+# the script started, from Foundation's NSDate, in the script's own
+# process. Applescript's own dates only have a resolution of one second,
+# and asking a shell would cost a process for every step.
+TRACE_START = ['use framework "Foundation"',
+               'use scripting additions',
+               "set itermocil_start to current application's NSDate's |date|()"]
+TRACE_TIMESTAMP = "((itermocil_start's timeIntervalSinceNow()) * -1) as text"
+
+
+def parse_trace(output):
+    """ Turn the output of a traced script into a list of (step, seconds)
+        giving how long each step took since the previous one.
+    """
+
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+
+    steps = []
+    previous = None
+    for line in output.replace('\r', '\n').split('\n'):
+        label, _, stamp = line.rpartition('\t')
+        try:
+            # Applescript writes numbers with the locale's decimal comma.
+            stamp = float(stamp.replace(',', '.'))
+        except ValueError:
+            continue
+        if previous is not None:
+            steps.append((label, stamp - previous))
+        previous = stamp
+
+    return steps
+
+
+class _Phase(object):
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timings.record(self.name, time.time() - self.start)
+
+
+class Timings(object):
+    """ Records how long each phase of a launch takes, along with how many
+        subprocesses were spawned and how many bytes of script were piped
+        to osascript. Hooks are called with (phase, seconds) as each phase
+        finishes.
+    """
+
+    def __init__(self, hooks=None):
+
+        self.phases = []
+        self.pre_hooks = []
+        self.subprocesses = 0
+        self.osascript_bytes = 0
+        self.hooks = list(hooks or [])
+
+        import threading
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        """ Time the body of a with block as the named phase.
+        """
+
+        return _Phase(self, name)
+
+    def record(self, name, seconds):
+
+        self.phases.append((name, seconds))
+        for hook in self.hooks:
+            hook(name, seconds)
+
+    def record_hook(self, name, seconds, error=None):
+        """ Note how long a pre hook took to run (alongside the phases,
+            as hooks run concurrently with them), and whether it failed.
+        """
+
+        with self.lock:
+            self.pre_hooks.append((name, seconds, error))
+
+    def spawned(self, stdin_bytes=0, osascript=True):
+        """ Note that a subprocess was run, and what was piped to it.
+        """
+
+        with self.lock:
+            self.subprocesses += 1
+            if osascript:
+                self.osascript_bytes += stdin_bytes
+
+    def as_dict(self):
+
+        return {
+            'phases': [{'phase': name, 'seconds': seconds} for name, seconds in self.phases],
+            'total': sum(seconds for _, seconds in self.phases),
+            'pre_hooks': [{'hook': name, 'seconds': seconds, 'error': error}
+                          for name, seconds, error in self.pre_hooks],
+            'subprocesses': self.subprocesses,
+            'osascript_bytes': self.osascript_bytes,
+        }
+
+    def report(self):
+        """ Return a human readable table of the timings.
+        """
+
+        lines = []
+        for name, seconds in self.phases:
+            lines.append('%-14s %9.1fms' % (name, seconds * 1000))
+        lines.append('%-14s %9.1fms' % ('total', sum(seconds for _, seconds in self.phases) * 1000))
+        for name, seconds, error in self.pre_hooks:
+            lines.append('%-14s %9.1fms  %s%s' % ('pre hook', seconds * 1000, name,
+                                                 ' (failed)' if error else ''))
+        lines.append('%-14s %9d' % ('subprocesses', self.subprocesses))
+        lines.append('%-14s %9d' % ('osascript in', self.osascript_bytes))
+
+        return '\n'.join(lines)
+
+
+def osascript(script=None, compiled=None, timings=None):
+    """ Run an Applescript with osascript, either from source or from a
+        script previously compiled with osacompile, returning its output.
+    """
+
+    import subprocess
+
+    if compiled:
+        if timings:
+            timings.spawned()
+        osa = subprocess.Popen(['osascript', compiled],
+                               stdout=subprocess.PIPE)
+        return osa.communicate()[0]
+
+    script = script.encode('utf-8')
+    if timings:
+        timings.spawned(len(script))
+
+    osa = subprocess.Popen(['osascript', '-'],
+                           stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+
+    return osa.communicate(script)[0]
+
+
+def osascript_result(script, timings=None):
+    """ Run an Applescript with osascript, returning its exit status,
+        output and errors.
+    """
+
+    import subprocess
+
+    script = script.encode('utf-8')
+    if timings:
+        timings.spawned(len(script))
+
+    osa = subprocess.Popen(['osascript', '-'],
+                           stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+    out, err = osa.communicate(script)
+
+    return osa.returncode, out, err
+
+
+def iterm_version_string(override=None, timings=None):
+    """ Get the version string of iTerm, as bytes.
+
+        Asking iTerm means running osascript, which is slow, so the
+        answer is cached on disk until the iTerm app bundle changes.
+        An override (or $ITERMOCIL_ITERM_VERSION) skips asking at all.
+    """
+
+    override = override or os.getenv('ITERMOCIL_ITERM_VERSION')
+    if override:
+        return str(override).encode('utf-8')
+
+    stamp = iterm_bundle_stamp()
+
+    if stamp and stamp in _memo:
+        return _memo[stamp]
+
+    if stamp:
+        try:
+            cache_file = os.path.join(cache_dir(), 'iterm_version')
+            with open(cache_file, 'r') as f:
+                cached_stamp, cached_version = f.read().split('\n')[:2]
+            if cached_stamp == stamp and cached_version:
+                return remember(stamp, cached_version.encode('utf-8'), of='iterm_version')
+        except (IOError, OSError, ValueError):
+            pass
+
+    version_script = 'set iterm_version to (get version of application "iTerm")'
+    v = osascript(version_script, timings=timings).strip()
+
+    if stamp and v:
+        remember(stamp, v, of='iterm_version')
+        try:
+            with open(os.path.join(cache_dir(), 'iterm_version'), 'w') as f:
+                f.write(stamp + '\n' + v.decode('utf-8') + '\n')
+        except (IOError, OSError):
+            pass
+
+    return v
+
+
+def live_sessions(timings=None):
+    """ Ask iTerm (with one script) for every open session tagged by a
+        --reconcile launch, returning a dict of tag to session id.
+    """
+
+    script = """ tell application "iTerm"
+                     set out to ""
+                     repeat with w in windows
+                         repeat with t in tabs of w
+                             repeat with s in sessions of t
+                                 tell s to set itermocil_tag to (variable named "user.itermocil")
+                                 if itermocil_tag is not missing value and itermocil_tag is not "" then
+                                     set out to out & (id of s as text) & (character id 9) & itermocil_tag & linefeed
+                                 end if
+                             end repeat
+                         end repeat
+                     end repeat
+                     return out
+                 end tell
+             """
+
+    live = {}
+    for line in osascript(script, timings=timings).decode('utf-8').splitlines():
+        if '\t' in line:
+            session_id, tag = line.split('\t', 1)
+            live.setdefault(tag.strip(), session_id.strip())
+
+    return live
+
+
+def load_config(path, use_cache=True):
+    """ Parse a teamocil file. The parsed config is kept in a pickle
+        sidecar in the cache directory, keyed by path, mtime and size, so
+        large layouts don't need to be parsed again until they change.
+    """
+
+    import hashlib
+    import pickle
+
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    sidecar = None
+
+    if use_cache and stamp in _memo:
+        return _memo[stamp]
+
+    if use_cache:
+        try:
+            name = hashlib.sha1(stamp[0].encode('utf-8')).hexdigest() + '.pickle'
+            sidecar = os.path.join(cache_dir(), 'configs', name)
+            with open(sidecar, 'rb') as f:
+                cached_stamp, config = pickle.load(f)
+            if cached_stamp == stamp:
+                return remember(stamp, config, of=stamp[0])
+        except Exception:
+            pass
+
+    import yaml
+
+    # libyaml's loader is many times faster than the pure Python one, but
+    # isn't always compiled in.
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    with open(path, 'r') as f:
+        config = yaml.load(f, Loader=loader)
+
+    if use_cache:
+        remember(stamp, config, of=stamp[0])
+
+    if sidecar:
+        try:
+            if not os.path.isdir(os.path.dirname(sidecar)):
+                os.makedirs(os.path.dirname(sidecar))
+            with open(sidecar, 'wb') as f:
+                pickle.dump((stamp, config), f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError, pickle.PicklingError):
+            pass
+
+    return config
+
+
+def major_version_of(v):
+    """ Turn an iTerm version string into a major version number, treating
+        anything unparseable as a new iTerm.
+    """
+
+    try:
+        mv = float(v[:3])
+        return mv
+    except ValueError:
+        return 99.0
+
+
+class Statement(object):
+    """ A single line of Applescript. The other nodes below make up the
+        small tree we build scripts from, which can be emitted compactly
+        to run, or indented to read (with --debug).
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def emit(self, lines, depth=0, compact=False):
+        lines.append(self.text if compact else "\t" * depth + self.text)
+
+
+class Delay(Statement):
+    """ Pause the script for a number of seconds.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        Statement.__init__(self, 'delay %s' % seconds)
+
+
+class Keystroke(Statement):
+    """ Send a keystroke (or a key code) to iTerm via System Events. This
+        is how old iTerm is driven.
+    """
+
+    def __init__(self, key=None, modifiers=('command',), key_code=None):
+        self.key = key
+        self.modifiers = tuple(modifiers)
+        self.key_code = key_code
+
+        if key_code is not None:
+            stroke = 'key code %d' % key_code
+        else:
+            stroke = 'keystroke "%s"' % key
+
+        using = ', '.join('%s down' % m for m in self.modifiers)
+        if len(self.modifiers) > 1:
+            using = '{' + using + '}'
+
+        Statement.__init__(self, 'tell i term application "System Events" to %s using %s'
+                           % (stroke, using))
+
+
+class CurrentSession(Statement):
+    """ Name the current session of the current window as a pane, so
+        later splits can refer to it.
+    """
+
+    def __init__(self, pane):
+        self.pane = pane
+        Statement.__init__(self, 'set pane_%s to (current session of current window)' % pane)
+
+
+class FindSession(object):
+    """ Find the session whose unique id is in the Applescript variable
+        'session_id' (or is session_id, if given), wherever it is, and
+        name it as a pane. This is how a script for a single window finds
+        the tab it should work in, and --reconcile finds the panes still
+        open. first says whether it's the first pane of a window found
+        (by default, if it's pane 1).
+    """
+
+    def __init__(self, pane, session_id=None, first=None):
+        self.pane = pane
+        self.session_id = session_id
+        self.first = pane == 1 if first is None else first
+
+    def emit(self, lines, depth=0, compact=False):
+
+        indent = "" if compact else "\t" * depth
+        step = "" if compact else "\t"
+        lines.append(indent + 'repeat with w in windows')
+        lines.append(indent + step + 'repeat with t in tabs of w')
+        lines.append(indent + step * 2 + 'repeat with s in sessions of t')
+        wanted = 'session_id' if self.session_id is None else '"%s"' % quote(self.session_id)
+        lines.append(indent + step * 3 + 'if (id of s as text) is %s then set pane_%s to s'
+                     % (wanted, self.pane))
+        lines.append(indent + step * 2 + 'end repeat')
+        lines.append(indent + step + 'end repeat')
+        lines.append(indent + 'end repeat')
+
+
+class WaitForSessions(object):
+    """ Wait until the current (old iTerm) window has at least a number of
+        sessions, checking every interval seconds, for up to timeout
+        seconds. This is how we know keystrokes have had their effect.
+    """
+
+    def __init__(self, count, timeout, interval):
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+
+    def emit(self, lines, depth=0, compact=False):
+
+        indent = "" if compact else "\t" * depth
+        step = "" if compact else "\t"
+        lines.append(indent + 'repeat %d times' % max(1, int(ceil(self.timeout / self.interval))))
+        lines.append(indent + step + 'if (count sessions of current terminal) >= %d then exit repeat'
+                     % self.count)
+        lines.append(indent + step + 'delay %s' % self.interval)
+        lines.append(indent + 'end repeat')
+
+
+class Tell(object):
+    """ A 'tell' block, sending the statements in body to target.
+    """
+
+    def __init__(self, target, body=None):
+        self.target = target
+        self.body = body or []
+
+    def emit(self, lines, depth=0, compact=False):
+
+        if compact:
+            if len(self.body) == 1 and isinstance(self.body[0], Statement):
+                lines.append('tell %s to %s' % (self.target, self.body[0].text))
+                return
+            lines.append('tell ' + self.target)
+            for node in self.body:
+                node.emit(lines, depth, compact)
+            lines.append('end tell')
+            return
+
+        indent = "\t" * depth
+        lines.append("")
+        lines.append(indent + 'tell ' + self.target)
+        for node in self.body:
+            node.emit(lines, depth + 1, compact)
+        lines.append(indent + 'end tell')
+
+
+class Split(Tell):
+    """ Split pane_<parent> in the given direction ('vertical' puts the
+        new pane to the right, 'horizontal' below), naming the new pane
+        pane_<child>.
+    """
+
+    def __init__(self, parent, child, direction="vertical", command=None):
+        self.parent = parent
+        self.child = child
+        self.direction = direction
+        self.command = command
+        split = 'split %sly with same profile' % direction
+        if command:
+            split += ' command "%s"' % quote(command)
+        Tell.__init__(self, 'pane_%s' % parent, [
+            Statement('set pane_%s to (%s)' % (child, split))
+        ])
+
+
+class WriteText(Tell):
+    """ Type text into a session (unless text is None), and optionally
+        name it, and tag it (in the user.itermocil variable, which needs
+        iTerm 3.3+) so --reconcile can find it later.
+    """
+
+    def __init__(self, target, text, name=None, tag=None):
+        self.text = text
+        self.name = name
+        self.tag = tag
+        body = []
+        if text is not None:
+            body.append(Statement('write text "%s"' % quote(text)))
+        if name:
+            body.append(Statement('set name to "%s"' % quote(name)))
+        if tag:
+            body.append(Statement('set variable named "user.itermocil" to "%s"' % quote(tag)))
+        Tell.__init__(self, target, body)
+
+
+class Select(Tell):
+    """ Focus a session.
+    """
+
+    def __init__(self, target):
+        Tell.__init__(self, target, [Statement('select')])
+
+
+def quote(text):
+    """ Escape backslashes and double quotes for use in an Applescript
+        string. Nodes hold plain text (pane commands are shell text, as
+        typed), which is only escaped here, as the script is emitted.
+    """
+
+    return text.replace('\\', '\\\\').replace('"', r'\"')
+
+
+def shell_path(path):
+    """ Quote a path (a root directory) for the shell, leaving a leading
+        ~ or ~user for the shell to expand.
+    """
+
+    import shlex
+
+    if path.startswith('~'):
+        head, sep, rest = path.partition('/')
+        return head + sep + (shlex.quote(rest) if rest else '')
+
+    return shlex.quote(path)
+
+
+def emit(nodes, compact=False):
+    """ Turn a list of nodes into Applescript, either compact (to run) or
+        indented and spaced out (to read).
+    """
+
+    lines = []
+    for node in nodes:
+        node.emit(lines, 0, compact)
+
+    if compact:
+        return "\n".join(lines)
+
+    return "\n".join(lines) + "\n"
+
+
+def validate(nodes):
+    """ Check a script before spending an osascript run on it: every pane
+        must be created before it is used, and never created twice.
+        Raises ValueError if there is a problem.
+    """
+
+    defined = set()
+
+    def check(node):
+        if isinstance(node, (CurrentSession, FindSession)):
+            # Each window starts again from its own first pane.
+            if node.pane == 1 if isinstance(node, CurrentSession) else node.first:
+                defined.clear()
+            defined.add(node.pane)
+        elif isinstance(node, Split):
+            if node.parent not in defined:
+                raise ValueError("pane_%s is split before it exists" % node.parent)
+            if node.child in defined:
+                raise ValueError("pane_%s is created twice" % node.child)
+            defined.add(node.child)
+        elif isinstance(node, Tell):
+            match = re.match(r'^pane_(\d+)$', node.target)
+            if match and int(match.group(1)) not in defined:
+                raise ValueError("%s is used before it exists" % node.target)
+            for child in node.body:
+                check(child)
+
+    for node in nodes:
+        check(node)
+
+
+def layout_plan(layout, num_panes, columns=None, rows=None):
+    """ Work out how to build a layout of num_panes panes: a tuple of
+        (parent, child, direction) splits, in the order they are made.
+        Pane 1 is the one we start with, and splitting pane 'parent'
+        creates pane 'child' to its right ('vertical') or below it
+        ('horizontal'). Attempts to match teamocil layout behaviour as
+        closely as is possible.
+
+        Panes end up numbered in the order iTerm cycles through them, so
+        both the named panes of new iTerm and the numbered sessions of old
+        iTerm refer to the same places. Raises ValueError for unknown
+        layouts.
+
+        columns and rows only apply to the 'grid' layout.
+    """
+
+    key = ('layout_plan', layout, num_panes, columns, rows)
+    if key in _memo:
+        return _memo[key]
+
+    plan = []
+
+    def create_pane(parent, child, split="vertical"):
+        plan.append((parent, child, split))
+
+    # tmux seems to treat the first 2 tiles of a tiled layout like this
+    if num_panes == 2:
+        if layout == 'tiled':
+            layout = 'even-vertical'
+        elif layout == 'double-main-horizontal':
+            layout = 'main-horizontal'
+        elif layout == 'double-main-vertical':
+            layout = 'even-horizontal'
+
+    # If we have just one pane we don't need to do any splitting.
+    if num_panes <= 1:
+        pass
+
+    # 'even-horizontal' layouts just split vertically across the screen
+    elif layout == 'even-horizontal':
+
+        for p in range(2, num_panes+1):
+            create_pane(p-1, p, "vertical")
+
+    # 'even-vertical' layouts just split horizontally down the screen
+    elif layout == 'even-vertical':
+
+        for p in range(2, num_panes+1):
+            create_pane(p-1, p, "horizontal")
+
+    # 'main-vertical' layouts have one left pane that is full height,
+    # and then split the remaining panes horizontally down the right
+    elif layout == 'main-vertical':
+
+        create_pane(1, 2, "vertical")
+        for p in range(3, num_panes+1):
+            create_pane(p-1, p, "horizontal")
+
+    # 'main-vertical-flipped' layouts have one right pane that is full height,
+    # and then split the remaining panes horizontally down the left
+    elif layout == 'main-vertical-flipped':
+
+        create_pane(1, num_panes, "vertical")
+        for p in range(2, num_panes):
+            create_pane(p-1, p, "horizontal")
+
+    # 'main-horizontal' layouts have one left pane that is full height,
+    # and then split the remaining panes horizontally down the right
+    elif layout == 'main-horizontal':
+
+        create_pane(1, 2, "horizontal")
+        for p in range(3, num_panes+1):
+            create_pane(p-1, p, "vertical")
+
+    # 'double-main-horizontal' layouts have two left panes that are full height,
+    # and then split the remaining panes horizontally down the right
+    elif layout == 'double-main-horizontal':
+
+        create_pane(1, num_panes-1, "horizontal")
+        create_pane(num_panes-1, num_panes, "vertical")
+        for p in range(2, num_panes-1):
+            create_pane(p-1, p, "vertical")
+
+    # 'double-main-vertical' layouts have two bottom panes that spllit the width
+    # and then split the remaining panes vertically across the top
+    elif layout == 'double-main-vertical':
+
+        create_pane(1, 2, "vertical")
+        create_pane(2, 3, "vertical")
+        for p in range(4, num_panes+1):
+            create_pane(p-1, p, "horizontal")
+
+    # 'tiled' layouts create 2 columns and then however many rows as
+    # needed. If there are odd number of panes then the bottom pane
+    # spans two columns. Panes are numbered top to bottom, left to right.
+    elif layout == 'tiled':
+
+        vertical_splits = int(ceil((num_panes / 2.0))) - 1
+        second_columns = num_panes // 2
+
+        for p in range(0, vertical_splits):
+            pp = (p * 2) + 1
+            cp = pp + 2
+            create_pane(pp, cp, "horizontal")
+
+        for p in range(0, second_columns):
+            pp = (p * 2) + 1
+            cp = pp + 1
+            create_pane(pp, cp, "vertical")
+
+    # '3_columns' layouts create 3 columns and then however many rows as
+    # needed. If there are odd number of panes then the bottom pane
+    # spans two columns. Panes are numbered top to bottom, left to right.
+    elif layout == '3_columns':
+
+        vertical_splits = int(ceil((num_panes / 3.0))) - 1
+        i = 1
+
+        for p in range(0, vertical_splits):
+            pp = (p * 3) + 1
+            cp = pp + 3
+            i += 1
+            create_pane(pp, cp, "horizontal")
+
+        for p in range(0, vertical_splits+1):
+            pp = (p * 3) + 1
+            for q in range(0, 2):
+                if i >= num_panes:
+                    break
+                qp = pp + q
+                cp = pp + 1 + q
+                i += 1
+                create_pane(qp, cp, "vertical")
+
+    # 'grid' layouts arrange the panes in as square a grid as possible
+    # (or with the given number of columns or rows), numbered row by row.
+    # If the panes don't fill the grid then the bottom row has fewer,
+    # wider panes. Rows, and then the panes in each row, are made by
+    # splitting in half each time, so they come out close to even.
+    elif layout == 'grid':
+
+        if columns:
+            num_columns = int(columns)
+        elif rows:
+            num_columns = int(ceil(num_panes / float(rows)))
+        else:
+            num_columns = int(ceil(num_panes ** 0.5))
+        if num_columns < 1:
+            raise ValueError("A grid needs at least one column.")
+        num_rows = int(ceil(num_panes / float(num_columns)))
+
+        def halve(first, count, step, split):
+            if count > 1:
+                half = (count + 1) // 2
+                create_pane(first, first + half * step, split)
+                halve(first, half, step, split)
+                halve(first + half * step, count - half, step, split)
+
+        halve(1, num_rows, num_columns, "horizontal")
+        for row in range(num_rows):
+            first = row * num_columns + 1
+            halve(first, min(num_columns, num_panes - first + 1), 1, "vertical")
+
+    # Raise an exception if we don't recognise the layout setting.
+    else:
+        raise ValueError("Unknown layout setting.")
+
+    return remember(key, tuple(plan))
+
+
+def split_geometry(geometry, parent, child, split):
+    """ Update geometry (see plan_geometry) for one split.
+    """
+
+    x, y, w, h = geometry[parent]
+    if split == 'vertical':
+        geometry[parent] = (x, y, w / 2, h)
+        geometry[child] = (x + w / 2, y, w / 2, h)
+    else:
+        geometry[parent] = (x, y, w, h / 2)
+        geometry[child] = (x, y + h / 2, w, h / 2)
+
+
+def plan_geometry(plan):
+    """ Where each pane of a plan ends up, as (left, top, width, height)
+        fractions of the window, assuming each split halves the pane.
+    """
+
+    geometry = {1: (0.0, 0.0, 1.0, 1.0)}
+    for parent, child, split in plan:
+        split_geometry(geometry, parent, child, split)
+
+    return geometry
+
+
+def neighbour(geometry, pane, direction):
+    """ The pane Cmd-Opt-<arrow> moves to from pane, or None if that isn't
+        certain: there must be exactly one pane alongside it in that
+        direction, as which one iTerm picks otherwise depends on where
+        the cursor is.
+    """
+
+    x, y, w, h = geometry[pane]
+    found = None
+    for other, (ox, oy, ow, oh) in geometry.items():
+        if direction in ('left', 'right'):
+            edge = ox + ow == x if direction == 'left' else ox == x + w
+            touching = edge and oy < y + h and y < oy + oh
+        else:
+            edge = oy + oh == y if direction == 'up' else oy == y + h
+            touching = edge and ox < x + w and x < ox + ow
+        if touching:
+            if found is not None:
+                return None
+            found = other
+
+    return found
+
+
+class KeystrokePlanner(object):
+    """ Work out the fewest keystrokes to drive old iTerm through a layout
+        plan (see layout_plan). Focus can be moved to the next or previous
+        pane, in the order panes are numbered (Cmd-] and Cmd-[), or to the
+        pane alongside in any direction (Cmd-Opt-<arrow>), and we search
+        for the shortest way to each pane that needs splitting, then to
+        the pane to leave focused.
+
+        The keystrokes, how many there are, and roughly how long they'll
+        take, can all be checked without iTerm.
+    """
+
+    # Key codes for the arrow keys
+    arrows = {'left': 123, 'right': 124, 'down': 125, 'up': 126}
+
+    # Roughly how long System Events takes to send iTerm a keystroke.
+    keystroke_seconds = 0.05
+
+    def __init__(self, plan):
+
+        self.plan = plan
+        self.order = [1]
+        self.geometry = {1: (0.0, 0.0, 1.0, 1.0)}
+        self.focus = 1
+        self.keystrokes = []
+
+    def moves(self, pane):
+        """ The panes one keystroke away from pane, with the keystroke.
+        """
+
+        position = self.order.index(pane)
+        yield Keystroke(']'), self.order[(position + 1) % len(self.order)]
+        yield Keystroke('['), self.order[position - 1]
+        for direction, key_code in sorted(self.arrows.items()):
+            other = neighbour(self.geometry, pane, direction)
+            if other is not None:
+                yield Keystroke(key_code=key_code, modifiers=('command', 'option')), other
+
+    def move_to(self, pane):
+        """ Move focus to pane by the shortest route. Of equally short
+            routes, we take the one with fewest Cmd-Opt-<arrow>s, as
+            Cmd-] and Cmd-[ depend least on how iTerm sized the panes.
+        """
+
+        import heapq
+        import itertools
+
+        # Routes found first break any remaining ties.
+        pushed = itertools.count(1)
+        done = set()
+        queue = [(0, 0, 0, self.focus, [])]
+        while True:
+            length, arrows, _, current, route = heapq.heappop(queue)
+            if current == pane:
+                break
+            if current in done:
+                continue
+            done.add(current)
+            for keystroke, other in self.moves(current):
+                if other not in done:
+                    heapq.heappush(queue, (length + 1, arrows + (keystroke.key is None),
+                                           next(pushed), other, route + [keystroke]))
+
+        self.keystrokes.extend(route)
+        self.focus = pane
+
+    def arrange(self, focus=1):
+        """ Split the panes as planned, then move focus to the given pane.
+            Returns the keystrokes.
+        """
+
+        for parent, child, split in self.plan:
+            self.move_to(parent)
+            self.keystrokes.append(Keystroke('d' if split == 'vertical' else 'D'))
+            self.order.insert(self.order.index(parent) + 1, child)
+            split_geometry(self.geometry, parent, child, split)
+            self.focus = child
+
+        self.move_to(focus)
+        return self.keystrokes
+
+    def navigate(self, start, pane):
+        """ The keystrokes to move focus from start to pane, once the
+            layout is finished.
+        """
+
+        self.order = list(range(1, len(self.plan) + 2))
+        self.geometry = plan_geometry(self.plan)
+        self.focus = start
+        self.keystrokes = []
+        self.move_to(pane)
+        return self.keystrokes
+
+    @classmethod
+    def estimate(cls, nodes):
+        """ Return how many keystrokes the nodes send and roughly how many
+            seconds they take, including any delays.
+        """
+
+        count = len([n for n in nodes if isinstance(n, Keystroke)])
+        delays = sum(n.seconds for n in nodes if isinstance(n, Delay))
+        return count, count * cls.keystroke_seconds + delays
+
+
+def check_plan(plan, num_panes):
+    """ Check a layout plan makes sense: each split is of a pane that
+        already exists, in a known direction, creating a new pane; there
+        are num_panes panes at the end; and they end up in the order they
+        are numbered. Raises ValueError if not.
+    """
+
+    order = [1]
+    for parent, child, split in plan:
+        if split not in ('vertical', 'horizontal'):
+            raise ValueError("pane_%s is split in an unknown direction, %r" % (parent, split))
+        if parent not in order:
+            raise ValueError("pane_%s is split before it exists" % parent)
+        if child in order:
+            raise ValueError("pane_%s is created twice" % child)
+        order.insert(order.index(parent) + 1, child)
+
+    if len(order) != max(num_panes, 1):
+        raise ValueError("plan makes %d panes, not %d" % (len(order), num_panes))
+    if order != sorted(order) or order != list(range(1, len(order) + 1)):
+        raise ValueError("panes end up in the order %s" % order)
+
+
+class ScriptCache(object):
+    """ A content addressed, least-recently-used cache of generated
+        Applescripts, and their osacompile'd versions, so that launching
+        an unchanged layout doesn't need to parse YAML, rebuild the script
+        or have osascript compile it from source.
+    """
+
+    # Total size (in bytes) the cache is allowed to grow to before the
+    # least recently used entries are evicted.
+    max_size = 20 * 1024 * 1024
+
+    def __init__(self, path=None, max_size=None):
+
+        self.path = path or os.path.join(cache_dir(), 'scripts')
+        if max_size is not None:
+            self.max_size = max_size
+        elif os.getenv('ITERMOCIL_CACHE_SIZE'):
+            self.max_size = int(os.getenv('ITERMOCIL_CACHE_SIZE'))
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def generator():
+        """ A hash of itermocil's own source, so a script generated by one
+            version of it (even one with the same __version__) is never
+            used by another.
+        """
+
+        key = ('generator', __file__)
+        if key not in _memo:
+            import hashlib
+            with open(__file__, 'rb') as f:
+                remember(key, hashlib.sha1(f.read()).hexdigest())
+
+        return _memo[key]
+
+    @classmethod
+    def key(cls, filepaths, here, cwd, major_version, split_cwd=False, source_commands=False):
+        """ Hash everything that affects the generated script: the content
+            of the layout files and where they are (which layout_id, and
+            so the panes' tags and startup directories, depend on), the
+            generator, --here (and the directory it applies to), the iTerm
+            major version, --split-cwd and --source-commands.
+        """
+
+        import hashlib
+
+        if not isinstance(filepaths, (list, tuple)):
+            filepaths = [filepaths]
+
+        h = hashlib.sha1()
+        for filepath in filepaths:
+            with open(filepath, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+            h.update(os.path.abspath(filepath).encode('utf-8') + b'\0')
+        h.update(cls.generator().encode('utf-8'))
+        h.update(('\0%s\0%s\0%s\0%s' % (__version__, bool(here),
+                                             cwd if here else '',
+                                             major_version)).encode('utf-8'))
+        if split_cwd:
+            h.update(b'\0split_cwd')
+        if source_commands:
+            h.update(b'\0source_commands')
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Return (script, compiled_path) for a key, or None if we don't
+            have it. compiled_path is None if the script couldn't be
+            compiled. A hit marks the entry as recently used.
+        """
+
+        source = os.path.join(self.path, key + '.applescript')
+        compiled = os.path.join(self.path, key + '.scpt')
+
+        try:
+            with open(source, 'r') as f:
+                script = f.read()
+        except (IOError, OSError):
+            self._count('misses')
+            return None
+
+        os.utime(source, None)
+        if os.path.isfile(compiled):
+            os.utime(compiled, None)
+        else:
+            compiled = None
+
+        self._count('hits')
+        return script, compiled
+
+    def put(self, key, script, timings=None):
+        """ Store a script, and try to compile it with osacompile. Returns
+            the path of the compiled script, or None.
+        """
+
+        source = os.path.join(self.path, key + '.applescript')
+        compiled = os.path.join(self.path, key + '.scpt')
+
+        with open(source, 'w') as f:
+            f.write(script)
+
+        import subprocess
+
+        if timings:
+            timings.spawned(osascript=False)
+
+        try:
+            subprocess.check_call(['osacompile', '-o', compiled, source],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            compiled = None
+
+        self.evict()
+
+        return compiled
+
+    def entries(self):
+        """ Return a list of (last_used, size, paths) for each cached
+            script (its source and compiled files), oldest first.
+        """
+
+        entries = {}
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            if ext not in ('.applescript', '.scpt'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            last_used, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(last_used, st.st_mtime), size + st.st_size, paths + [path])
+
+        return sorted(entries.values())
+
+    def evict(self):
+        """ Remove least recently used scripts until we fit in max_size,
+            always keeping the most recently used one.
+        """
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, paths in entries[:-1]:
+            if total <= self.max_size:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        """ Return a dict describing the cache: entries, size and hit rate.
+        """
+
+        counts = self._read_counts()
+        entries = self.entries()
+        paths = [p for _, _, ps in entries for p in ps]
+
+        return {
+            'path': self.path,
+            'entries': len(entries),
+            'compiled': len([p for p in paths if p.endswith('.scpt')]),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size,
+            'hits': counts.get('hits', 0),
+            'misses': counts.get('misses', 0),
+        }
+
+    def _read_counts(self):
+
+        import json
+
+        try:
+            with open(os.path.join(self.path, 'stats.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _count(self, what):
+
+        import json
+        import tempfile
+
+        counts = self._read_counts()
+        counts[what] = counts.get(what, 0) + 1
+
+        # Written aside and renamed into place, so that a launch reading
+        # it never sees it half written.
+        try:
+            fd, temp = tempfile.mkstemp(prefix='stats.', suffix='.tmp', dir=self.path)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(counts, f)
+                os.replace(temp, os.path.join(self.path, 'stats.json'))
+            except BaseException:
+                os.remove(temp)
+                raise
+        except (IOError, OSError):
+            pass
+
+
+class CommandFiles(object):
+    """ Content addressed files of pane commands, so that a pane with a
+        long list of commands can be sent a short line sourcing the file
+        instead of having all of them typed into it. Identical command
+        lists, in any pane of any layout, share a file. Files unused for
+        max_age seconds, or beyond max_size in total, are removed, least
+        recently used first.
+    """
+
+    max_size = 5 * 1024 * 1024
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, path=None, max_size=None, max_age=None):
+
+        self.path = path or os.path.join(cache_dir(), 'commands')
+        if max_size is not None:
+            self.max_size = max_size
+        if max_age is not None:
+            self.max_age = max_age
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def source_line(self, commands, write=True):
+        """ Return the line to type to run commands (a list) from a file,
+            writing the file if it doesn't exist yet (unless write is
+            False). The line starts with a space, which keeps it out of
+            most shells' history.
+        """
+
+        import hashlib
+        import shlex
+
+        text = "\n".join(commands) + "\n"
+        path = os.path.join(self.path, hashlib.sha1(text.encode('utf-8')).hexdigest() + '.sh')
+
+        if not write:
+            pass
+        elif os.path.isfile(path):
+            os.utime(path, None)
+        else:
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.rename(tmp, path)
+
+        return ' source ' + shlex.quote(path)
+
+    def missing(self, script):
+        """ Return the files a script sources which no longer exist (so
+            the script can't be reused), marking the rest as used.
+        """
+
+        missing = []
+        for path in re.findall(r'source \'?(%s/[0-9a-f]{40}\.sh)' % re.escape(self.path), script):
+            try:
+                os.utime(path, None)
+            except OSError:
+                missing.append(path)
+
+        return missing
+
+    def evict(self):
+        """ Remove files unused for max_age, then least recently used
+            files until we fit in max_size.
+        """
+
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for last_used, size, path in entries:
+            if total <= self.max_size and now - last_used <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class PreHooks(object):
+    """ Runs layouts' 'pre' hooks (shell commands to run before their
+        windows are created) from Python, up to max_workers at once,
+        rather than having iTerm run them one by one from the script.
+        Hooks can be started as soon as their layout is parsed, so they
+        run while the script is being generated; wait() blocks until
+        the required ones (and any others to wait for) have finished. The
+        others each run on a daemon thread, which itermocil doesn't wait
+        for when it exits (their commands carry on, but their timeouts and
+        failures go unseen).
+
+        A hook is a command, or a hash of:
+
+          command: ...
+          name: ...        # how it's reported (default: the command)
+          timeout: 30      # seconds before it's killed (default: none)
+          required: false  # don't wait for it, or stop if it fails
+          wait: true       # wait for it anyway (only warning if it fails)
+    """
+
+    max_workers = 4
+
+    def __init__(self, timings=None, max_workers=None):
+
+        self.timings = timings
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.hooks = []
+        self.futures = []
+        self.started = 0
+        self.executor = None
+        self.waited = False
+
+    @staticmethod
+    def parse(pre):
+        """ Return the hooks given by a layout's 'pre' key (a command, or
+            a list of commands or hashes) as a list of hashes.
+        """
+
+        if not pre:
+            return []
+        if not isinstance(pre, list):
+            pre = [pre]
+
+        hooks = []
+        for hook in pre:
+            if not isinstance(hook, dict):
+                hook = {'command': hook}
+            hook = dict(hook)
+            hook['command'] = str(hook['command'])
+            hook.setdefault('name', hook['command'])
+            hook.setdefault('timeout', None)
+            hook.setdefault('required', True)
+            hook.setdefault('wait', hook['required'])
+            hooks.append(hook)
+
+        return hooks
+
+    def add(self, pre, start=False):
+        """ Add the hooks given by a layout's 'pre' key, starting them
+            straight away if start is True.
+        """
+
+        self.hooks.extend(self.parse(pre))
+        if start:
+            self.start()
+
+    def start(self):
+        """ Start any hooks not yet started.
+        """
+
+        if self.started == len(self.hooks):
+            return
+
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        # The executor's threads are joined at exit, even after
+        # shutdown(wait=False), so only the hooks waited for go on it.
+        for hook in self.hooks[self.started:]:
+            if hook['required'] or hook['wait']:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self.futures.append(self.executor.submit(self.run, hook))
+            else:
+                threading.Thread(target=lambda hook=hook: self.report(*self.run(hook)),
+                                 daemon=True).start()
+        self.started = len(self.hooks)
+
+    def run(self, hook):
+        """ Run a hook, returning (hook, seconds, error), where error is
+            None if it succeeded.
+        """
+
+        import signal
+        import subprocess
+
+        start = time.time()
+        if self.timings:
+            self.timings.spawned(osascript=False)
+
+        # In its own process group, so a timeout kills everything it ran.
+        proc = subprocess.Popen(hook['command'], shell=True, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        try:
+            _, errors = proc.communicate(timeout=hook['timeout'])
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            error = 'timed out after %gs' % hook['timeout']
+        else:
+            error = None
+            if proc.returncode:
+                error = (errors.decode('utf-8', 'replace').strip() or
+                         'exited with status %d' % proc.returncode)
+
+        seconds = time.time() - start
+        if self.timings:
+            self.timings.record_hook(hook['name'], seconds, error)
+
+        return hook, seconds, error
+
+    @staticmethod
+    def report(hook, seconds, error):
+        """ Warn about a hook (that wasn't required) failing.
+        """
+
+        if error:
+            sys.stderr.write("itermocil: pre hook '%s' failed: %s\n" % (hook['name'], error))
+
+    def wait(self):
+        """ Run any hooks not yet started, and wait for the ones to wait
+            for to finish. Exits if any required ones failed.
+        """
+
+        if self.waited:
+            return
+        self.waited = True
+        self.start()
+
+        failed = False
+        for future in self.futures:
+            hook, seconds, error = future.result()
+            if error and not hook['required']:
+                self.report(hook, seconds, error)
+            elif error:
+                failed = True
+                print("ERROR: pre hook '%s' failed: %s" % (hook['name'], error))
+
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if failed:
+            sys.exit(1)
+
+
+class SshHosts(object):
+    """ Shares one ssh connection to each host between all the panes of
+        a layout with a 'host' (their own, or their window's), using
+        OpenSSH's connection multiplexing: a pre hook opens a master
+        connection to each host before any pane starts, and the panes'
+        ssh commands go through its socket rather than each making a
+        connection of their own. The hook can't answer prompts, so if it
+        can't connect (a host needing a password, or an unknown host key)
+        the launch carries on without it, and each pane's ssh connects
+        (and asks) for itself. Settings come from the layout's 'ssh':
+
+          control_dir: ~/.ssh/sockets  # where sockets go (default: the cache directory)
+          persist: 600                 # seconds a master stays open once unused
+          timeout: 30                  # seconds to wait for a master to connect
+    """
+
+    persist = 600
+    timeout = 30
+
+    def __init__(self, config):
+
+        settings = config.get('ssh') or {}
+        self.persist = settings.get('persist', self.persist)
+        self.timeout = settings.get('timeout', self.timeout)
+        self.control_dir = settings.get('control_dir')
+        self.hosts = self.hosts_of(config)
+
+        # Only pick a default (creating the cache directory) if needed.
+        if self.hosts:
+            self.control_dir = os.path.expanduser(self.control_dir or
+                                                  os.path.join(cache_dir(), 'ssh'))
+
+    @staticmethod
+    def host_of(window, pane=None):
+        """ The host a pane's commands run on, or None if it's local.
+            A pane with an empty 'host' is local, whatever its window's.
+        """
+
+        if isinstance(pane, dict) and 'host' in pane:
+            return pane['host'] or None
+        return window.get('host') or None
+
+    @classmethod
+    def hosts_of(cls, config):
+        """ Every host the panes of a layout use.
+        """
+
+        hosts = set()
+        for window in config.get('windows') or []:
+            for pane in window.get('panes') or [None]:
+                host = cls.host_of(window, pane)
+                if host:
+                    hosts.add(host)
+
+        return sorted(hosts)
+
+    def control_path(self, host):
+        """ The socket for a host's master connection. It's named by a
+            hash, so it's safe for any host and short enough for a Unix
+            socket path.
+        """
+
+        import hashlib
+
+        return os.path.join(self.control_dir, hashlib.sha1(host.encode('utf-8')).hexdigest()[:16])
+
+    def options(self, host):
+        """ ssh's options to use (or, if there isn't one, become) the
+            master connection to a host. With no master to use, ssh just
+            connects as usual.
+        """
+
+        return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + self.control_path(host),
+                '-o', 'ControlPersist=%s' % self.persist]
+
+    def command(self, host, commands):
+        """ The line to type to run commands on a host, leaving the pane
+            in a login shell there.
+        """
+
+        import shlex
+
+        remote = '; '.join(list(commands) + ['exec "$SHELL" -l'])
+        return ' '.join(shlex.quote(arg) for arg in ['ssh', '-t'] + self.options(host)
+                        + [host, remote])
+
+    def master_hooks(self):
+        """ Pre hooks (see PreHooks) opening a master connection to each
+            host. Each runs 'true' on its host, after which the master
+            stays in the background for the panes to use (or, if one is
+            already open, just checks it works). They're waited for, but
+            aren't required: one failing only costs its host's panes the
+            shared connection.
+        """
+
+        import shlex
+
+        hooks = []
+        for host in self.hosts:
+            args = (['ssh'] + self.options(host) + ['-o', 'ConnectTimeout=%s' % self.timeout,
+                                                    '-o', 'BatchMode=yes', host, 'true'])
+            hooks.append({
+                'command': 'mkdir -p %s && %s' % (shlex.quote(self.control_dir),
+                                                  ' '.join(shlex.quote(arg) for arg in args)),
+                'name': 'ssh ' + host,
+                'timeout': self.timeout + 5,
+                'required': False,
+                'wait': True,
+            })
+
+        return hooks
+
+
+def layout_hooks(config):
+    """ A layout's pre hooks (see PreHooks): its own, and the ones that
+        connect to the hosts its panes use (see SshHosts).
+    """
+
+    return PreHooks.parse(config.get('pre')) + SshHosts(config).master_hooks()
+
+
+# Run (with sh) by panes with 'startup' settings or dependencies before
+# their commands.
+#
+# 'start' waits for the pane's turn to start. Panes take turns in order
+# (of rank), 'stagger' seconds apart, and each holds one of 'max' slots
+# (directories made with mkdir, which is atomic) for 'warmup' seconds
+# after it starts.
+#
+# 'wait' waits for a pane it depends on to be ready: for a file (which
+# may be the marker 'started' leaves) to exist, a log file to match a
+# pattern, or a port to accept connections. Only lines written to the
+# log since the launch started count, which 'mark' (run as it starts)
+# notes the size of the log at.
+#
+# Nothing waits more than its timeout, so a pane that never starts or
+# becomes ready can't hold the others up for ever.
+STARTUP_HELPER = r"""#!/bin/sh
+case $1 in
+start|wait) tries=$(awk "BEGIN { print int($2 / 0.1) }") ;;
+esac
+
+ready() {
+    case $1 in
+    file) [ -e "$2" ] ;;
+    log)
+        # only what was written since 'mark' noted the log's size (or
+        # all of it, if it has been truncated since)
+        [ -f "$2" ] || return 1
+        size=$(($(wc -c < "$2"))) offset=$(($(cat "$4" 2>/dev/null)))
+        [ "$size" -ge "$offset" ] || offset=0
+        tail -c +$((offset + 1)) "$2" | grep -Eq -- "$3" ;;
+    port) perl -MIO::Socket::INET -e 'exit !IO::Socket::INET->new(PeerAddr => $ARGV[0], Timeout => 1)' "$2" ;;
+    esac
+}
+
+case $1 in
+start)
+    # start TIMEOUT DIR RANK MAX STAGGER WARMUP
+    dir=$3 rank=$4 max=$5 stagger=$6 warmup=$7
+
+    if [ "$rank" -gt 0 ]; then
+        n=0
+        while [ ! -e "$dir/started.$((rank - 1))" ] && [ "$n" -lt "$tries" ]; do
+            sleep 0.1; n=$((n + 1))
+        done
+        sleep "$stagger"
+    fi
+
+    n=0
+    while [ "$max" -gt 0 ] && [ "$n" -lt "$tries" ]; do
+        i=0
+        while [ "$i" -lt "$max" ]; do
+            if mkdir "$dir/slot.$i" 2>/dev/null; then
+                (sleep "$warmup"; rmdir "$dir/slot.$i") >/dev/null 2>&1 &
+                touch "$dir/started.$rank"
+                exit 0
+            fi
+            i=$((i + 1))
+        done
+        sleep 0.1; n=$((n + 1))
+    done
+    touch "$dir/started.$rank"
+    ;;
+wait)
+    # wait TIMEOUT NAME file PATH | log PATH PATTERN SIZEFILE | port HOST:PORT
+    name=$3
+    shift 3
+    n=0
+    until ready "$@"; do
+        if [ "$n" -ge "$tries" ]; then
+            echo "itermocil: gave up waiting for $name" >&2
+            exit 1
+        fi
+        sleep 0.1; n=$((n + 1))
+    done
+    ;;
+mark)
+    # mark PATH SIZEFILE
+    if [ -f "$2" ]; then wc -c < "$2"; else echo 0; fi > "$3"
+    ;;
+esac
+"""
+
+
+def helper_path(name, content):
+    """ Write a helper script to the cache directory, named after its
+        content so that different versions of itermocil can't clash, and
+        return its path.
+    """
+
+    import hashlib
+
+    directory = os.path.join(cache_dir(), 'bin')
+    path = os.path.join(directory, '%s-%s.sh' % (
+        name, hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]))
+
+    if not os.path.isfile(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+    return path
+
+
 class Itermocil(object):
     """ Read the teamocil file and build an Applescript that will configure
         iTerm into the correct layout. Uses an Applescript to establish
@@ -18,20 +1664,77 @@ class Itermocil(object):
         Applescript based upon that.
     """
 
-    def __init__(self, teamocil_file, here=False, cwd=None):
+    # Functions called with (phase, seconds) as each phase of every launch
+    # finishes, so wrappers can collect timings.
+    timing_hooks = []
+
+    def __init__(self, teamocil_file, here=False, cwd=None, iterm_version=None,
+                 use_cache=True, timings=None, trace=False, parallel=None,
+                 wait_timeout=10.0, poll_interval=0.1, split_cwd=False,
+                 source_commands=False, pre_hooks=None, reconcile=False):
         """ Establish iTerm version, and initialise the list which
             will contain all the Applescript commands to execute.
+
+            teamocil_file may be a list of files, in which case all of
+            their windows are built by the one script. --here only applies
+            to the first of them.
+
+            If iterm_version is given (or $ITERMOCIL_ITERM_VERSION is set)
+            it is used instead of asking iTerm, which means no osascript
+            needs to be run in order to generate the script.
+
+            use_cache=False stops the parsed teamocil file being read from,
+            or saved to, the cache directory.
+
+            How long each phase takes is recorded in self.timings (which
+            can be passed in, to carry on timing a launch already begun).
+
+            trace=True instruments the script so that it outputs a
+            timestamp after each step it takes in iTerm (see parse_trace).
+
+            parallel=N (new iTerm only) builds a separate script for each
+            window, which execute() runs up to N at a time once a first
+            script has created all the tabs.
+
+            Old iTerm is driven by keystrokes, which take a moment to have
+            an effect. The script waits for each new tab and split to
+            appear, polling every poll_interval seconds for up to
+            wait_timeout seconds. wait_timeout=None waits a fixed time
+            instead, as older versions of iTermocil did.
+
+            split_cwd=True (new iTerm only) starts each new session in its
+            pane's root directory, with its environment, rather than
+            typing 'cd' (and 'export') into it.
+
+            source_commands=True writes each pane's commands to a file
+            (see CommandFiles) and has the pane source it, if that's less
+            to type.
+
+            Layouts' 'pre' hooks are run (see PreHooks) before execute()
+            runs the script. pre_hooks can be a PreHooks holding them,
+            which is started once the layouts have been checked, so they
+            run while the script is generated.
+
+            reconcile=True (iTerm 3.3+) asks iTerm which of the layouts'
+            panes are still open (tagged by an earlier reconcile launch),
+            and only creates the windows and panes that aren't.
         """
 
+        self.iterm_version = iterm_version
+        self.timings = timings or Timings()
+        self.timings.hooks.extend(h for h in self.timing_hooks if h not in self.timings.hooks)
+
         # Check whether we are old or new iTerm (pre/post 2.9)
-        major_version = self.get_major_version()
+        with self.timings.phase('version'):
+            version_string = self.get_version_string()
+        major_version = self.get_major_version(version_string)
         self.new_iterm = True
 
         if tuple(int(n) for n in str(major_version).split(".")) < (2, 9):
             self.new_iterm = False
         else:
             # Temporary check to check for unsupported version of iTerm beta
-            v = self.get_version_string().decode('utf-8')
+            v = version_string.decode('utf-8')
             bits = v.split('.')
             if len(bits) > 2 and '-nightly' in str(major_version):
                 build = bits[2].replace('-nightly', '')
@@ -42,564 +1745,1703 @@ class Itermocil(object):
                     sys.exit(1)
 
         # Initiate from arguments
-        self.file = teamocil_file
+        if isinstance(teamocil_file, (list, tuple)):
+            self.files = list(teamocil_file)
+        else:
+            self.files = [teamocil_file]
+        self.file = self.files[0]
         self.here = here
         self.cwd = cwd
+        self.trace = trace
+        self.reconcile = reconcile
+        self.parallel = parallel if (parallel and self.new_iterm and not trace
+                                     and not reconcile) else None
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.split_cwd = split_cwd and self.new_iterm
+        self.command_files = CommandFiles() if source_commands else None
+
+        # Shell commands the script runs (with 'do shell script') before
+        # setting up any windows, in order.
+        self.shell_commands = []
+
+        # If we weren't given the layouts' pre hooks to start, we collect
+        # them to run when the script is executed.
+        self.pre_hooks = pre_hooks
+        collect_hooks = pre_hooks is None
+        if collect_hooks:
+            self.pre_hooks = PreHooks(self.timings)
+
+        # In parallel mode, the node lists for each window's own script,
+        # and the command (see start_command) each window's tab starts.
+        self.window_scripts = []
+        self.window_commands = []
+
+        # With reconcile, the sessions still open, by tag.
+        self.live = {}
+        if self.reconcile:
+            if major_version < 3.3:
+                print("ERROR: --reconcile needs iTerm 3.3 or later")
+                sys.exit(1)
+            with self.timings.phase('reconcile'):
+                self.live = live_sessions(self.timings)
 
         # Open up the file and parse it with PyYaml
-        with open(self.file, 'r') as f:
-            self.parsed_config = yaml.load(f, Loader=yaml.Loader)
+        with self.timings.phase('parse'):
+            self.parsed_configs = [load_config(f, use_cache) for f in self.files]
+        self.check_layouts()
+        self.parsed_config = self.parsed_configs[0]
 
-        # This will be where we build up the script.
-        self.applescript = []
-        self.applescript.append('tell application "iTerm"')
-        self.applescript.append('activate')
-
-        if 'pre' in self.parsed_config:
-            self.applescript.append('do shell script "' + self.parsed_config['pre'] + ';"')
-
-        # If we need to open a new window, then add necessary commands
-        # to script.
-        if not self.here:
-            if self.new_iterm:
-                self.applescript.append('tell current window')
-                self.applescript.append('create tab with default profile')
-                self.applescript.append('end tell')
-                # self.applescript.append('create window with default profile')
-            else:
-                self.applescript.append('delay 0.3')
-                self.applescript.append('tell i term application "System Events" ' +
-                                        'to keystroke "t" using command down')
-                self.applescript.append('delay 0.3')
+        if not collect_hooks:
+            self.pre_hooks.start()
 
-        # Process the file, building the script.
-        self.process_file()
+        # This will be where we build up the script: the nodes (see
+        # Statement and Tell) to send to iTerm.
+        self.applescript = []
+        self.applescript.append(Statement('activate'))
+        self.trace_point('start')
+        if self.parallel:
+            self.applescript.append(Statement('set itermocil_ids to ""'))
 
-        # Finish the script
-        self.applescript.append('end tell')
+        # total_pane_count is only used for old iTerm, and is needed to
+        # reference panes created in later windows (and to know how many
+        # sessions to wait for)
+        self.total_pane_count = None
+        if not self.new_iterm:
+            with self.timings.phase('count_panes'):
+                self.total_pane_count = int(self.get_num_panes_in_current_window())
+            if self.here:
+                self.total_pane_count -= 1
+
+        for num, (f, parsed_config) in enumerate(zip(self.files, self.parsed_configs)):
+            self.file = f
+            self.parsed_config = parsed_config
+            first_here = self.here and num == 0
+
+            if collect_hooks:
+                self.pre_hooks.add(layout_hooks(self.parsed_config))
+            self.ssh = SshHosts(self.parsed_config)
+
+            # Panes with startup settings take turns, and panes with
+            # dependencies wait for them, keeping track of it all in
+            # directories that need to start empty every launch.
+            startup_lines, startup_dirs, markers = self.plan_startup()
+            waits, started, ready_dir, ready_markers, log_marks = self.plan_dependencies()
+            if ready_dir:
+                startup_dirs.append(ready_dir)
+            self.startup_lines = {}
+            for key in set(startup_lines) | set(waits) | set(started):
+                self.startup_lines[key] = (waits.get(key, []) + startup_lines.get(key, [])
+                                           + started.get(key, []))
+            if startup_dirs:
+                import shlex
+                dirs = ' '.join(shlex.quote(d) for d in startup_dirs)
+                reset = 'rm -rf %s && mkdir -p %s' % (dirs, dirs)
+                # Panes still open from last time have started (and are
+                # ready), which the new ones may be waiting to see, so
+                # only the markers of the panes being made again go.
+                if self.reconcile:
+                    reset = 'mkdir -p %s' % dirs
+                    windows = self.parsed_config.get('windows') or [{}]
+                    stale = []
+                    for key in sorted(set(markers) | set(ready_markers)):
+                        if key[1] not in self.live_panes(key[0], windows[key[0]]):
+                            stale.extend(markers.get(key, []) + ready_markers.get(key, []))
+                    if stale:
+                        reset += ' && rm -f ' + ' '.join(shlex.quote(m) for m in stale)
+                # Logs count from where they are now, except those of
+                # panes still open from last time, which may have said
+                # they're ready already.
+                for key in sorted(log_marks):
+                    if not self.reconcile or key[1] not in self.live_panes(key[0], windows[key[0]]):
+                        reset += ' && ' + ' && '.join(log_marks[key])
+                self.applescript.append(Statement('do shell script "%s"' % quote(reset)))
+                self.shell_commands.append(reset)
+
+            # If we need to open a new window, then add necessary commands
+            # to script.
+            windows = self.parsed_config.get('windows') or [{}]
+            if not first_here and not self.live_panes(0, windows[0]):
+                self.new_tab(self.total_pane_count, self.start_command(windows[0], 1, first_here))
+                self.trace_point('create tab for window 1 of ' + os.path.basename(f))
+
+            # Process the file, building the script.
+            with self.timings.phase('generate'):
+                self.process_file(here=first_here)
+
+        self.file = self.files[0]
+        self.parsed_config = self.parsed_configs[0]
+
+        if self.command_files:
+            self.command_files.evict()
+
+        if self.parallel:
+            self.applescript.append(Statement('return itermocil_ids'))
 
     def get_version_string(self):
         """ Get version of iTerm. 'iTerm2' (iTerm 2.9+) has much improved
             Applescript support and options, so is more robust.
         """
 
-        osa = subprocess.Popen(['osascript', '-'],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
+        return iterm_version_string(self.iterm_version, self.timings)
+
+    def get_major_version(self, v=None):
+        """ Get version of iTerm. 'iTerm2' (iTerm 2.9+) has much improved
+            Applescript support and options, so is more robust.
+        """
+
+        if v is None:
+            v = self.get_version_string()
+
+        return major_version_of(v)
+
+    def get_num_panes_in_current_window(self):
+        """ Get the number of panes already existing in the current window.
+            This is used only for old iTerm.
+        """
+
+        panes_script = """ tell application "iTerm"
+                               count sessions of current terminal
+                           end tell
+                       """
+        num = osascript(panes_script, timings=self.timings)
+
+        return num.strip()
+
+    def execute(self):
+        """ Execute the Applescript built by parsing the teamocil file.
+        """
+
+        if self.parallel:
+            return self.execute_parallel()
+
+        script = self.script()
+        self.wait_for_hooks()
+
+        with self.timings.phase('execute'):
+            return osascript(script, timings=self.timings)
+
+    def wait_for_hooks(self):
+        """ Wait for the layouts' required pre hooks to finish (running
+            them first, if they haven't been started).
+        """
+
+        with self.timings.phase('pre_hooks'):
+            self.pre_hooks.wait()
+
+    def execute_parallel(self):
+        """ Create all the tabs with one script, then set up each window
+            with its own script, running up to self.parallel of them at
+            once. Returns a list with a result for each window, in order:
+            (window number, exit status, output, errors).
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.wait_for_hooks()
+        with self.timings.phase('execute_tabs'):
+            session_ids = osascript(self.script(), timings=self.timings)
+        session_ids = session_ids.decode('utf-8').split()
+
+        if len(session_ids) != len(self.window_scripts):
+            return [(num, 1, b'', b'Expected a tab for each window, but iTerm gave us '
+                     + str(len(session_ids)).encode('utf-8'))
+                    for num in range(1, len(self.window_scripts) + 1)]
+
+        def run(num):
+            script = self.window_script(num, session_ids[num - 1])
+            return (num,) + osascript_result(script, self.timings)
+
+        with self.timings.phase('execute_windows'):
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                return list(pool.map(run, range(1, len(self.window_scripts) + 1)))
+
+    def window_script(self, num, session_id=None, pretty=False):
+        """ Return the script which sets up window num (counting from 1)
+            in parallel mode, in the tab with the given session id.
+        """
+
+        if session_id is None:
+            session_id = 'session id of window %d' % num
+
+        nodes = [Tell('application "iTerm"',
+                      [Statement('set session_id to "%s"' % quote(session_id))]
+                      + self.window_scripts[num - 1])]
+        validate(nodes)
+
+        return emit(nodes, compact=not pretty)
+
+    def trace_point(self, label):
+        """ When tracing, add a step to the script that records the time
+            along with a label for whatever was just done.
+        """
+
+        if not self.trace:
+            return
+
+        # 'tab' would mean an iTerm tab here, so use the character itself.
+        step = ('set itermocil_trace to itermocil_trace & "{label}" & '
+                '(character id 9) & ({timestamp}) & linefeed')
+        self.applescript.append(Statement(step.format(label=label.replace('"', "'"),
+                                                      timestamp=TRACE_TIMESTAMP)))
+
+    def nodes(self):
+        """ Return the whole script as a list of nodes, wrapping what we
+            have built in a tell to iTerm.
+        """
+
+        nodes = []
+        if self.trace:
+            nodes.extend(Statement(line) for line in TRACE_START)
+            nodes.append(Statement('set itermocil_trace to ""'))
+        nodes.append(Tell('application "iTerm"', self.applescript))
+        if self.trace:
+            nodes.append(Statement('return itermocil_trace'))
+
+        return nodes
+
+    def script(self, pretty=False):
+        """ Return the Applescript we have built (so far), compact for
+            running, or pretty for debugging purposes. The script is
+            validated first, so we don't run anything broken.
+        """
+
+        nodes = self.nodes()
+        validate(nodes)
+
+        return emit(nodes, compact=not pretty)
+
+    def new_tab(self, sessions=None, command=None):
+        """ Open a new tab in the current window. For old iTerm, sessions
+            is how many sessions the window had before, so we can wait
+            for the tab to appear. For new iTerm, the tab's session can
+            be started with a command (see start_command).
+        """
+
+        if self.new_iterm:
+            create = 'create tab with default profile'
+            if command:
+                create += ' command "%s"' % quote(command)
+            self.applescript.append(Tell('current window', [Statement(create)]))
+            # self.applescript.append(Tell('current window', [Statement('create window with default profile')]))
+        elif self.wait_timeout and sessions is not None:
+            self.applescript.append(Keystroke('t'))
+            self.applescript.append(WaitForSessions(sessions + 1, self.wait_timeout,
+                                                    self.poll_interval))
+        else:
+            self.applescript.append(Delay(0.3))
+            self.applescript.append(Keystroke('t'))
+            self.applescript.append(Delay(0.3))
+
+    def arrange_panes(self, num_panes, layout="tiled", columns=None, rows=None, commands=None):
+        """ Create a set of Applescript instructions to generate the desired
+            layout of panes, splitting each pane into a named variable as
+            the layout's plan (see layout_plan) says. commands, if given,
+            are the commands to start each pane's session with (see
+            start_command), by pane number.
+
+            See 'arrange_panes_old_iterm' for an alternate version for
+            generating a version for old iTerm.
+        """
+
+        # Link a variable to the current window (which in parallel mode
+        # is found by its session id instead).
+        if self.parallel:
+            self.applescript.append(FindSession(1))
+        else:
+            self.applescript.append(CurrentSession(1))
+
+        for parent, child, split in layout_plan(layout, num_panes, columns, rows):
+            self.applescript.append(Split(parent, child, split, (commands or {}).get(child)))
+            self.trace_point('split pane_%s %sly from pane_%s' % (child, split, parent))
+
+    def arrange_missing_panes(self, num_panes, live, layout="tiled", columns=None, rows=None,
+                              commands=None):
+        """ Like arrange_panes, but for a window some of whose panes (in
+            live, by pane number) are still open: find those, and split
+            just the missing ones from their parents. If the first pane
+            has gone, it's split from the first one left, so the layout
+            won't be quite the same.
+        """
+
+        for pane in sorted(live):
+            self.applescript.append(FindSession(pane, live[pane], first=pane == min(live)))
+
+        commands = commands or {}
+        if 1 not in live:
+            self.applescript.append(Split(min(live), 1, 'vertical', commands.get(1)))
+            self.trace_point('split pane_1 verticaly from pane_%s' % min(live))
+
+        for parent, child, split in layout_plan(layout, num_panes, columns, rows):
+            if child not in live:
+                self.applescript.append(Split(parent, child, split, commands.get(child)))
+                self.trace_point('split pane_%s %sly from pane_%s' % (child, split, parent))
+
+    def arrange_panes_old_iterm(self, num_panes, layout="tiled", columns=None, rows=None,
+                                sessions=None):
+        """ Create a set of Applescript instructions to generate the desired
+            layout of panes, following the same plan as 'arrange_panes' but
+            with keystrokes: Cmd-d and Cmd-Shift-d split the focused pane,
+            and KeystrokePlanner finds the fewest keystrokes to move focus
+            to each pane that needs splitting. Focus is left on the first
+            pane, which 'focus_on_pane' relies on.
+
+            sessions is how many sessions the window had before, so we can
+            wait for all the new ones to appear.
+        """
+
+        # If we have just one pane we don't need to do any splitting.
+        if num_panes <= 1:
+            return
+
+        plan = layout_plan(layout, num_panes, columns, rows)
+        self.applescript.extend(KeystrokePlanner(plan).arrange())
+
+        # This is all keystroke based and thus takes a moment to happen,
+        # so unfortunately (for old iTerm) we have to wait for the panes
+        # to appear, or failing that a moment for it all to happen.
+        if self.wait_timeout and sessions is not None:
+            self.applescript.append(WaitForSessions(sessions + num_panes - 1, self.wait_timeout,
+                                                    self.poll_interval))
+        else:
+            self.applescript.append(Delay(2))
+        self.trace_point('arrange %d panes (%s)' % (num_panes, layout))
+
+    def pane_root(self, window, pane=None, here=False):
+        """ The directory a pane starts in: its own 'root', or its window's,
+            or with --here and an empty root, the current directory. None
+            if there isn't one.
+        """
+
+        if isinstance(pane, dict) and pane.get('root'):
+            return pane['root']
+        if window.get('root'):
+            return window['root']
+        if 'root' in window and here:
+            return self.cwd
+        return None
+
+    def pane_env(self, window, pane=None):
+        """ The environment variables a pane's commands run with: its
+            window's 'env', updated with its own.
+        """
+
+        env = dict(window.get('env') or {})
+        if isinstance(pane, dict):
+            env.update(pane.get('env') or {})
+        return env
+
+    def start_command(self, window, pane_num, here=False):
+        """ With split_cwd, the command to start pane number pane_num of
+            window with: a login shell, in the pane's root directory and
+            with its environment. None if there's nothing to set, or we
+            aren't using split_cwd.
+        """
+
+        panes = window.get('panes')
+        if not self.split_cwd or not panes:
+            return None
+
+        import shlex
+
+        pane = panes[pane_num - 1]
+        # Panes on other hosts go to their root (and set their env) there.
+        if SshHosts.host_of(window, pane):
+            return None
+
+        root = self.pane_root(window, pane, here)
+        env = self.pane_env(window, pane)
+        if root is None and not env:
+            return None
+
+        args = []
+        if env:
+            args = ['/usr/bin/env'] + ['%s=%s' % (k, v) for k, v in sorted(env.items())]
+        if root is None:
+            args += ['/bin/sh', '-c', 'exec "$SHELL" -l']
+        else:
+            args += ['/bin/sh', '-c', 'cd "$1" && exec "$SHELL" -l', 'sh', os.path.expanduser(root)]
+
+        return ' '.join(shlex.quote(str(arg)) for arg in args)
+
+    def layout_id(self):
+        """ A short id for the current layout, from its path.
+        """
+
+        import hashlib
+
+        return hashlib.sha1(os.path.abspath(self.file).encode('utf-8')).hexdigest()[:12]
+
+    def pane_tag(self, num, pane_num):
+        """ The tag --reconcile gives a pane's session, to find it again.
+        """
+
+        return '%s/%d/%d' % (self.layout_id(), num + 1, pane_num)
+
+    def live_panes(self, num, window):
+        """ With --reconcile, the panes of the current layout's window num
+            which are still open, as a dict of pane number to session id.
+        """
+
+        if not self.reconcile:
+            return {}
+
+        live = {}
+        for pane_num in range(1, (len(window.get('panes') or []) or 1) + 1):
+            session_id = self.live.get(self.pane_tag(num, pane_num))
+            if session_id:
+                live[pane_num] = session_id
+
+        return live
+
+    def check_layouts(self):
+        """ Check each layout can be launched before anything is done for
+            it, so a mistake in one doesn't leave its pre hooks run and
+            the script half built. Exits if a layout has no windows, or
+            its panes' dependencies are wrong (see dependency_graph), and
+            raises ValueError for unknown layouts.
+        """
+
+        for f, parsed_config in zip(self.files, self.parsed_configs):
+            self.file = f
+            self.parsed_config = parsed_config
+
+            if 'windows' not in parsed_config:
+                print("ERROR: No windows defined in " + f)
+                sys.exit(1)
+
+            for window in parsed_config['windows']:
+                if window.get('panes'):
+                    layout_plan(window['layout'] if 'layout' in window else 'tiled',
+                                len(window['panes']), window.get('columns'), window.get('rows'))
+
+            self.dependency_graph()
+
+    def plan_startup(self):
+        """ Work out how the panes of the current layout take turns to
+            start, from the 'startup' settings of the layout, or of each
+            window (which then has its own turns):
+
+              max_concurrent  how many panes may be starting at once
+              stagger         seconds between one pane starting and the next
+              warmup          seconds a pane counts as starting (default 5)
+              timeout         most seconds to wait for a turn (default 300)
+
+            Panes take turns by their 'priority' (highest first, default
+            0), then in order. Returns the lines each pane runs (keyed by
+            window and pane number) before its commands, the directories
+            the turns are kept track of in, and the marker each pane
+            leaves there once it has started.
+        """
+
+        layout_startup = self.parsed_config.get('startup')
+        groups = {}
+        for num, window in enumerate(self.parsed_config.get('windows') or []):
+            startup = window.get('startup') or layout_startup
+            if not startup or not window.get('panes'):
+                continue
+            scope = 'window-%d' % (num + 1) if window.get('startup') else 'layout'
+            group = groups.setdefault(scope, (startup, []))
+            for pane_num, pane in enumerate(window['panes'], start=1):
+                priority = pane.get('priority', 0) if isinstance(pane, dict) else 0
+                group[1].append((-priority, num, pane_num))
+
+        lines = {}
+        dirs = []
+        markers = {}
+        if not groups:
+            return lines, dirs, markers
+
+        import shlex
+
+        helper = helper_path('startup', STARTUP_HELPER)
+        layout_id = self.layout_id()
+
+        for scope, (startup, panes) in sorted(groups.items()):
+            directory = os.path.join(cache_dir(), 'startup', layout_id, scope)
+            dirs.append(directory)
+            for rank, (_, num, pane_num) in enumerate(sorted(panes)):
+                lines[(num, pane_num)] = [' '.join(shlex.quote(str(arg)) for arg in [
+                    'sh', helper, 'start', startup.get('timeout', 300), directory, rank,
+                    int(startup.get('max_concurrent') or 0),
+                    startup.get('stagger', 0), startup.get('warmup', 5)])]
+                markers[(num, pane_num)] = [os.path.join(directory, 'started.%d' % rank)]
+
+        return lines, dirs, markers
+
+    def dependency_graph(self):
+        """ The named panes of the current layout (name to window, pane
+            number and pane), and the names each pane (keyed by window and
+            pane number) depends on. Exits if a pane depends on one that
+            doesn't exist, or panes depend on each other in a cycle.
+        """
+
+        panes = {}
+        depends = {}
+        for num, window in enumerate(self.parsed_config.get('windows') or []):
+            for pane_num, pane in enumerate(window.get('panes') or [], start=1):
+                if not isinstance(pane, dict):
+                    continue
+                if pane.get('name'):
+                    panes.setdefault(pane['name'], (num, pane_num, pane))
+                if pane.get('depends_on'):
+                    names = pane['depends_on']
+                    depends[(num, pane_num)] = [names] if isinstance(names, str) else list(names)
+
+        for key, names in sorted(depends.items()):
+            for name in names:
+                if name not in panes:
+                    print("ERROR: A pane depends on '%s', but there is no pane of that name in %s"
+                          % (name, self.file))
+                    sys.exit(1)
+
+        def dependencies(name):
+            num, pane_num, _ = panes[name]
+            return iter(depends.get((num, pane_num), []))
+
+        # Check for cycles with a depth first search, visiting each pane
+        # once: a pane is grey while the panes it depends on are being
+        # followed, and black once they all have been. Reaching a grey
+        # pane again means the chain so far is a cycle.
+        colour = {}
+        for start in sorted(panes):
+            if start in colour:
+                continue
+            colour[start] = 'grey'
+            chain, followed = [start], [dependencies(start)]
+            while followed:
+                name = next(followed[-1], None)
+                if name is None:
+                    colour[chain.pop()] = 'black'
+                    followed.pop()
+                elif colour.get(name) == 'grey':
+                    print("ERROR: Panes depend on each other in a cycle: " +
+                          " -> ".join(chain[chain.index(name):] + [name]))
+                    sys.exit(1)
+                elif name not in colour:
+                    colour[name] = 'grey'
+                    chain.append(name)
+                    followed.append(dependencies(name))
+
+        return panes, depends
+
+    def plan_dependencies(self):
+        """ Work out what each pane of the current layout waits for before
+            starting: the panes (by name) in its 'depends_on' to be ready.
+            A pane is ready once its 'ready' probe passes, or if it has
+            none, once it has started:
+
+              ready:
+                port: 5432               # or host:port, accepts connections
+                file: tmp/pids/server.pid  # exists
+                log: log/development.log   # matches the pattern in 'match'
+                match: Listening on
+                timeout: 60              # most seconds to wait (default 60)
+
+            A relative log is in the pane's root (or the home directory,
+            where iTerm starts it without one), and only lines written
+            to it since the launch started count.
+
+            Returns the lines each pane runs (keyed by window and pane
+            number) before starting, and after starting (to say it has),
+            the directory that is kept track of in, the marker each pane
+            leaves there once it has started, and the lines noting how
+            long each pane's log is as the launch starts.
+        """
+
+        panes, depends = self.dependency_graph()
+
+        before, after, markers, marks = {}, {}, {}, {}
+        if not depends:
+            return before, after, None, markers, marks
+
+        import shlex
+
+        helper = helper_path('startup', STARTUP_HELPER)
+        directory = os.path.join(cache_dir(), 'startup', self.layout_id(), 'ready')
+
+        def line(*args):
+            return ' '.join(shlex.quote(str(arg)) for arg in ('sh', helper) + args)
+
+        for key, names in sorted(depends.items()):
+            before[key] = []
+            for name in names:
+                num, pane_num, pane = panes[name]
+                ready = pane.get('ready') or {}
+                timeout = ready.get('timeout', 60)
+                probes = []
+                if ready.get('port'):
+                    port = str(ready['port'])
+                    probes.append(('port', port if ':' in port else 'localhost:' + port))
+                if ready.get('file'):
+                    probes.append(('file', ready['file']))
+                if ready.get('log'):
+                    windows = self.parsed_config.get('windows') or [{}]
+                    root = self.pane_root(windows[num], pane, self.here) or '~'
+                    log = os.path.join(os.path.expanduser(root),
+                                       os.path.expanduser(ready['log']))
+                    size = os.path.join(directory, 'log-%d-%d' % (num + 1, pane_num))
+                    probes.append(('log', log, ready.get('match', '.'), size))
+                    marks[(num, pane_num)] = [line('mark', log, size)]
+                if not probes:
+                    marker = os.path.join(directory, 'pane-%d-%d' % (num + 1, pane_num))
+                    probes.append(('file', marker))
+                    after[(num, pane_num)] = ['touch ' + shlex.quote(marker)]
+                    markers[(num, pane_num)] = [marker]
+                before[key].extend(line('wait', timeout, name, *probe) for probe in probes)
+
+        return before, after, directory, markers, marks
+
+    def initiate_pane(self, pane, commands="", name=None, tag=None):
+        """ Once we have layed out the panes we need, we can now navigate
+            to the specified starting directory and run the specified
+            commands for each pane (and tag it, for --reconcile).
+        """
+
+        # Determine the correct target for Applescript's 'tell' command
+        # based upon iTerm version.
+        if self.new_iterm:
+            tell_target = 'pane_%s' % pane
+        else:
+            # Converts numbers to 2nd, 3rd, 4th format for Applescript
+            ordinal = lambda n: "%d%s" % (n,"tsnrhtdd"[(n/10%10!=1)*(n%10<4)*n%10::4])
+            tell_target = ordinal(pane) + ' session of current terminal'
+
+        # Turn commands list into a string command. If there's nothing to
+        # type (and no name to set), there's nothing to do.
+        command = self.command_text(commands)
+        if command is None and not name and not tag:
+            return
+
+        # Build the applescript snippet. Setting the pane name is
+        # mercifully the same across both iTerm versions.
+        self.applescript.append(WriteText(tell_target, command, name, tag))
+        self.trace_point('write text to pane %s' % pane)
+
+    def command_text(self, commands):
+        """ The text to type to run a list of commands: the commands
+            themselves, or with source_commands, a line sourcing a file
+            of them if that's shorter. None if there are no commands.
+        """
+
+        if not commands:
+            return None
+
+        command = "; ".join(commands)
+        if self.command_files:
+            source = self.command_files.source_line(commands, write=False)
+            if len(source) < len(command):
+                return self.command_files.source_line(commands)
+
+        return command
+
+    def initiate_window(self, commands=None, tag=None):
+        """ Runs the list of commands in the current pane
+        """
+        command = self.command_text(commands) or ""
+        if self.parallel:
+            self.applescript.append(FindSession(1))
+            self.applescript.append(WriteText('pane_1', command))
+        else:
+            self.applescript.append(WriteText('current session of current window', command,
+                                              tag=tag))
+
+    def focus_on_pane(self, pane, plan=()):
+        """ Switch focus to the specified pane (numbered within its
+            window). Old iTerm needs the window's layout plan to find the
+            fewest keystrokes there from the first pane.
+        """
+
+        if not pane:
+            return
+
+        # Determine the correct target for Applescript's 'tell' command
+        # based upon iTerm version.
+        if self.new_iterm:
+            self.applescript.append(Select('pane_%s' % pane))
+        else:
+            self.applescript.extend(KeystrokePlanner(plan).navigate(1, pane))
+
+    def process_file(self, here=None):
+        """ Parse the named iTermocil file, generate Applescript to send to
+            iTerm2 to generate panes, name them and run the specified commands
+            in them.
+        """
+
+        if here is None:
+            here = self.here
+
+        # total_pane_count is only used for old iTerm, and is needed to
+        # reference panes created in later windows (and later layouts)
+        if self.new_iterm:
+            total_pane_count = 0
+        else:
+            total_pane_count = self.total_pane_count
+
+        if 'windows' not in self.parsed_config:
+            print("ERROR: No windows defined in " + self.file)
+            sys.exit(1)
+
+        for num, window in enumerate(self.parsed_config['windows']):
+            # With reconcile, windows whose panes are all still open are
+            # left alone, and only the missing panes of others are made.
+            live = self.live_panes(num, window)
+            if live and len(live) == (len(window.get('panes') or []) or 1):
+                continue
+
+            if num > 0 and not live:
+                self.new_tab(total_pane_count, self.start_command(window, 1, here))
+                self.trace_point('create tab for window %d' % (num + 1))
+
+            # In parallel mode, note which tab this window is in and put
+            # everything else into the window's own script.
+            if self.parallel:
+                self.applescript.append(Statement('set itermocil_ids to itermocil_ids & '
+                                                  '(id of current session of current window) & linefeed'))
+                tabs_script = self.applescript
+                self.applescript = []
+                self.window_scripts.append(self.applescript)
+                self.window_commands.append(None if (here and num == 0) else
+                                            self.start_command(window, 1, here))
+
+            base_command = []
+
+            # Extract layout format, if given.
+            if "layout" in window:
+                layout = window['layout']
+            else:
+                layout = "tiled"
+
+            # Extract starting directory for panes in this window, if given.
+            if 'root' in window:
+                if window['root']:
+                    base_command.append('cd {path}'.format(path=shell_path(window['root'])))
+                else:
+                    if here:
+                        base_command.append('cd {path}'.format(path=shell_path(self.cwd)))
+                    pass
+            else:
+                print('no root!')
+
+            # Generate Applescript to lay the panes out and then add to our
+            # Applescript commands to run.
+            if 'panes' in window:
+
+                # Only the 'grid' layout looks at these
+                columns = window.get('columns')
+                rows = window.get('rows')
+
+                # With split_cwd, sessions we create start in the right
+                # place, so only the current session (with --here) needs
+                # to be told where to go.
+                commands = dict((p, self.start_command(window, p, here))
+                                for p in range(1, len(window['panes']) + 1))
+                if not self.split_cwd:
+                    typed = set(commands)
+                elif here and num == 0:
+                    typed = set([1])
+                else:
+                    typed = set()
+
+                if live:
+                    self.arrange_missing_panes(len(window['panes']), live, layout, columns, rows,
+                                               commands)
+                elif self.new_iterm:
+                    self.arrange_panes(len(window['panes']), layout, columns, rows, commands)
+                else:
+                    self.arrange_panes_old_iterm(len(window['panes']), layout, columns, rows,
+                                                 total_pane_count + 1)
+
+                focus_pane = None
+                if self.new_iterm:
+                    start_pane = 1
+                else:
+                    start_pane = total_pane_count + 1
+
+                for pane_num, pane in enumerate(window['panes'], start=start_pane):
+                    total_pane_count += 1
+                    pane_name = None
+
+                    # each pane needs the base_command to navigate to
+                    # the correct directory (unless it started there),
+                    # or its own root, and its environment. Panes on
+                    # another host need them there.
+                    host = SshHosts.host_of(window, pane)
+                    pane_commands = []
+                    if host or pane_num - start_pane + 1 in typed:
+                        if host:
+                            root = self.pane_root(window, pane)
+                            if root:
+                                pane_commands.append('cd {path}'.format(path=shell_path(root)))
+                        elif isinstance(pane, dict) and pane.get('root'):
+                            pane_commands.append('cd {path}'.format(path=shell_path(pane['root'])))
+                        else:
+                            pane_commands.extend(base_command)
+                        env = self.pane_env(window, pane)
+                        if env:
+                            import shlex
+                            pane_commands.extend('export %s=%s' % (k, shlex.quote(str(v)))
+                                                 for k, v in sorted(env.items()))
+
+                    # wait for this pane's dependencies and its turn to
+                    # start, if it has them (here, even if it runs on
+                    # another host)
+                    startup = self.startup_lines.get((num, pane_num - start_pane + 1), [])
+                    if not host:
+                        pane_commands.extend(startup)
+
+                    # pane entries may be lists of multiple commands
+                    if isinstance(pane, dict):
+                        if 'commands' in pane:
+                            pane_commands.extend(pane['commands'])
+
+                        if 'name' in pane:
+                            pane_name = pane.get('name', None)
+
+                        if 'focus' in pane:
+                            focus_pane = pane_num - start_pane + 1
+
+                    else:
+                        pane_commands.append(pane)
+
+                    # Check if this pane, or containing window has a name.
+                    if pane_name:
+                        window_name = pane_name
+                    else:
+                        window_name = window.get('name', None)
+
+                    if host:
+                        pane_commands = startup + [self.ssh.command(host, pane_commands)]
+
+                    if pane_num - start_pane + 1 in live:
+                        continue
+                    tag = self.pane_tag(num, pane_num) if self.reconcile else None
+                    self.initiate_pane(pane_num, pane_commands, window_name, tag)
+
+                self.focus_on_pane(focus_pane, layout_plan(layout, len(window['panes']),
+                                                           columns, rows))
+
+            else:
+                commands = []
+                if 'command' in window:
+                    commands.append(window['command'])
+                elif 'commands' in window:
+                    commands = window['commands']
+                if window.get('host'):
+                    commands = [self.ssh.command(window['host'], commands)]
+                self.initiate_window(commands, self.pane_tag(num, 1) if self.reconcile else None)
+                self.trace_point('write text to window %d' % (num + 1))
+
+            if self.parallel:
+                self.applescript = tabs_script
+
+        self.total_pane_count = total_pane_count
+
+
+class ApiBackend(object):
+    """ Set up iTerm through its Python API (the 'iterm2' package, talking
+        to iTerm 3.3+ over a websocket) rather than Applescript. The same
+        nodes that would become each window's script are turned into API
+        calls; splits within a window happen in order, but windows, and the
+        text sent to each pane, are set up concurrently.
+    """
+
+    def __init__(self, instance):
 
-        version_script = 'set iterm_version to (get version of application "iTerm")'.encode('utf-8')
-        v = osa.communicate(version_script)[0]
+        self.instance = instance
 
-        return v.strip()
+        # Whether anything has been asked of iTerm that changes it, after
+        # which it's too late to fall back to Applescript, and what went
+        # wrong inside run (which iterm2 would otherwise exit over).
+        self.changed = False
+        self.error = None
 
-    def get_major_version(self):
-        """ Get version of iTerm. 'iTerm2' (iTerm 2.9+) has much improved
-            Applescript support and options, so is more robust.
+    @staticmethod
+    def available():
+        """ Whether the optional iterm2 package is installed.
+        """
+
+        try:
+            import iterm2  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def execute(self):
+        """ Run the layout through the API. Returns False (having done
+            nothing in iTerm) if we couldn't import iterm2 or connect, or
+            anything else went wrong before iTerm was changed, so the
+            caller can fall back to Applescript. Exits if something went
+            wrong after that, as falling back would make the windows
+            again.
         """
 
-        v = self.get_version_string()
+        instance = self.instance
+        if not instance.new_iterm or not instance.window_scripts:
+            return False
 
         try:
-            mv = float(v[:3])
-            return mv
-        except ValueError:
-            return 99.0
+            import iterm2
+            connection = iterm2.Connection()
+            try:
+                instance.wait_for_hooks()
+                with instance.timings.phase('execute'):
+                    connection.run_until_complete(self.run, False, False)
+            finally:
+                # iterm2 leaves the event loop it ran in open.
+                if getattr(connection, 'loop', None) is not None:
+                    connection.loop.close()
+        except Exception as e:
+            self.error = self.error or e
+
+        if self.error is None:
+            return True
+        if not self.changed:
+            return False
+
+        print("ERROR: iTerm's Python API failed part way through: %s"
+              % (str(self.error) or type(self.error).__name__))
+        sys.exit(1)
 
-    def get_num_panes_in_current_window(self):
-        """ Get the number of panes already existing in the current window.
-            This is used only for old iTerm.
+    async def run(self, connection):
+        """ Set the layout up over a connection, keeping any error for
+            execute to deal with.
         """
 
-        osa = subprocess.Popen(['osascript', '-'],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
+        try:
+            await self.run_layout(connection)
+        except Exception as e:
+            self.error = e
 
-        panes_script = """ tell application "iTerm"
-                               count sessions of current terminal
-                           end tell
-                       """
-        num = osa.communicate(panes_script)[0]
+    async def run_layout(self, connection):
 
-        return num.strip()
+        import asyncio
+        import iterm2
 
-    def execute(self):
-        """ Execute the Applescript built by parsing the teamocil file.
-        """
+        app = await iterm2.async_get_app(connection)
+        window = app.current_terminal_window
 
-        parsed_script = "\n".join(self.applescript).encode('utf-8')
+        self.changed = True
+        if window is None:
+            window = await iterm2.Window.async_create(connection)
 
-        osa = subprocess.Popen(['osascript', '-'],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
+        for command in self.instance.shell_commands:
+            self.instance.timings.spawned(osascript=False)
+            proc = await asyncio.create_subprocess_shell(command)
+            await proc.wait()
+
+        # Tabs are created in order, so they end up in the same order as
+        # the windows in the layout.
+        sessions = []
+        for num, command in enumerate(self.instance.window_commands):
+            if num == 0 and self.instance.here:
+                sessions.append(window.current_tab.current_session)
+            else:
+                tab = await window.async_create_tab(command=command)
+                sessions.append(tab.current_session)
 
-        return osa.communicate(parsed_script)[0]
+        await asyncio.gather(*[self.run_window(nodes, session) for nodes, session
+                               in zip(self.instance.window_scripts, sessions)])
 
-    def script(self):
-        """ Return the Applescript we have built (so far). Mainly for
-            debugging purposes.
+    async def run_window(self, nodes, session):
+        """ Carry out one window's nodes, starting in the given session.
         """
 
-        parsed_script = "\n".join(self.applescript)
+        import asyncio
+        import iterm2
+
+        panes = {}
+        sends = []
+        focus = None
+
+        for node in nodes:
+            if isinstance(node, FindSession):
+                panes['pane_%s' % node.pane] = session
+            elif isinstance(node, Split):
+                parent = panes[node.target]
+                customizations = None
+                if node.command:
+                    customizations = iterm2.LocalWriteOnlyProfile()
+                    customizations.set_use_custom_command('Yes')
+                    customizations.set_command(node.command)
+                panes['pane_%s' % node.child] = await parent.async_split_pane(
+                    vertical=(node.direction == 'vertical'),
+                    profile_customizations=customizations)
+            elif isinstance(node, WriteText):
+                pane = panes[node.target]
+                if node.text is not None:
+                    sends.append(pane.async_send_text(node.text + "\n"))
+                if node.name:
+                    sends.append(pane.async_set_name(node.name))
+            elif isinstance(node, Select):
+                focus = panes[node.target]
+
+        await asyncio.gather(*sends)
+
+        if focus is not None:
+            await focus.async_activate()
+
+
+def tmux_quote(arg):
+    """ Quote an argument for a tmux command file (or, the same way, a
+        shell), unless it doesn't need it.
+    """
 
-        return parsed_script
+    arg = str(arg)
+    if re.match(r'^[\w@%+=:,./-]+$', arg):
+        return arg
 
-    def arrange_panes(self, num_panes, layout="tiled"):
-        """ Create a set of Applescript instructions to generate the desired
-            layout of panes. Attempt to match teamocil layout behaviour as
-            closely as is possible.
+    return "'" + arg.replace("'", "'\"'\"'") + "'"
 
-            See 'arrange_panes_old_iterm' for an alternate version for
-            generating a version for old iTerm.
-        """
 
-        def create_pane(parent, child, split="vertical"):
+class TmuxBackend(object):
+    """ Set up a layout in tmux (3.1+) rather than iTerm, for machines
+        without it. The nodes that would become each window's script (see
+        ApiBackend) are turned into tmux commands: new-window, then
+        split-window (in the pane's root, with its env), send-keys,
+        select-layout (also evening out panes after each split, as iTerm
+        does) and select-pane. They're written to one file, run
+        with a single 'tmux source-file' rather than a tmux process each.
 
-            return (''' tell pane_{pp}
-                            set pane_{cp} to (split {o}ly with same profile)
-                        end tell
-                    '''.format(pp=parent, cp=child, o=split))
+        Inside tmux, windows are added to the current session (and --here
+        uses the current window, which should have just the one pane).
+        Otherwise a new session is made, named after the first layout,
+        and attached to if we're in a terminal.
 
-        # Link a variable to the current window.
-        self.applescript.append("set pane_1 to (current session of current window)")
+        tmux numbers the panes of a window in order, each new pane coming
+        just after the one split, starting from pane-base-index. Windows
+        are found by a temporary name, and given their own once set up.
+    """
 
-        # If we have just one pane we don't need to do any splitting.
-        if num_panes <= 1:
-            return
+    # Layouts tmux has its own version of, which it uses to even out the
+    # panes once they're all split.
+    layouts = {'even-horizontal': 'even-horizontal', 'even-vertical': 'even-vertical',
+               'main-vertical': 'main-vertical', 'main-horizontal': 'main-horizontal',
+               'tiled': 'tiled'}
 
-        # tmux seems to treat the first 2 tiles of a tiled layout like this
-        if num_panes == 2:
-            if layout == 'tiled':
-                layout = 'even-vertical'
+    def __init__(self, instance, session=None):
 
-        # 'even-horizontal' layouts just split vertically across the screen
-        if layout == 'even-horizontal':
+        self.instance = instance
+        self.inside = bool(os.getenv('TMUX'))
+        self.session = session or re.sub(r'[^\w-]', '_', os.path.splitext(
+            os.path.basename(instance.files[0]))[0])
 
-            for p in range(2, num_panes+1):
-                self.applescript.append(create_pane(p-1, p, "vertical"))
+    def windows(self):
+        """ The windows of all the layouts, in order, each with whether it
+            uses the current window (with --here).
+        """
 
-        # 'even-vertical' layouts just split horizontally down the screen
-        elif layout == 'even-vertical':
+        windows = []
+        for config in self.instance.parsed_configs:
+            windows.extend(config.get('windows') or [{}])
 
-            for p in range(2, num_panes+1):
-                self.applescript.append(create_pane(p-1, p, "horizontal"))
+        return [(window, self.inside and self.instance.here and num == 0)
+                for num, window in enumerate(windows)]
 
-        # 'main-vertical' layouts have one left pane that is full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'main-vertical':
+    def pane_options(self, window, pane_num):
+        """ new-window and split-window's options for a pane: its root
+            and env, unless it's on another host (see SshHosts).
+        """
 
-            self.applescript.append(create_pane(1, 2, "vertical"))
-            for p in range(3, num_panes+1):
-                self.applescript.append(create_pane(p-1, p, "horizontal"))
+        pane = (window.get('panes') or [None])[pane_num - 1]
+        if SshHosts.host_of(window, pane):
+            return []
 
-        # 'main-vertical-flipped' layouts have one right pane that is full height,
-        # and then split the remaining panes horizontally down the left
-        elif layout == 'main-vertical-flipped':
+        options = []
+        root = self.instance.pane_root(window, pane)
+        if root:
+            options += ['-c', os.path.expanduser(root)]
+        for k, v in sorted(self.instance.pane_env(window, pane).items()):
+            options += ['-e', '%s=%s' % (k, v)]
 
-            self.applescript.append(create_pane(1, num_panes, "vertical"))
-            for p in range(2, num_panes):
-                self.applescript.append(create_pane(p-1, p, "horizontal"))
+        return options
 
-        # 'main-horizontal' layouts have one left pane that is full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'main-horizontal':
+    def new_session(self):
+        """ The command making the session (outside tmux), with the first
+            window, sized to fit this terminal.
+        """
 
-            self.applescript.append(create_pane(1, 2, "horizontal"))
-            for p in range(3, num_panes+1):
-                self.applescript.append(create_pane(p-1, p, "vertical"))
+        import shutil
 
-        # 'double-main-horizontal' layouts have two left panes that are full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'double-main-horizontal':
+        columns, lines = shutil.get_terminal_size()
+        window = self.windows()[0][0]
+        return (['new-session', '-d', '-s', self.session, '-n', 'itermocil-1',
+                 '-x', str(columns), '-y', str(lines)] + self.pane_options(window, 1))
 
-            self.applescript.append(create_pane(1, num_panes-1, "horizontal"))
-            self.applescript.append(create_pane(num_panes-1, num_panes, "vertical"))
-            for p in range(2, num_panes-1):
-                self.applescript.append(create_pane(p-1, p, "vertical"))
+    def commands(self, base=0):
+        """ The tmux commands (as lists of arguments) setting up every
+            window after the new session (if there is one), for panes
+            numbered from base.
+        """
 
-        # 'double-main-vertical' layouts have two bottom panes that spllit the width
-        # and then split the remaining panes vertically across the top
-        elif layout == 'double-main-vertical':
+        session = '' if self.inside else '=' + self.session
+        commands = []
+
+        for num, ((window, here), nodes) in enumerate(zip(self.windows(),
+                                                          self.instance.window_scripts)):
+            name = 'itermocil-%d' % (num + 1)
+            target = '%s:=%s' % (session, name)
+            if here:
+                commands.append(['rename-window', name])
+            elif num > 0 or self.inside:
+                commands.append(['new-window', '-t', session + ':', '-n', name]
+                                + self.pane_options(window, 1))
+
+            # Panes by plan number, in tmux's order.
+            order = [1]
+
+            def pane(target_node):
+                number = int(target_node.target[len('pane_'):])
+                return '%s.%d' % (target, order.index(number) + base)
+
+            for node in nodes:
+                if isinstance(node, Split):
+                    commands.append(['split-window', '-t', pane(node),
+                                     '-h' if node.direction == 'vertical' else '-v']
+                                    + self.pane_options(window, node.child))
+                    order.insert(order.index(node.parent) + 1, node.child)
+                    # iTerm shares space evenly between panes split the same
+                    # way, where tmux would just halve the pane split.
+                    commands.append(['select-layout', '-t', pane(Select('pane_%s' % node.child)),
+                                     '-E'])
+                elif isinstance(node, WriteText):
+                    if node.text is not None:
+                        commands.append(['send-keys', '-t', pane(node), '-l', node.text])
+                        commands.append(['send-keys', '-t', pane(node), 'Enter'])
+                    if node.name:
+                        commands.append(['select-pane', '-t', pane(node), '-T', node.name])
+                elif isinstance(node, Select):
+                    commands.append(['select-pane', '-t', pane(node)])
+
+            layout = self.layouts.get(window.get('layout', 'tiled'))
+            if layout and len(order) > 1:
+                commands.append(['select-layout', '-t', target, layout])
+
+            if window.get('name'):
+                commands.append(['rename-window', '-t', target, window['name']])
+            else:
+                commands.append(['set-option', '-w', '-t', target, 'automatic-rename', 'on'])
 
-            self.applescript.append(create_pane(1, 2, "vertical"))
-            self.applescript.append(create_pane(2, 3, "vertical"))
-            for p in range(4, num_panes+1):
-                self.applescript.append(create_pane(p-1, p, "horizontal"))
-
-        # 'tiled' layouts create 2 columns and then however many rows as
-        # needed. If there are odd number of panes then the bottom pane
-        # spans two columns. Panes are numbered top to bottom, left to right.
-        elif layout == 'tiled':
-
-            vertical_splits = int(ceil((num_panes / 2.0))) - 1
-            second_columns = num_panes // 2
-
-            for p in range(0, vertical_splits):
-                pp = (p * 2) + 1
-                cp = pp + 2
-                self.applescript.append(create_pane(pp, cp, "horizontal"))
-
-            for p in range(0, second_columns):
-                pp = (p * 2) + 1
-                cp = pp + 1
-                self.applescript.append(create_pane(pp, cp, "vertical"))
-
-        # '3_columns' layouts create 3 columns and then however many rows as
-        # needed. If there are odd number of panes then the bottom pane
-        # spans two columns. Panes are numbered top to bottom, left to right.
-        elif layout == '3_columns':
-
-            vertical_splits = int(ceil((num_panes / 3.0))) - 1
-            second_columns = num_panes // 3
-            i = 1
-
-            for p in range(0, vertical_splits):
-                pp = (p * 3) + 1
-                cp = pp + 3
-                i += 1
-                self.applescript.append(create_pane(pp, cp, "horizontal"))
-
-            for p in range(0, vertical_splits+1):
-                pp = (p * 3) + 1
-                for q in range(0, 2):
-                    if i >= num_panes:
-                        break
-                    qp = pp + q
-                    cp = pp + 1 + q
-                    i += 1
-                    self.applescript.append(create_pane(qp, cp, "vertical"))
-
-        # Raise an exception if we don't recognise the layout setting.
-        else:
-            raise ValueError("Unknown layout setting.")
+        return commands
 
-    def arrange_panes_old_iterm(self, num_panes, layout="tiled"):
-        """ Create a set of Applescript instructions to generate the desired
-            layout of panes. Attempt to match teamocil layout behaviour as
-            closely as is possible.
+    def script(self, base=0):
+        """ The command file (with the new session, if there is one).
+        """
+
+        commands = self.commands(base)
+        if not self.inside:
+            commands.insert(0, self.new_session())
 
-            See 'arrange_panes' for the main version used for generating
-            the script for the newer iTerm.
+        return ''.join(' '.join(tmux_quote(arg) for arg in command) + '\n'
+                       for command in commands)
+
+    def execute(self):
+        """ Make the session (outside tmux) and find out pane-base-index,
+            then run the rest of the commands from a file with one tmux
+            process, and attach to the session.
         """
 
-        prefix = 'tell i term application "System Events" to '
+        import subprocess
+
+        instance = self.instance
+        timings = instance.timings
+
+        for command in instance.shell_commands:
+            timings.spawned(osascript=False)
+            subprocess.check_call(command, shell=True)
+
+        instance.wait_for_hooks()
+
+        with timings.phase('execute'):
+            # Making the session starts the server if it isn't running
+            # (which reads the user's settings, like pane-base-index).
+            for attempt in range(1, 100):
+                query = ['tmux']
+                if not self.inside:
+                    query += self.new_session() + [';']
+                query += ['show-options', '-gv', 'pane-base-index']
+                timings.spawned(osascript=False)
+                proc = subprocess.Popen(query, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = proc.communicate()
+                if not (proc.returncode and b'duplicate session' in err):
+                    break
+                self.session = re.sub(r'-\d+$', '', self.session) + '-%d' % (attempt + 1)
 
-        # If we have just one pane we don't need to do any splitting.
-        if num_panes <= 1:
-            return
+            if proc.returncode:
+                print("ERROR: tmux failed: " + err.decode('utf-8').strip())
+                sys.exit(1)
+            base = int(out.split()[-1]) if out.split() else 0
 
-        # tmux seems to treat the first 2 tiles of a tiled layout like this
-        if num_panes == 2 and layout == 'tiled':
-            layout = 'even-vertical'
+            path = os.path.join(cache_dir(), 'tmux', self.session + '.conf')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(''.join(' '.join(tmux_quote(arg) for arg in command) + '\n'
+                                for command in self.commands(base)))
 
-        # 'even-horizontal' layouts just split vertically across the screen
-        if layout == 'even-horizontal':
+            timings.spawned(osascript=False)
+            status = subprocess.call(['tmux', 'source-file', path])
 
-            for p in range(2, num_panes+1):
-                self.applescript.append(prefix + 'keystroke "d" using command down')
+        if status:
+            sys.exit(status)
+        if not self.inside and sys.stdout.isatty():
+            os.execvp('tmux', ['tmux', 'attach-session', '-t', '=' + self.session])
 
-            # Focus back on the first pane
-            self.applescript.append(prefix + 'keystroke "]" using command down')
 
-        # 'even-vertical' layouts just split horizontally down the screen
-        elif layout == 'even-vertical':
+def layout_dirs():
+    """ The directories layouts are looked for in.
+    """
 
-            for p in range(2, num_panes+1):
-                self.applescript.append(prefix + 'keystroke "D" using command down')
+    home = os.path.expanduser("~")
+    return [os.path.join(home, ".itermocil"), os.path.join(home, ".teamocil")]
 
-            # Focus back on the first pane
-            self.applescript.append(prefix + 'keystroke "]" using command down')
 
-        # 'main-vertical' layouts have one left pane that is full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'main-vertical':
+class LayoutIndex(object):
+    """ A catalogue of the layouts in the layout directories, with their
+        window and pane counts, the layouts (tiled etc.) they use, and a
+        description, so that --list and shell completion don't need to
+        parse anything. Refreshing only re-reads files whose mtime or
+        size changed.
 
-            self.applescript.append(prefix + 'keystroke "d" using command down')
-            for p in range(3, num_panes+1):
-                self.applescript.append(prefix + 'keystroke "D" using command down')
+        It is kept as tab separated text, one layout per line, so that
+        reading it needs no imports.
+    """
 
-            # Focus back on the first pane
-            self.applescript.append(prefix + 'keystroke "]" using command down')
+    fields = ['path', 'mtime', 'size', 'windows', 'panes', 'layouts', 'description']
 
-        # 'main-vertical-flipped' layouts have one right pane that is full height,
-        # and then split the remaining panes horizontally down the left
-        elif layout == 'main-vertical-flipped':
+    def __init__(self, path=None, dirs=None):
 
-            self.applescript.append(prefix + 'keystroke "d" using command down')
+        self.path = path or os.path.join(cache_dir(), 'index.tsv')
+        self.dirs = dirs or layout_dirs()
+        self.entries = {}
 
-            # Focus back on the first pane
-            self.applescript.append(prefix + 'keystroke "[" using command down')
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    values = line.rstrip('\n').split('\t')
+                    if len(values) != len(self.fields):
+                        continue
+                    entry = dict(zip(self.fields, values))
+                    for field in ('mtime', 'size', 'windows', 'panes'):
+                        entry[field] = int(entry[field])
+                    entry['layouts'] = [l for l in entry['layouts'].split(',') if l]
+                    self.entries[entry['path']] = entry
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def describe(path):
+        """ Work out the metadata for one layout file. The description is
+            its 'description' key if it has one, otherwise the first
+            comment at the top of the file.
+        """
 
-            for p in range(3, num_panes+1):
-                self.applescript.append(prefix + 'keystroke "D" using command down')
+        config = load_config(path)
+        if not isinstance(config, dict):
+            config = {}
+        windows = config.get('windows') or []
+
+        description = config.get('description') or ''
+        if not description:
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if line.startswith('#'):
+                        description = line.lstrip('#').strip()
+                    break
 
-        # 'main-horizontal' layouts have one left pane  that is full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'main-horizontal':
+        layouts = []
+        panes = 0
+        for window in windows:
+            layout = window.get('layout') or 'tiled'
+            if layout not in layouts:
+                layouts.append(layout)
+            panes += len(window.get('panes') or [])
 
-            self.applescript.append(prefix + 'keystroke "D" using command down')
-            for p in range(3, num_panes+1):
-                self.applescript.append(prefix + 'keystroke "d" using command down')
+        return {'windows': len(windows), 'panes': panes, 'layouts': layouts,
+                'description': ' '.join(str(description).split())}
 
-            # Focus back on the first pane
-            self.applescript.append(prefix + 'keystroke "]" using command down')
+    def refresh(self):
+        """ Bring the index up to date with the layout directories,
+            saving it if anything changed.
+        """
 
-        # 'tiled' layouts create 2 columns and then however many rows as
-        # needed. If there are odd number of panes then the bottom pane
-        # spans two columns. Panes are numbered top to bottom, left to right.
-        elif layout == 'tiled':
+        seen = set()
+        changed = False
+
+        for d in self.dirs:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.yml'):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+
+                entry = self.entries.get(path)
+                if entry and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                    continue
+
+                try:
+                    entry = self.describe(path)
+                except Exception:
+                    # Still list layouts we can't parse; launching them
+                    # will say what's wrong.
+                    entry = {'windows': 0, 'panes': 0, 'layouts': [], 'description': ''}
+                entry.update(path=path, mtime=st.st_mtime_ns, size=st.st_size)
+                self.entries[path] = entry
+                changed = True
+
+        for path in list(self.entries):
+            if path not in seen:
+                del self.entries[path]
+                changed = True
+
+        if changed:
+            self.save()
+
+        return self
+
+    def save(self):
+
+        lines = []
+        for path in sorted(self.entries):
+            entry = dict(self.entries[path], layouts=','.join(self.entries[path]['layouts']))
+            lines.append('\t'.join(str(entry[field]).replace('\t', ' ') for field in self.fields))
+
+        # Write then rename, so a completion running at the same time
+        # never sees half an index.
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+    def layouts(self, hidden=False):
+        """ All the layouts, in the order --list shows them: by directory,
+            then by name. A layout in ~/.itermocil hides one with the same
+            name in ~/.teamocil, as it does when launching, unless hidden
+            is True (--list shows every directory's layouts).
+        """
 
-            vertical_splits = int(ceil((num_panes / 2.0))) - 1
-            second_columns = num_panes // 2
+        found = {}
+        for d in self.dirs:
+            for path in sorted(self.entries):
+                entry = self.entries[path]
+                name = os.path.basename(path)[:-4]
+                if os.path.dirname(path) == d and (hidden or name not in found):
+                    found[path if hidden else name] = dict(entry, name=name, dir=d)
+
+        return sorted(found.values(), key=lambda e: (self.dirs.index(e['dir']), e['name']))
+
+    def search(self, query, hidden=False):
+        """ Layouts matching query, best first: names starting with it,
+            then names containing it, then names containing its letters
+            in order (so 'wbap' finds 'web-app'). hidden is as for
+            layouts().
+        """
 
-            for p in range(0, vertical_splits):
-                self.applescript.append(prefix + 'keystroke "D" using command down')
+        query = query.lower()
+        ranked = []
+        for entry in self.layouts(hidden):
+            name = entry['name'].lower()
+            if name.startswith(query):
+                rank = 0
+            elif query in name:
+                rank = 1
+            elif self.subsequence(query, name):
+                rank = 2
+            else:
+                continue
+            ranked.append((rank, entry['name'], entry))
 
-            if vertical_splits > 0:
-                # If we split vertically at all then move 'down' a pane to take
-                # us back to the initial pane.
-                self.applescript.append(prefix + 'key code 125 using {command down, option down}')
+        return [entry for rank, name, entry in sorted(ranked, key=lambda r: r[:2])]
 
-            for p in range(0, second_columns):
-                self.applescript.append(prefix + 'keystroke "d" using command down')
-                self.applescript.append(prefix + 'keystroke "]" using command down')
+    @staticmethod
+    def subsequence(query, name):
 
-            if num_panes % 2 != 0:
-                # If odd number of panes then move once more to return to initial pane.
-                self.applescript.append(prefix + 'keystroke "]" using command down')
+        chars = iter(name)
+        return all(c in chars for c in query)
 
-        # '3_columns' layouts create 3 columns and then however many rows as
-        # needed. If there are odd number of panes then the bottom pane
-        # spans two columns. Panes are numbered top to bottom, left to right.
-        elif layout == '3_columns':
 
-            vertical_splits = int(ceil((num_panes / 3.0))) - 1
+def daemon_socket_path():
+    """ Where the daemon listens. The thin client in the 'itermocil'
+        script works this out the same way.
+    """
 
-            i = 1
-            for p in range(0, vertical_splits):
-                self.applescript.append(prefix + 'keystroke "D" using command down')
-                i += 1
+    return os.path.join(cache_dir(), 'daemon.sock')
 
-            while True:
-                self.applescript.append(prefix + 'keystroke "]" using command down')
-                i += 1
-                self.applescript.append(prefix + 'keystroke "d" using command down')
-                if i >= num_panes:
-                    break
-                i += 1
-                self.applescript.append(prefix + 'keystroke "d" using command down')
-                if i >= num_panes:
-                    break
 
-        # 'double-main-horizontal' layouts have two left panes that are full height,
-        # and then split the remaining panes horizontally down the right
-        elif layout == 'double-main-horizontal':
+def watch_layouts(interval=2.0):
+    """ Every interval seconds, parse any layout that is new or has
+        changed, so it is ready (in _memo) before it is launched.
+    """
 
-            self.applescript.append(prefix + 'keystroke "d" using command down')
-            if num_panes > 2:
-                self.applescript.append(prefix + 'keystroke "d" using command down')
+    while True:
+        for d in layout_dirs():
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if name.endswith(".yml"):
+                    try:
+                        load_config(os.path.join(d, name))
+                    except Exception:
+                        pass
+        time.sleep(interval)
+
+
+class RequestOutput(object):
+    """ Stands in for sys.stdout or sys.stderr in the daemon, which runs
+        each request on a thread of its own: what a request prints goes
+        to its own buffer (the thread's attribute name, if set), and
+        anything else to the stream it replaced.
+    """
 
-            if num_panes > 3:
-                for p in range(0, num_panes-3):
-                    self.applescript.append(prefix + 'keystroke "D" using command down')
+    def __init__(self, stream, local, name):
 
-        # 'double-main-vertical' layouts have two bottom panes that split the width
-        # and then split the remaining panes vertically across the top
-        elif layout == 'double-main-vertical':
+        self.stream = stream
+        self.local = local
+        self.name = name
 
-            self.applescript.append(prefix + 'keystroke "D" using command down')
-            self.applescript.append(prefix + 'keystroke "d" using command down')
+    def target(self):
 
-            self.applescript.append(prefix + 'keystroke "]" using command down')
-            if num_panes > 3:
-                for p in range(0, num_panes-3):
-                    self.applescript.append(prefix + 'keystroke "d" using command down')
+        return getattr(self.local, self.name, None) or self.stream
 
-        # Raise an exception if we don't recognise the layout setting.
-        else:
-            raise ValueError("Unknown layout setting.")
+    def write(self, text):
 
-        # This is all keystroke based and thus takes a moment to happen,
-        # so unfortunately (for old iTerm) we have to wait a moment to
-        # give all that time to happen.
-        self.applescript.append('delay 2')
+        return self.target().write(text)
 
-    def initiate_pane(self, pane, commands="", name=None):
-        """ Once we have layed out the panes we need, we can now navigate
-            to the specified starting directory and run the specified
-            commands for each pane.
-        """
+    def flush(self):
 
-        # Determine the correct target for Applescript's 'tell' command
-        # based upon iTerm version.
-        if self.new_iterm:
-            tell_target = 'pane_%s' % pane
-        else:
-            # Converts numbers to 2nd, 3rd, 4th format for Applescript
-            ordinal = lambda n: "%d%s" % (n,"tsnrhtdd"[(n/10%10!=1)*(n%10<4)*n%10::4])
-            tell_target = ordinal(pane) + ' session of current terminal'
+        self.target().flush()
 
-        # Setting the pane name is mercifully the same across both
-        # iTerm versions.
-        if name:
-            name_command = 'set name to "' + name + '"'
+    def __getattr__(self, name):
 
-        # Turn commands list into a string command
-        command = "; ".join(commands)
+        return getattr(self.stream, name)
 
-        # Build the applescript snippet.
-        self.applescript.append(
-            ''' tell {tell_target}
-                    write text "{command}"
-                    {name}
-                end tell
-            '''.format(tell_target=tell_target, command=command, name=name_command))
 
-    def initiate_window(self, commands=None):
-        """ Runs the list of commands in the current pane
-        """
-        command = "; ".join(commands)
-        self.applescript.append(
-            ''' tell current session of current window
-                    write text "{command}"
-                end tell
-            '''.format(command=command))
+class Requests(object):
+    """ Runs itermocil commands for the daemon's clients, at the same time
+        (so a launch waiting on its hooks doesn't hold up --complete or
+        --list). A client's ITERMOCIL_* settings are put in the
+        environment for the length of its command, which is the daemon's
+        own, so only commands with the same settings run at once; others
+        wait for them to finish.
+    """
 
-    def focus_on_pane(self, pane):
-        """ Switch focus to the specified pane.
-        """
+    def __init__(self):
 
-        if not pane:
-            return
+        import threading
 
-        if not self.new_iterm and not self.here:
-            pane -= 1
+        self.local = threading.local()
+        self.changed = threading.Condition()
+        self.settings = None
+        self.saved = {}
+        self.running = 0
 
-        # Determine the correct target for Applescript's 'tell' command
-        # based upon iTerm version.
-        if self.new_iterm:
-            self.applescript.append(''' tell pane_{pane}
-                                        select
-                                    end tell
-                                '''.format(pane=pane))
-        else:
-            for i in range(1, pane):
-                self.applescript.append('tell i term application "System Events" ' +
-                                        'to keystroke "]" using command down')
+        if not isinstance(sys.stdout, RequestOutput):
+            sys.stdout = RequestOutput(sys.stdout, self.local, 'stdout')
+        if not isinstance(sys.stderr, RequestOutput):
+            sys.stderr = RequestOutput(sys.stderr, self.local, 'stderr')
 
-    def process_file(self):
-        """ Parse the named iTermocil file, generate Applescript to send to
-            iTerm2 to generate panes, name them and run the specified commands
-            in them.
+    def enter(self, settings):
+        """ Wait until no commands with other settings are running, then
+            put these in the environment (if they aren't already).
         """
 
-        # total_pane_count is only used for old iTerm, and is needed to
-        # reference panes created in later windows
-        if self.new_iterm:
-            total_pane_count = 0
-        else:
-            total_pane_count = int(self.get_num_panes_in_current_window())
-            if self.here:
-                total_pane_count -= 1
+        with self.changed:
+            while self.running and settings != self.settings:
+                self.changed.wait()
+            if not self.running:
+                self.settings = settings
+                self.saved = dict((k, os.environ.get(k)) for k in settings)
+                os.environ.update(settings)
+            self.running += 1
+
+    def leave(self):
+        """ Once the last command with these settings finishes, put the
+            environment back as it was.
+        """
 
-        if 'windows' not in self.parsed_config:
-            print("ERROR: No windows defined in " + self.file)
-            sys.exit(1)
+        with self.changed:
+            self.running -= 1
+            if not self.running:
+                for k, v in self.saved.items():
+                    if v is None:
+                        os.environ.pop(k, None)
+                    else:
+                        os.environ[k] = v
+                self.changed.notify_all()
 
-        for num, window in enumerate(self.parsed_config['windows']):
-            if num > 0:
-                if self.new_iterm:
-                    self.applescript.append('tell current window')
-                    self.applescript.append('create tab with default profile')
-                    self.applescript.append('end tell')
-                    # self.applescript.append('create window with default profile')
-                else:
-                    self.applescript.append('delay 0.3')
-                    self.applescript.append('tell i term application "System Events" ' +
-                                            'to keystroke "t" using command down')
-                    self.applescript.append('delay 0.3')
+    def handle(self, request):
+        """ Run one itermocil command for a client of the daemon, returning
+            what it printed and its exit status.
+        """
 
-            base_command = []
+        import io
+        import traceback
 
-            # Extract layout format, if given.
-            if "layout" in window:
-                layout = window['layout']
-            else:
-                layout = "tiled"
+        settings = dict((k, v) for k, v in request.get('env', {}).items()
+                        if k.startswith('ITERMOCIL_'))
+        argv, cwd = request['argv'], request['cwd']
 
-            # Extract starting directory for panes in this window, if given.
-            if 'root' in window:
-                if window['root']:
-                    parsed_path = window['root'].replace(" ", "\\\ ")
-                    base_command.append('cd {path}'.format(path=parsed_path))
-                else:
-                    if self.here:
-                        parsed_path = self.cwd.replace(" ", "\\\ ")
-                        base_command.append('cd {path}'.format(path=parsed_path))
-                    pass
+        self.local.stdout, self.local.stderr = stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+
+        self.enter(settings)
+        try:
+            main(argv, cwd)
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                stderr.write(e.code + "\n")
+                status = 1
             else:
-                print('no root!')
+                status = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            self.leave()
+            self.local.stdout = self.local.stderr = None
+
+        return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'status': status}
+
+    def serve_client(self, conn):
+        """ Read a client's request from its connection, and send back the
+            response.
+        """
 
-            # Generate Applescript to lay the panes out and then add to our
-            # Applescript commands to run.
-            if 'panes' in window:
+        import json
 
-                if self.new_iterm:
-                    self.arrange_panes(len(window['panes']), layout)
-                else:
-                    self.arrange_panes_old_iterm(len(window['panes']), layout)
+        with conn:
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                response = self.handle(json.loads(data.decode('utf-8')))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                response = {'stdout': '', 'stderr': 'Bad request\n', 'status': 1}
+            try:
+                conn.sendall(json.dumps(response).encode('utf-8'))
+            except OSError:
+                pass
+
+
+def listen(path):
+    """ Listen on a Unix socket at path that only this user can connect
+        to. A socket left there by a daemon that's gone is replaced, but
+        one with a daemon still listening (or anything else) is an error.
+    """
 
-                focus_pane = None
-                if self.new_iterm:
-                    start_pane = 1
-                else:
-                    start_pane = total_pane_count + 1
+    import socket
+    import stat
 
-                for pane_num, pane in enumerate(window['panes'], start=start_pane):
-                    total_pane_count += 1
-                    pane_name = None
+    try:
+        st = os.lstat(path)
+    except OSError:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            print("ERROR: %s exists and isn't a socket." % path)
+            sys.exit(1)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)
+        else:
+            print("ERROR: an itermocil daemon is already listening on %s." % path)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Made without group or other permissions, rather than changed after
+    # (when someone else could already have connected).
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    server.listen(16)
+
+    return server
+
+
+def serve(path=None, poll_interval=2.0):
+    """ Run as a daemon, listening on a Unix socket for itermocil commands
+        from the thin client. Staying resident means Python startup, the
+        imports, version detection and layout parsing have already been
+        paid for when a launch arrives. Each command runs on a thread of
+        its own (see Requests).
+    """
 
-                    # each pane needs the base_command to navigate to
-                    # the correct directory
-                    pane_commands = []
-                    pane_commands.extend(base_command)
+    import threading
 
-                    # pane entries may be lists of multiple commands
-                    if isinstance(pane, dict):
-                        if 'commands' in pane:
-                            for command in pane['commands']:
-                                escaped_command = command.replace('"', r'\"')
-                                pane_commands.append(escaped_command)
+    path = path or daemon_socket_path()
+    server = listen(path)
+    requests = Requests()
 
-                        if 'name' in pane:
-                            pane_name = pane.get('name', None)
+    watcher = threading.Thread(target=watch_layouts, args=(poll_interval,))
+    watcher.daemon = True
+    watcher.start()
 
-                        if 'focus' in pane:
-                            focus_pane = pane_num
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=requests.serve_client, args=(conn,), daemon=True).start()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
 
-                    else:
-                        escaped_command = pane.replace('"', r'\"')
-                        pane_commands.append(escaped_command)
 
-                    # Check if this pane, or containing window has a name.
-                    if pane_name:
-                        window_name = pane_name
-                    else:
-                        window_name = window.get('name', None)
+def report_timings(fmt, timings):
+    """ Print the timings of a launch to stderr, if asked for with
+        --timings (as a table) or --timings=json.
+    """
 
-                    self.initiate_pane(pane_num, pane_commands, window_name)
+    if not fmt:
+        return
 
-                self.focus_on_pane(focus_pane)
+    if fmt == 'json':
+        import json
+        sys.stderr.write(json.dumps(timings.as_dict(), indent=2) + "\n")
+    else:
+        sys.stderr.write(timings.report() + "\n")
 
-            else:
-                commands = []
-                if 'command' in window:
-                    commands.append(window['command'])
-                elif 'commands' in window:
-                    commands = window['commands']
-                self.initiate_window(commands)
 
+def report_trace(steps):
+    """ Print how long each step of a traced script took inside iTerm.
+    """
+
+    if not steps:
+        print("No trace output was returned by osascript.")
+        return
+
+    width = max(len(label) for label, _ in steps)
+    for label, seconds in steps:
+        print('%-*s %9.1fms' % (width, label, seconds * 1000))
+    print('%-*s %9.1fms' % (width, 'total', sum(seconds for _, seconds in steps) * 1000))
 
-def main():
+
+def main(argv=None, cwd=None):
+    """ Run itermocil with the given arguments (default: sys.argv) as if
+        from the given directory (default: the current one).
+    """
 
     parser = argparse.ArgumentParser(
         description='Process a teamocil file natively in iTerm2 (i.e. without tmux).',
@@ -633,11 +3475,27 @@ def main():
                         action="store_true",
                         default=None)
 
+    parser.add_argument("--group",
+                        help="a file listing layouts (one per line) to launch together",
+                        default=None)
+
     parser.add_argument("--list",
                         help="show the available layouts in ~/teamocil",
                         action="store_true",
                         default=False)
 
+    parser.add_argument("--json",
+                        help="with --list, output the layouts and what's in them as json",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--complete",
+                        help="list layout names matching PREFIX, for shell completion",
+                        metavar="PREFIX",
+                        nargs="?",
+                        const="",
+                        default=None)
+
     parser.add_argument("--version",
                         help="show iTermocil version",
                         action="store_true",
@@ -648,47 +3506,175 @@ def main():
                         action="store_true",
                         default=None)
 
-    args = parser.parse_args()
+    parser.add_argument("--no-cache",
+                        help="don't use (or update) the cache of generated scripts",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--cache-stats",
+                        help="show statistics about the cache of generated scripts",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--timings",
+                        help="show how long each phase took (as a table, or json)",
+                        nargs="?",
+                        const="table",
+                        choices=["table", "json"],
+                        default=None)
+
+    parser.add_argument("--trace",
+                        help="time each step the script takes inside iTerm",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--parallel",
+                        help="set up windows concurrently, running up to N scripts at once (iTerm 2.9+)",
+                        metavar="N",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--backend",
+                        help="how to drive iTerm: applescript (default), or api to use iTerm's "
+                             "Python API if the iterm2 package is installed, or tmux to set the "
+                             "layout up in tmux instead",
+                        choices=["applescript", "api", "tmux"],
+                        default="applescript")
+
+    parser.add_argument("--daemon",
+                        help="stay running in the background to make later launches faster",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--reconcile",
+                        help="only create the windows and panes of the layout which aren't "
+                             "still open from an earlier --reconcile launch (iTerm 3.3+)",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--split-cwd",
+                        help="start each new pane in its root directory, with its env, rather "
+                             "than typing cd into it (iTerm 2.9+)",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--source-commands",
+                        help="put each pane's commands in a file and type a line sourcing it, "
+                             "rather than typing them all",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--wait-timeout",
+                        help="with old iTerm, wait up to this many seconds for each new tab "
+                             "and its panes to appear (default 10)",
+                        metavar="SECONDS",
+                        type=float,
+                        default=10.0)
+
+    parser.add_argument("--poll-interval",
+                        help="with old iTerm, how often to check whether panes have appeared "
+                             "(default 0.1 seconds)",
+                        metavar="SECONDS",
+                        type=float,
+                        default=0.1)
+
+    parser.add_argument("--fixed-delays",
+                        help="with old iTerm, wait a fixed time for tabs and panes to appear, "
+                             "rather than checking",
+                        action="store_true",
+                        default=False)
+
+    parser.add_argument("--iterm-version",
+                        help="assume this iTerm version rather than asking iTerm",
+                        default=None)
+
+    args = parser.parse_args(argv)
+
+    if cwd is None:
+        cwd = os.getcwd()
+
+    # If --daemon then stay running, serving other itermocil commands
+    if args.daemon:
+        serve()
+        sys.exit(0)
 
     # itermocil files live in a hidden directory in the home directory
     # either in an .itermocil directory or a .teamocil directory
-    itermocil_dir = os.path.join(os.path.expanduser("~"), ".itermocil")
-    teamocil_dir = os.path.join(os.path.expanduser("~"), ".teamocil")
+    itermocil_dir, teamocil_dir = layout_dirs()
 
     # If --version then show the version number
     if args.version:
         print(__version__)
         sys.exit(0)
 
-    # If --list then show the layout names in ~./teamocil
+    # If --cache-stats then describe the script cache
+    if args.cache_stats:
+        for k, v in sorted(ScriptCache().stats().items()):
+            print("%s: %s" % (k, v))
+        sys.exit(0)
+
+    # If --complete then print the names of matching layouts for the
+    # shell, straight from the index
+    if args.complete is not None:
+        for entry in LayoutIndex().refresh().search(args.complete):
+            print(entry['name'])
+        sys.exit(0)
+
+    # If --list then show the layout names in ~./teamocil, optionally
+    # only those matching the given search
     if args.list:
-        for d in [itermocil_dir, teamocil_dir]:
-            if os.path.isdir(d):
-                print(d)
-                for file in os.listdir(d):
-                    if file.endswith(".yml"):
-                        print("  " + file[:-4])
+        index = LayoutIndex().refresh()
+        if args.layout_name:
+            entries = index.search(' '.join(args.layout_name), hidden=True)
+        else:
+            entries = index.layouts(hidden=True)
+
+        if args.json:
+            import json
+            print(json.dumps([dict((k, e[k]) for k in ('name', 'path', 'windows', 'panes',
+                                                        'layouts', 'description'))
+                              for e in entries], indent=2))
+        else:
+            for d in [itermocil_dir, teamocil_dir]:
+                names = [e['name'] for e in entries if e['dir'] == d]
+                if os.path.isdir(d) and (names or not args.layout_name):
+                    print(d)
+                    for name in names:
+                        print("  " + name)
         sys.exit(0)
 
-    filepath = None
-    if not args.layout_name:
+    # Layouts can be given as arguments, and/or listed in a --group file
+    layouts = list(args.layout_name)
+    if args.group:
+        group = os.path.join(cwd, args.group)
+        if not os.path.isfile(group):
+            print("ERROR: There is no group file at: " + group)
+            sys.exit(1)
+        with open(group, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    layouts.append(line)
+
+    filepaths = []
+    if not layouts:
         # parser.error('You must supply a layout name, or just the --list option. Use -h for help.')
-        filepath = os.path.join(os.getcwd(), 'iTermocil.yml')
+        filepath = os.path.join(cwd, 'iTermocil.yml')
         if not os.path.isfile(filepath):
-            filepath = os.path.join(os.getcwd(), '.itermocil.yml')
+            filepath = os.path.join(cwd, '.itermocil.yml')
             if not os.path.isfile(filepath):
                 parser.print_help()
                 sys.exit(1)
-    else:
-        layout = args.layout_name[0]
+        filepaths.append(filepath)
+
+    for layout in layouts:
         # Sanitize input
-        layout = re.sub("[\*\?\[\]\'\"\\\$\;\&\(\)\|\^\<\>]", "", layout)
+        layout = re.sub(r'[\*\?\[\]\'"\\$\;\&\(\)\|\^\<\>]', "", layout)
 
-    # Build teamocil file path based on presence of --layout flag.
-    if args.layout:
-        filepath = os.path.join(os.getcwd(), layout)
-    else:
-        if not filepath:
+        # Build teamocil file path based on presence of --layout flag.
+        if args.layout:
+            filepath = os.path.join(cwd, layout)
+        else:
             if not os.path.isdir(itermocil_dir):
                 if not os.path.isdir(teamocil_dir):
                     print("ERROR: No ~/.itermocil or ~/.teamocil directory")
@@ -699,63 +3685,144 @@ def main():
             if not os.path.isfile(filepath) and os.path.isfile(filepath_teamocil):
                 filepath = filepath_teamocil
 
+        filepaths.append(filepath)
 
     # If --edit the try to launch editor and exit
     if args.edit:
+        import subprocess
         editor_var = os.getenv('EDITOR')
         if editor_var:
             import shlex
             editor = shlex.split(editor_var)
-            editor.append(filepath)
+            editor.extend(filepaths)
             subprocess.call(editor)
         else:
-            if not os.path.isfile(filepath):
-                subprocess.call(['touch', filepath])
-            subprocess.call(['open', filepath])
+            for filepath in filepaths:
+                if not os.path.isfile(filepath):
+                    subprocess.call(['touch', filepath])
+                subprocess.call(['open', filepath])
 
         sys.exit(0)
 
-    # Check teamocil file exists
-    if not os.path.isfile(filepath):
-        print("ERROR: There is no file at: " + filepath)
-        sys.exit(1)
+    # Check teamocil files exist
+    for filepath in filepaths:
+        if not os.path.isfile(filepath):
+            print("ERROR: There is no file at: " + filepath)
+            sys.exit(1)
 
     # If --show then output and exit()
     if args.show:
-        with open(filepath, 'r') as fin:
-            print(fin.read())
-            sys.exit(0)
+        for filepath in filepaths:
+            with open(filepath, 'r') as fin:
+                print(fin.read())
+        sys.exit(0)
 
-    # Parse the teamocil file and execute it.
-    cwd = os.getcwd()
-    instance = Itermocil(filepath, here=args.here, cwd=cwd)
+    timings = Timings(Itermocil.timing_hooks)
+
+    # The layouts' pre hooks (and ssh connections) are started by
+    # Itermocil once it has checked the layouts, so they run while the
+    # script is generated, or, for a cached script, just before it runs.
+    hooks = None
+    if not args.debug:
+        hooks = PreHooks(timings)
+        for filepath in filepaths:
+            hooks.add(layout_hooks(load_config(filepath, not args.no_cache)))
+
+    # tmux doesn't need iTerm at all. The script is built as for the
+    # newest iTerm, one window at a time, for TmuxBackend to follow.
+    if args.backend == 'tmux':
+        if args.here and not os.getenv('TMUX'):
+            print("ERROR: --here with --backend tmux only works inside tmux")
+            sys.exit(1)
+        instance = Itermocil(filepaths, here=args.here, cwd=cwd, iterm_version='tmux',
+                             use_cache=not args.no_cache, timings=timings, parallel=1,
+                             split_cwd=True, source_commands=args.source_commands,
+                             pre_hooks=hooks)
+        backend = TmuxBackend(instance)
+        if args.debug:
+            sys.stdout.write(backend.script())
+        else:
+            backend.execute()
+            report_timings(args.timings, timings)
+        sys.exit(0)
 
-    # If --debug then output the applescript. Do some rough'n'ready
-    # formatting on it.
-    if args.debug:
+    # If we've launched this exact layout before, run the script we built
+    # last time. Old iTerm scripts depend on how many panes are already
+    # open, so they can't be reused.
+    cache = None
+    cached = None
+    iterm_version = args.iterm_version
+    use_api = (args.backend == 'api' and not args.debug and not args.trace and not args.reconcile
+               and ApiBackend.available())
+    if (not args.no_cache and not args.debug and not args.trace and not args.parallel
+            and not use_api and not args.reconcile):
+        with timings.phase('version'):
+            iterm_version = iterm_version_string(iterm_version, timings).decode('utf-8')
+        major_version = major_version_of(iterm_version)
+        if major_version >= 2.9:
+            with timings.phase('cache_lookup'):
+                cache = ScriptCache()
+                key = cache.key(filepaths, args.here, cwd, major_version, args.split_cwd,
+                                args.source_commands)
+                cached = cache.get(key)
+                # A script sourcing command files that have since been
+                # removed can't be reused.
+                if cached and args.source_commands and CommandFiles().missing(cached[0]):
+                    cached = None
+
+    if cached:
+        script, compiled = cached
+        with timings.phase('pre_hooks'):
+            hooks.wait()
+        with timings.phase('execute'):
+            osascript(script, compiled, timings)
+        report_timings(args.timings, timings)
+        sys.exit(0)
 
+    # Parse the teamocil file and execute it.
+    instance = Itermocil(filepaths, here=args.here, cwd=cwd,
+                         iterm_version=iterm_version,
+                         use_cache=not args.no_cache,
+                         timings=timings,
+                         trace=args.trace,
+                         parallel=args.parallel or (1 if use_api else None),
+                         wait_timeout=None if args.fixed_delays else args.wait_timeout,
+                         poll_interval=args.poll_interval,
+                         split_cwd=args.split_cwd,
+                         source_commands=args.source_commands,
+                         pre_hooks=hooks,
+                         reconcile=args.reconcile)
+
+    # If --debug then output the applescript, laid out to be readable.
+    if args.debug:
+        print(instance.script(pretty=True))
+        if instance.parallel:
+            for num in range(1, len(instance.window_scripts) + 1):
+                print("-- window %d" % num)
+                print(instance.window_script(num, pretty=True))
+    elif cache:
         script = instance.script()
-        script = re.sub("^(\s*)", "", script, flags=re.MULTILINE)
-
-        indent = ""
-        formatted_script = []
-
-        for line in script.split("\n"):
-            if line[:8] == "end tell":
-                indent = indent[:-1]
-            if line[:4] == "tell" and line[:7] != "tell i ":
-                formatted_script.append("")
-
-            formatted_script.append(indent + line)
-
-            if line[:4] == "tell" and line[:7] != "tell i ":
-                indent += "\t"
-
-        formatted_script.append("")
-        print("\n".join(formatted_script))
+        with timings.phase('compile'):
+            compiled = cache.put(key, script, timings)
+        instance.wait_for_hooks()
+        with timings.phase('execute'):
+            osascript(script, compiled, timings)
+    elif use_api and ApiBackend(instance).execute():
+        pass
+    elif instance.parallel:
+        failed = False
+        for num, status, output, error in instance.execute():
+            if status:
+                failed = True
+                print("ERROR: window %d failed: %s" % (num, error.decode('utf-8').strip()))
+        if failed:
+            sys.exit(1)
+    elif args.trace:
+        report_trace(parse_trace(instance.execute()))
     else:
         instance.execute()
 
+    report_timings(args.timings, timings)
 
 if __name__ == '__main__':
     main()
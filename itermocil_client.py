@@ -0,0 +1,115 @@
+""" The itermocil command. If an itermocil daemon (itermocil --daemon) is
+    running, the command is handed to it; otherwise itermocil runs as
+    usual. Only what's needed to talk to the daemon is imported here, and
+    only once there's a daemon to talk to, so that handing a command over
+    (or finding there's no daemon) costs as little as possible.
+"""
+
+import os
+import sys
+
+
+def runs_here(argv):
+    """ Whether a command has to run in this process rather than the
+        daemon's: --edit starts an editor in this terminal, and tmux
+        (--backend tmux) needs this terminal's $TMUX and size, and to
+        attach it to the session. Options can be abbreviated, as argparse
+        allows (an ambiguous one is an error wherever it runs).
+    """
+
+    for i, arg in enumerate(argv):
+        name = arg.split('=', 1)[0]
+        if len(name) > 2 and any(option.startswith(name) for option in ('--daemon', '--edit')):
+            return True
+        # --backend is the only option starting --b, however abbreviated.
+        if arg.startswith('--b'):
+            if '=' in arg:
+                value = arg.split('=', 1)[1]
+            else:
+                value = argv[i + 1] if i + 1 < len(argv) else None
+            if value == 'tmux':
+                return True
+
+    return False
+
+
+def run_via_daemon(argv=None):
+    """ If an itermocil daemon (itermocil --daemon) is running, hand the
+        command to it, avoiding the cost of starting up. Returns the exit
+        status, or None if there's no daemon to talk to (or the command
+        has to run here, see runs_here). Once the daemon has the command,
+        it's never run here as well, even if the daemon's answer is lost.
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if runs_here(argv):
+        return None
+
+    base = os.getenv('ITERMOCIL_CACHE_DIR')
+    if not base:
+        base = os.path.join(os.getenv('XDG_CACHE_HOME') or
+                            os.path.join(os.path.expanduser("~"), '.cache'), 'itermocil')
+
+    path = os.path.join(base, 'daemon.sock')
+    if not os.path.exists(path):
+        return None
+
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (OSError, socket.error):
+        return None
+
+    request = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict((k, v) for k, v in os.environ.items() if k.startswith('ITERMOCIL_')),
+    }
+
+    with client:
+        try:
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        except (OSError, socket.error):
+            return None
+
+        data = b''
+        try:
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except (OSError, socket.error):
+            pass
+
+    try:
+        response = json.loads(data.decode('utf-8'))
+        stdout, stderr, status = response['stdout'], response['stderr'], response['status']
+    except (ValueError, KeyError, TypeError):
+        sys.stderr.write("itermocil: the daemon's response was lost or garbled\n")
+        return 1
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+
+    return status
+
+
+def main():
+    """ Run the itermocil command, through the daemon if there is one.
+    """
+
+    status = run_via_daemon()
+    if status is None:
+        from itermocil import main
+        main()
+    else:
+        sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,12 +9,12 @@ setup(
     author='Tom Anthony, Ruud Kamphuis, Guillaume Leclerc',
     author_email='',
     packages=find_packages(),
-    py_modules=['itermocil'],
+    py_modules=['itermocil', 'itermocil_client'],
     package_data={},
     classifiers=[],
     entry_points={
         'console_scripts': [
-            'itermocil = itermocil:main',
+            'itermocil = itermocil_client:main',
         ]
     },
     install_requires=[
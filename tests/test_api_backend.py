@@ -0,0 +1,291 @@
+""" Tests for ApiBackend against a fake iTerm: a local websocket server
+    speaking enough of iTerm's Python API protocol to set layouts up in.
+"""
+
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+try:
+    from iterm2 import api_pb2
+    from websockets.asyncio.server import unix_serve
+    from websockets.exceptions import ConnectionClosed
+except ImportError:
+    api_pb2 = None
+
+
+LAYOUT = """
+windows:
+  - name: one
+    root: /tmp
+    layout: main-vertical
+    panes:
+      - echo one-1
+      - echo one-2
+      - echo one-3
+  - name: two
+    root: /tmp
+    panes:
+      - echo two-1
+      - echo two-2
+"""
+
+
+def socket_path(home):
+    """ Where the iterm2 package looks for iTerm's API socket.
+    """
+
+    return os.path.join(home, 'Library', 'Application Support', 'iTerm2', 'private', 'socket')
+
+
+class FakeIterm(object):
+    """ A fake iTerm, listening on the API socket in a thread of its own.
+        It keeps track of its windows, tabs and sessions, and records the
+        requests it gets. Requests of the kind named by fail get a
+        response with an error status.
+    """
+
+    def __init__(self, home, fail=None):
+
+        self.path = socket_path(home)
+        self.fail = fail
+        self.requests = []
+        self.ids = 0
+        # One window, with one tab of one session, which has focus.
+        self.windows = []
+        self.new_tab(None)
+        self.ready = threading.Event()
+        self.loop = None
+        self.stop = None
+        self.thread = None
+
+    def next_id(self):
+
+        self.ids += 1
+        return self.ids
+
+    def new_tab(self, window_id):
+
+        window = [w for w in self.windows if w['id'] == window_id]
+        if not window:
+            window = [{'id': 'window-%d' % self.next_id(), 'tabs': []}]
+            self.windows.extend(window)
+        tab = {'id': self.next_id(), 'sessions': ['session-%d' % self.next_id()]}
+        window[0]['tabs'].append(tab)
+
+        return window[0], tab
+
+    def split(self, session_id):
+
+        for window in self.windows:
+            for tab in window['tabs']:
+                if session_id in tab['sessions']:
+                    new = 'session-%d' % self.next_id()
+                    tab['sessions'].insert(tab['sessions'].index(session_id) + 1, new)
+                    return new
+
+    def kinds(self, kind):
+
+        return [request for k, request in self.requests if k == kind]
+
+    def respond(self, request):
+
+        kind = request.WhichOneof('submessage')
+        message = getattr(request, kind)
+        self.requests.append((kind, message))
+
+        response = api_pb2.ServerOriginatedMessage(id=request.id)
+        body = getattr(response, kind.replace('_request', '_response'))
+        body.SetInParent()
+
+        if kind == self.fail:
+            body.status = 1
+        elif kind == 'list_sessions_request':
+            for window in self.windows:
+                w = body.windows.add(window_id=window['id'])
+                for tab in window['tabs']:
+                    t = w.tabs.add(tab_id=str(tab['id']), active_session_id=tab['sessions'][0])
+                    t.root.vertical = True
+                    for session_id in tab['sessions']:
+                        t.root.links.add().session.unique_identifier = session_id
+        elif kind == 'focus_request':
+            notification = body.notifications.add()
+            notification.window.window_status = 0
+            notification.window.window_id = self.windows[0]['id']
+        elif kind == 'create_tab_request':
+            window, tab = self.new_tab(message.window_id or None)
+            body.window_id = window['id']
+            body.tab_id = tab['id']
+            body.session_id = tab['sessions'][0]
+        elif kind == 'split_pane_request':
+            body.session_id.append(self.split(message.session))
+        elif kind == 'invoke_function_request':
+            body.success.json_result = 'null'
+
+        return response.SerializeToString()
+
+    async def handler(self, websocket):
+
+        try:
+            async for data in websocket:
+                request = api_pb2.ClientOriginatedMessage()
+                request.ParseFromString(data)
+                await websocket.send(self.respond(request))
+        except ConnectionClosed:
+            pass
+
+    def serve(self):
+
+        async def main():
+            self.loop = asyncio.get_running_loop()
+            self.stop = self.loop.create_future()
+            async with unix_serve(self.handler, self.path, subprotocols=['api.iterm2.com']):
+                self.ready.set()
+                await self.stop
+
+        asyncio.run(main())
+
+    def __enter__(self):
+
+        os.makedirs(os.path.dirname(self.path))
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        self.ready.wait(5)
+        return self
+
+    def __exit__(self, *exc):
+
+        self.loop.call_soon_threadsafe(self.stop.set_result, None)
+        self.thread.join(5)
+
+
+@unittest.skipUnless(api_pb2 is not None, "needs the iterm2 and websockets packages")
+class ApiBackendTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        # The iterm2 package finds iTerm's socket under $HOME, and skips
+        # asking iTerm (with osascript) for a cookie if it has one.
+        self.env = mock.patch.dict(os.environ, {
+            'HOME': self.tmp,
+            'ITERM2_COOKIE': 'cookie',
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+        })
+        self.env.start()
+        self.layout = os.path.join(self.tmp, 'layout.yml')
+        with open(self.layout, 'w') as f:
+            f.write(LAYOUT)
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def backend(self):
+
+        instance = itermocil.Itermocil(self.layout, iterm_version='3.4', parallel=1,
+                                       use_cache=False)
+        return itermocil.ApiBackend(instance)
+
+    def test_sends_commands_as_written(self):
+
+        project = os.path.join(self.tmp, 'My Code')
+        os.makedirs(project)
+        with open(self.layout, 'w') as f:
+            f.write('windows:\n'
+                    '  - root: ~/My Code\n'
+                    '    panes:\n'
+                    '      - pwd > out\n'
+                    '      - echo \'back\\slash "quoted"\' > out2\n')
+
+        with FakeIterm(self.tmp) as iterm:
+            self.assertTrue(self.backend().execute())
+
+        sent = [request.text for request in iterm.kinds('send_text_request')]
+        self.assertEqual(len(sent), 2)
+        for text in sent:
+            subprocess.check_call(['bash', '-c', text], cwd=self.tmp,
+                                  env=dict(os.environ, HOME=self.tmp))
+        with open(os.path.join(project, 'out')) as f:
+            self.assertEqual(f.read(), project + '\n')
+        with open(os.path.join(project, 'out2')) as f:
+            self.assertEqual(f.read(), 'back\\slash "quoted"\n')
+
+    def test_sets_layout_up(self):
+
+        with FakeIterm(self.tmp) as iterm:
+            self.assertTrue(self.backend().execute())
+
+        self.assertEqual(len(iterm.kinds('create_tab_request')), 2)
+        self.assertEqual(len(iterm.kinds('split_pane_request')), 3)
+        sent = ''.join(request.text for request in iterm.kinds('send_text_request'))
+        for pane in ['one-1', 'one-2', 'one-3', 'two-1', 'two-2']:
+            self.assertIn('echo ' + pane, sent)
+        self.assertEqual([len(tab['sessions']) for tab in iterm.windows[0]['tabs']],
+                         [1, 3, 2])
+
+    def test_falls_back_if_it_cannot_connect(self):
+
+        # A socket file nothing is listening on.
+        path = socket_path(self.tmp)
+        os.makedirs(os.path.dirname(path))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.close()
+
+        with mock.patch('sys.stderr'):
+            self.assertFalse(self.backend().execute())
+
+    def test_falls_back_if_it_fails_before_changing_anything(self):
+
+        with FakeIterm(self.tmp, fail='notification_request') as iterm:
+            self.assertFalse(self.backend().execute())
+
+        self.assertEqual(iterm.kinds('create_tab_request'), [])
+
+    def test_stops_if_it_fails_after_changing_something(self):
+
+        with FakeIterm(self.tmp, fail='split_pane_request') as iterm:
+            with mock.patch('sys.stdout'):
+                with self.assertRaises(SystemExit) as raised:
+                    self.backend().execute()
+
+        self.assertEqual(raised.exception.code, 1)
+        self.assertTrue(iterm.kinds('create_tab_request'))
+
+    def test_main_does_not_make_windows_again_with_applescript(self):
+
+        # osascript would be run to fall back; it records that it was.
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin_dir)
+        log = os.path.join(self.tmp, 'osascript.log')
+        with open(os.path.join(bin_dir, 'osascript'), 'w') as f:
+            f.write('#!/bin/sh\ncat >> %s\n' % log)
+        os.chmod(os.path.join(bin_dir, 'osascript'), 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+        with FakeIterm(self.tmp, fail='split_pane_request') as iterm:
+            with mock.patch('sys.stdout'):
+                with self.assertRaises(SystemExit):
+                    itermocil.main(['--backend', 'api', '--layout', self.layout,
+                                    '--iterm-version', '3.4', '--no-cache'], cwd=self.tmp)
+
+        self.assertTrue(iterm.kinds('create_tab_request'))
+        self.assertFalse(os.path.exists(log))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+""" Tests for the cache of generated scripts (itermocil.ScriptCache): what
+    its keys depend on, and that its hit counts are never seen half
+    written.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+
+class ScriptCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.cache = itermocil.ScriptCache(os.path.join(self.tmp, 'scripts'))
+        self.layout = os.path.join(self.tmp, 'layout.yml')
+        with open(self.layout, 'w') as f:
+            f.write('windows:\n  - panes:\n      - echo hi\n')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp)
+
+    def key(self, path=None, **options):
+
+        return self.cache.key([path or self.layout], False, self.tmp, 3, **options)
+
+    def test_key(self):
+
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        self.assertNotEqual(self.key(split_cwd=True), key)
+
+        # The same layout somewhere else has its own panes' tags and
+        # startup directories.
+        os.mkdir(os.path.join(self.tmp, 'elsewhere'))
+        elsewhere = os.path.join(self.tmp, 'elsewhere', 'layout.yml')
+        shutil.copy(self.layout, elsewhere)
+        self.assertNotEqual(self.key(elsewhere), key)
+
+        # A change to itermocil makes scripts again.
+        with mock.patch.object(itermocil.ScriptCache, 'generator', return_value='changed'):
+            self.assertNotEqual(self.key(), key)
+
+    def test_generator_is_the_source(self):
+
+        import hashlib
+
+        with open(itermocil.__file__, 'rb') as f:
+            self.assertEqual(itermocil.ScriptCache.generator(), hashlib.sha1(f.read()).hexdigest())
+
+    def test_counts_are_never_half_written(self):
+
+        stats = os.path.join(self.cache.path, 'stats.json')
+        done = threading.Event()
+        errors = []
+
+        def read():
+            while not done.is_set():
+                try:
+                    with open(stats) as f:
+                        json.load(f)
+                except (IOError, OSError):
+                    pass
+                except ValueError as e:
+                    errors.append(e)
+
+        def count():
+            for _ in range(100):
+                self.cache.get('missing')
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        counters = [threading.Thread(target=count) for _ in range(4)]
+        for thread in counters:
+            thread.start()
+        for thread in counters:
+            thread.join()
+        done.set()
+        reader.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(self.cache.stats()['misses'], 0)
+        self.assertEqual(sorted(os.listdir(self.cache.path)), ['stats.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
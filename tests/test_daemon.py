@@ -0,0 +1,254 @@
+""" Tests for the daemon (itermocil --daemon) and the client in the
+    itermocil script: which commands the client keeps to itself, that it
+    never runs a command the daemon was handed, that the daemon's socket
+    is only for its user, and that it runs commands at the same time,
+    each getting only what it printed.
+"""
+
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import itermocil  # noqa: E402
+import itermocil_client  # noqa: E402
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {'ITERMOCIL_CACHE_DIR': self.tmp})
+        self.env.start()
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_runs_here(self):
+
+        for argv in [['--daemon'], ['--daem'], ['--edit', 'x'], ['--edi', 'x'], ['x', '--ed'],
+                     ['--backend', 'tmux'], ['--backend=tmux'], ['--ba', 'tmux']]:
+            with self.subTest(argv=argv):
+                self.assertTrue(itermocil_client.runs_here(argv))
+
+        for argv in [['--list'], ['--layout', 'x.yml'], ['--backend', 'api'], ['--', 'x'],
+                     ['--debug', 'x'], ['edit']]:
+            with self.subTest(argv=argv):
+                self.assertFalse(itermocil_client.runs_here(argv))
+
+    def fake_daemon(self, response):
+        """ Listen where the daemon would, answering one request with
+            response. Returns the requests received.
+        """
+
+        received = []
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(os.path.join(self.tmp, 'daemon.sock'))
+        server.listen(1)
+
+        def answer():
+            conn, _ = server.accept()
+            with conn:
+                received.append(conn.recv(65536))
+                conn.sendall(response)
+            server.close()
+
+        threading.Thread(target=answer, daemon=True).start()
+        return received
+
+    def test_no_daemon(self):
+
+        self.assertIsNone(itermocil_client.run_via_daemon(['--list']))
+
+    def test_never_reruns_a_command_it_handed_over(self):
+
+        for response in [b'', b'{"stdout": "', b'{}', b'[1]']:
+            with self.subTest(response=response):
+                received = self.fake_daemon(response)
+                with mock.patch('sys.stderr') as stderr:
+                    self.assertEqual(itermocil_client.run_via_daemon(['--list']), 1)
+                self.assertTrue(received)
+                self.assertIn('daemon', ''.join(c[0][0] for c in stderr.write.call_args_list))
+                os.remove(os.path.join(self.tmp, 'daemon.sock'))
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'daemon.sock')
+        self.env = dict(os.environ, ITERMOCIL_CACHE_DIR=self.tmp, ITERMOCIL_ITERM_VERSION='3.4')
+        self.daemons = []
+
+    def tearDown(self):
+
+        for daemon in self.daemons:
+            daemon.terminate()
+            daemon.wait()
+            daemon.stdout.close()
+        shutil.rmtree(self.tmp)
+
+    def start(self):
+
+        daemon = subprocess.Popen([sys.executable, os.path.join(ROOT, 'itermocil.py'), '--daemon'],
+                                  env=self.env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.daemons.append(daemon)
+        for _ in range(500):
+            if daemon.poll() is not None:
+                break
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self.path)
+                break
+            except OSError:
+                time.sleep(0.01)
+
+        return daemon
+
+    def test_socket_is_only_for_its_user(self):
+
+        self.start()
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+        # The client gets its answers.
+        output = subprocess.check_output([sys.executable, os.path.join(ROOT, 'itermocil'),
+                                          '--version'], env=self.env)
+        self.assertTrue(output.strip())
+
+    def test_leaves_a_running_daemon_alone(self):
+
+        self.start()
+        second = self.start()
+        self.assertEqual(second.wait(10), 1)
+        self.assertIn(b'already listening', second.stdout.read())
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_replaces_a_stale_socket(self):
+
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+
+        daemon = self.start()
+        self.assertIsNone(daemon.poll())
+
+    def test_wont_remove_other_files(self):
+
+        with open(self.path, 'w') as f:
+            f.write('not a socket')
+
+        self.assertEqual(self.start().wait(10), 1)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'not a socket')
+
+
+class RequestsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        self.requests = itermocil.Requests()
+
+    def tearDown(self):
+
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def test_runs_commands_at_once(self):
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def main(argv, cwd):
+            print('output of ' + argv[0])
+            if argv[0] == 'launch':
+                started.set()
+                release.wait(10)
+            sys.stderr.write('errors of %s\n' % argv[0])
+            sys.exit(3 if argv[0] == 'launch' else 0)
+
+        responses = {}
+
+        def handle(name):
+            responses[name] = self.requests.handle({'argv': [name], 'cwd': '/'})
+
+        with mock.patch.object(itermocil, 'main', main):
+            launch = threading.Thread(target=handle, args=('launch',))
+            launch.start()
+            self.assertTrue(started.wait(10))
+            # Answered while the launch is still running.
+            handle('--list')
+            self.assertTrue(launch.is_alive())
+            release.set()
+            launch.join()
+
+        for name, status in [('launch', 3), ('--list', 0)]:
+            self.assertEqual(responses[name], {'stdout': 'output of %s\n' % name,
+                                               'stderr': 'errors of %s\n' % name,
+                                               'status': status})
+
+    def test_settings_for_the_length_of_a_command(self):
+
+        seen = []
+
+        def main(argv, cwd):
+            seen.append(os.environ.get('ITERMOCIL_TEST_SETTING'))
+
+        with mock.patch.object(itermocil, 'main', main):
+            self.requests.handle({'argv': [], 'cwd': '/', 'env': {'ITERMOCIL_TEST_SETTING': 'x',
+                                                                  'OTHER': 'y'}})
+        self.assertEqual(seen, ['x'])
+        self.assertNotIn('ITERMOCIL_TEST_SETTING', os.environ)
+        self.assertNotIn('OTHER', os.environ)
+
+
+class MemoTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {'ITERMOCIL_CACHE_DIR': self.tmp})
+        self.env.start()
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_keeps_only_the_latest_layout(self):
+
+        path = os.path.join(self.tmp, 'layout.yml')
+        for n in range(5):
+            with open(path, 'w') as f:
+                f.write('windows:\n' + '  - name: w\n' * (n + 1))
+            os.utime(path, ns=(n * 10 ** 9, n * 10 ** 9))
+            itermocil.load_config(path)
+
+        stamps = [k for k in itermocil._memo if isinstance(k, tuple) and k[0] == path]
+        self.assertEqual(len(stamps), 1)
+
+    def test_bounded(self):
+
+        with mock.patch.object(itermocil, 'MEMO_SIZE', 10):
+            for n in range(50):
+                itermocil.remember(('test', n), n)
+            self.assertLessEqual(len(itermocil._memo), 10)
+            self.assertIn(('test', 49), itermocil._memo)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+""" Tests that the quick commands (which shell completion and editors run
+    often) stay quick, run as they are installed, through the itermocil
+    script and its daemon client in a process of their own: they mustn't
+    import anything slow, run osascript, or take longer to import than
+    their budget (see benchmark.py imports).
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from benchmark import IMPORT_BUDGETS, SLOW_MODULES, TEST_LAYOUTS, import_times  # noqa: E402
+
+# Budgets are multiplied by this, for slow machines.
+SCALE = float(os.getenv('ITERMOCIL_IMPORT_BUDGET_SCALE', '1'))
+
+
+class ImportTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.tmp = tempfile.mkdtemp()
+        cls.marker = os.path.join(cls.tmp, 'osascript-was-run')
+
+        # An osascript that leaves a mark if anything runs it.
+        bin_dir = os.path.join(cls.tmp, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'osascript'), 'w') as f:
+            f.write('#!/bin/sh\ntouch %s\n' % cls.marker)
+        os.chmod(os.path.join(bin_dir, 'osascript'), 0o755)
+
+        # Some layouts to list, already indexed as they would be after
+        # the first --list.
+        home = os.path.join(cls.tmp, 'home')
+        os.makedirs(os.path.join(home, '.itermocil'))
+        for path in TEST_LAYOUTS:
+            shutil.copy(path, os.path.join(home, '.itermocil'))
+
+        cls.env = dict(os.environ, ITERMOCIL_CACHE_DIR=os.path.join(cls.tmp, 'cache'),
+                       PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                       EDITOR='true', HOME=home)
+        cls.env.pop('ITERMOCIL_ITERM_VERSION', None)
+        # Compiled once (by the --list below), as an installed module would be.
+        cls.env.pop('PYTHONDONTWRITEBYTECODE', None)
+        cls.env['PYTHONPYCACHEPREFIX'] = os.path.join(cls.tmp, 'pycache')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'itermocil'), '--list'],
+                              env=cls.env, stdout=subprocess.DEVNULL)
+
+        # The best of a few runs of each, to smooth out noise.
+        def best(command):
+            runs = [import_times(command, cls.env) for _ in range(3)]
+            return dict((name, min(r.get(name, 0) for r in runs)) for name in runs[0])
+
+        cls.interpreter = best(['-c', 'pass'])
+        cls.times = {}
+        cls.ran_osascript = set()
+        for command, _, _ in IMPORT_BUDGETS:
+            cls.times[command[0]] = best([os.path.join(ROOT, 'itermocil')] + command)
+            if os.path.exists(cls.marker):
+                cls.ran_osascript.add(command[0])
+                os.remove(cls.marker)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.tmp)
+
+    def test_no_slow_modules(self):
+
+        for command, _, allowed in IMPORT_BUDGETS:
+            with self.subTest(command=command[0]):
+                times = self.times[command[0]]
+                # The itermocil module itself was run, not just the client.
+                self.assertIn('itermocil', times)
+                self.assertEqual([m for m in SLOW_MODULES if m in times and m not in allowed], [])
+
+    def test_no_osascript(self):
+
+        self.assertEqual(self.ran_osascript, set())
+
+    def test_budgets(self):
+
+        for command, budget, _ in IMPORT_BUDGETS:
+            with self.subTest(command=command[0]):
+                extra = sum(seconds for name, seconds in self.times[command[0]].items()
+                            if name not in self.interpreter) * 1000
+                self.assertLessEqual(extra, budget * SCALE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+""" Tests for the keystrokes old iTerm (before 2.9) is driven with
+    (itermocil.KeystrokePlanner), played against a model of its panes:
+    they make the layout plan's splits and leave focus where asked, reach
+    every pane by the shortest route, and need no more keystrokes than
+    they did.
+"""
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+LAYOUTS = ['even-horizontal', 'even-vertical', 'main-vertical', 'main-vertical-flipped',
+           'main-horizontal', 'double-main-horizontal', 'double-main-vertical', 'tiled',
+           '3_columns', 'grid']
+
+# The most keystrokes each layout of 16 panes may take to arrange, and
+# then to focus the pane that takes the most keystrokes to reach.
+BUDGETS = {
+    'even-horizontal': 24, 'even-vertical': 24, 'main-vertical': 24,
+    'main-vertical-flipped': 26, 'main-horizontal': 24, 'double-main-horizontal': 25,
+    'double-main-vertical': 24, 'tiled': 28, '3_columns': 26, 'grid': 33,
+}
+
+
+def replay(nodes, plan=None):
+    """ Play old iTerm's keystrokes against a model of its panes, which
+        are cycled through (by Cmd-] and Cmd-[) in the order they are
+        numbered, and moved between with Cmd-Opt-<arrow> where there is
+        one pane alongside. Starts with one pane, or the finished layout
+        of plan. Returns the splits made, the final pane order and which
+        pane has focus at the end.
+    """
+
+    directions = dict((code, d) for d, code in itermocil.KeystrokePlanner.arrows.items())
+    if plan is None:
+        order = [1]
+        geometry = {1: (0.0, 0.0, 1.0, 1.0)}
+    else:
+        order = list(range(1, len(plan) + 2))
+        geometry = itermocil.plan_geometry(plan)
+    focus = 1
+    splits = []
+
+    for node in nodes:
+        if not isinstance(node, itermocil.Keystroke):
+            continue
+        if node.key in (']', '['):
+            step = 1 if node.key == ']' else -1
+            focus = order[(order.index(focus) + step) % len(order)]
+        elif node.key_code in directions:
+            other = itermocil.neighbour(geometry, focus, directions[node.key_code])
+            if other is None:
+                raise AssertionError('no single pane %s of pane %d'
+                                     % (directions[node.key_code], focus))
+            focus = other
+        elif node.key in ('d', 'D'):
+            child = len(order) + 1
+            split = 'vertical' if node.key == 'd' else 'horizontal'
+            splits.append((focus, child, split))
+            order.insert(order.index(focus) + 1, child)
+            itermocil.split_geometry(geometry, focus, child, split)
+            focus = child
+        else:
+            raise AssertionError('unexpected keystroke %r' % node.key)
+
+    return splits, order, focus
+
+
+def shape(steps):
+    """ Old iTerm numbers panes in the order they're created, so compare
+        the shape of the splits rather than the numbers.
+    """
+
+    created = dict((child, n + 2) for n, (_, child, _) in enumerate(steps))
+    created[1] = 1
+    return [(created[p], created[c], d) for p, c, d in steps]
+
+
+class KeystrokeTest(unittest.TestCase):
+
+    def test_arrange_makes_the_plans_splits(self):
+
+        for layout in LAYOUTS:
+            for panes in range(1, 65):
+                with self.subTest(layout=layout, panes=panes):
+                    plan = itermocil.layout_plan(layout, panes)
+                    splits, order, focus = replay(itermocil.KeystrokePlanner(plan).arrange())
+                    self.assertEqual(shape(splits), shape(plan))
+                    self.assertEqual(len(order), panes)
+                    self.assertEqual(focus, 1)
+
+    def test_navigate_takes_the_shortest_route(self):
+
+        for layout in LAYOUTS:
+            for panes in [2, 5, 16, 33]:
+                plan = itermocil.layout_plan(layout, panes)
+                for pane in range(1, panes + 1):
+                    with self.subTest(layout=layout, panes=panes, pane=pane):
+                        keystrokes = itermocil.KeystrokePlanner(plan).navigate(1, pane)
+                        self.assertEqual(replay(keystrokes, plan)[2], pane)
+                        # Never more than cycling round, either way.
+                        self.assertLessEqual(len(keystrokes), min(pane - 1, panes - pane + 1))
+
+    def test_keystroke_budgets(self):
+
+        for layout, budget in sorted(BUDGETS.items()):
+            with self.subTest(layout=layout):
+                plan = itermocil.layout_plan(layout, 16)
+                arrange = itermocil.KeystrokePlanner(plan).arrange()
+                focus = max((itermocil.KeystrokePlanner(plan).navigate(1, p)
+                             for p in range(1, 17)), key=len)
+                count, seconds = itermocil.KeystrokePlanner.estimate(arrange + focus)
+                self.assertLessEqual(count, budget)
+                self.assertAlmostEqual(seconds, count * itermocil.KeystrokePlanner.keystroke_seconds)
+
+    def test_estimate_includes_delays(self):
+
+        nodes = [itermocil.Keystroke('d'), itermocil.Delay(2), itermocil.Keystroke(']')]
+        self.assertEqual(itermocil.KeystrokePlanner.estimate(nodes),
+                         (2, 2 + 2 * itermocil.KeystrokePlanner.keystroke_seconds))
+
+
+if __name__ == '__main__':
+    unittest.main()
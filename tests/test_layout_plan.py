@@ -0,0 +1,131 @@
+""" Property tests for layout plans (itermocil.layout_plan): for every
+    layout and every pane count up to 256, and grids of random shapes,
+    the plan makes the right number of panes, numbered in the order iTerm
+    cycles through them, each split of a pane that exists, covering the
+    whole window; and new iTerm's scripts make exactly the plan's splits.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from fractions import Fraction
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+LAYOUTS = ['even-horizontal', 'even-vertical', 'main-vertical', 'main-vertical-flipped',
+           'main-horizontal', 'double-main-horizontal', 'double-main-vertical', 'tiled',
+           '3_columns', 'grid']
+
+MAX_PANES = 256
+
+
+def cases():
+    """ Every layout with 1 to MAX_PANES panes, and grids of random sizes
+        with random numbers of columns or rows.
+    """
+
+    for layout in LAYOUTS:
+        for panes in range(1, MAX_PANES + 1):
+            yield layout, panes, None, None
+
+    rng = random.Random(14)
+    for _ in range(500):
+        panes = rng.randint(1, MAX_PANES)
+        if rng.random() < 0.5:
+            yield 'grid', panes, rng.randint(1, panes), None
+        else:
+            yield 'grid', panes, None, rng.randint(1, panes)
+
+
+class LayoutPlanTest(unittest.TestCase):
+
+    def test_plans_are_valid(self):
+
+        for layout, panes, columns, rows in cases():
+            with self.subTest(layout=layout, panes=panes, columns=columns, rows=rows):
+                plan = itermocil.layout_plan(layout, panes, columns, rows)
+                # Each split of a pane that exists, in a known direction,
+                # making a new pane; the right number of panes at the end,
+                # in the order they're numbered.
+                itermocil.check_plan(plan, panes)
+                self.assertEqual(len(plan), panes - 1)
+
+    def test_panes_cover_the_window(self):
+
+        for layout, panes, columns, rows in cases():
+            with self.subTest(layout=layout, panes=panes, columns=columns, rows=rows):
+                geometry = itermocil.plan_geometry(itermocil.layout_plan(layout, panes,
+                                                                         columns, rows))
+                self.assertEqual(sorted(geometry), list(range(1, panes + 1)))
+                self.assertTrue(all(w > 0 and h > 0 for _, _, w, h in geometry.values()))
+                self.assertEqual(sum(Fraction(w) * Fraction(h)
+                                     for _, _, w, h in geometry.values()), 1)
+
+    def test_grid_rows_fit_their_columns(self):
+
+        for layout, panes, columns, rows in cases():
+            if layout != 'grid' or not columns:
+                continue
+            with self.subTest(panes=panes, columns=columns):
+                geometry = itermocil.plan_geometry(itermocil.layout_plan(layout, panes, columns))
+                tops = {}
+                for x, y, w, h in geometry.values():
+                    tops[y] = tops.get(y, 0) + 1
+                self.assertTrue(all(count <= columns for count in tops.values()))
+
+    def test_plans_are_memoized(self):
+
+        plan = itermocil.layout_plan('tiled', 16)
+        self.assertIs(itermocil.layout_plan('tiled', 16), plan)
+        self.assertIsNot(itermocil.layout_plan('tiled', 17), plan)
+
+    def test_unknown_layout(self):
+
+        with self.assertRaises(ValueError):
+            itermocil.layout_plan('spiral', 4)
+
+
+class ScriptPlanTest(unittest.TestCase):
+    """ New iTerm's scripts, for whole layouts, follow the plans.
+    """
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ,
+                                   {'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache')})
+        self.env.start()
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_scripts_make_the_plans_splits(self):
+
+        for layout in LAYOUTS:
+            for panes in [1, 2, 3, 5, 16, 33]:
+                with self.subTest(layout=layout, panes=panes):
+                    path = os.path.join(self.tmp, 'layout.yml')
+                    with open(path, 'w') as f:
+                        json.dump({'windows': [{'root': '/tmp', 'layout': layout, 'panes': [
+                            'echo %d' % p for p in range(panes)]}]}, f)
+
+                    instance = itermocil.Itermocil(path, iterm_version='3.4')
+                    nodes = instance.nodes()
+                    itermocil.validate(nodes)
+                    splits = [(n.parent, n.child, n.direction) for n in nodes[0].body
+                              if isinstance(n, itermocil.Split)]
+                    self.assertEqual(tuple(splits), itermocil.layout_plan(layout, panes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+""" Tests for --list and --complete, which answer from the index of the
+    layouts in ~/.itermocil and ~/.teamocil (itermocil.LayoutIndex).
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+
+class ListTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {
+            'HOME': self.tmp,
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+        })
+        self.env.start()
+
+        for d, names in [('.itermocil', ['web', 'api']), ('.teamocil', ['web', 'docs'])]:
+            os.makedirs(os.path.join(self.tmp, d))
+            for name in names:
+                with open(os.path.join(self.tmp, d, name + '.yml'), 'w') as f:
+                    f.write('# %s in %s\nwindows:\n  - panes:\n      - echo hi\n' % (name, d))
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def run_main(self, *args):
+
+        out = io.StringIO()
+        with redirect_stdout(out):
+            with self.assertRaises(SystemExit):
+                itermocil.main(list(args), cwd=self.tmp)
+
+        return out.getvalue().splitlines()
+
+    def test_lists_every_directory(self):
+
+        # Each directory's layouts, even one named like a layout in
+        # ~/.itermocil (which is the one launched).
+        self.assertEqual(self.run_main('--list'), [
+            os.path.join(self.tmp, '.itermocil'), '  api', '  web',
+            os.path.join(self.tmp, '.teamocil'), '  docs', '  web'])
+        self.assertEqual(self.run_main('--list', 'we'), [
+            os.path.join(self.tmp, '.itermocil'), '  web',
+            os.path.join(self.tmp, '.teamocil'), '  web'])
+
+    def test_completes_each_name_once(self):
+
+        self.assertEqual(self.run_main('--complete', ''), ['api', 'docs', 'web'])
+        self.assertEqual(self.run_main('--complete', 'w'), ['web'])
+
+
+if __name__ == '__main__':
+    unittest.main()
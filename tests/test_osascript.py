@@ -0,0 +1,442 @@
+""" Tests for how itermocil drives osascript, against a stub osascript on
+    PATH which logs every run and answers as iTerm would: how often it's
+    spawned (the version cache), replaying traced scripts (--trace), and
+    running windows' scripts in order and no more at once than asked
+    (--parallel), and what the scripts type into panes.
+"""
+
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+
+# Stands in for osascript. Each run is logged to $STUB_LOG (as a line
+# of JSON, with the script and when it started and ended). It answers the version query
+# with $STUB_ITERM_VERSION, --reconcile's query for open sessions with
+# the canned ones in $STUB_STATE, the parallel mode's tab script with an
+# id for each tab, and a traced script with each of its steps' labels,
+# 25ms apart. Window scripts take $STUB_DELAY seconds, and fail for the
+# session ids in $STUB_FAIL.
+STUB_OSASCRIPT = r"""#!%(python)s
+import json, os, re, sys, time
+
+start = time.time()
+script = sys.stdin.read() if sys.argv[1:] == ['-'] else open(sys.argv[1]).read()
+entry = {'kind': 'script', 'script': script}
+status = 0
+
+if 'get version of application' in script:
+    entry['kind'] = 'version'
+    print(os.environ['STUB_ITERM_VERSION'])
+elif '(variable named "user.itermocil")' in script:
+    entry['kind'] = 'sessions'
+    with open(os.environ['STUB_STATE']) as f:
+        sys.stdout.write(f.read())
+elif 'set itermocil_ids to ""' in script:
+    entry['kind'] = 'tabs'
+    for num in range(1, script.count('set itermocil_ids to itermocil_ids') + 1):
+        print('tab-%%d' %% num)
+elif 'set session_id to "' in script:
+    entry['kind'] = 'window'
+    entry['session'] = re.search(r'set session_id to "([^"]*)"', script).group(1)
+    entry['windows'] = re.findall(r'echo window-(\d+)', script)
+    time.sleep(float(os.environ.get('STUB_DELAY', '0')))
+    if entry['session'] in os.environ.get('STUB_FAIL', '').split():
+        sys.stderr.write('stub failure in %%s\n' %% entry['session'])
+        status = 1
+elif 'itermocil_trace' in script:
+    entry['kind'] = 'trace'
+    entry['labels'] = re.findall(r'itermocil_trace & "([^"]*)"', script)
+    for num, label in enumerate(entry['labels']):
+        print('%%s\t%%.6f' %% (label, 1000 + num * 0.025))
+
+entry['start'] = start
+entry['end'] = time.time()
+with open(os.environ['STUB_LOG'], 'a') as f:
+    f.write(json.dumps(entry) + '\n')
+sys.exit(status)
+"""
+
+
+def layout(windows, panes=2):
+    """ A layout with the given number of windows and panes, each pane
+        echoing its window's number.
+    """
+
+    lines = ['windows:']
+    for num in range(1, windows + 1):
+        lines += ['  - name: window-%d' % num, '    root: /tmp', '    panes:']
+        lines += ['      - echo window-%d pane-%d' % (num, pane) for pane in range(1, panes + 1)]
+
+    return '\n'.join(lines) + '\n'
+
+
+class StubOsascriptTest(unittest.TestCase):
+    """ Puts the stub osascript (and an osacompile that always fails, so
+        scripts are never compiled) on PATH, with a fresh cache directory
+        and a stand-in iTerm app bundle.
+    """
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin_dir)
+        for name, content in [('osascript', STUB_OSASCRIPT % {'python': sys.executable}),
+                              ('osacompile', '#!/bin/sh\nexit 1\n')]:
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            os.chmod(path, 0o755)
+
+        self.log = os.path.join(self.tmp, 'osascript.log')
+        self.app = os.path.join(self.tmp, 'iTerm.app')
+        os.makedirs(os.path.join(self.app, 'Contents'))
+        self.upgrade_iterm('3.4.0')
+
+        self.env = mock.patch.dict(os.environ, {
+            'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+            'STUB_LOG': self.log,
+        })
+        self.env.start()
+        os.environ.pop('ITERMOCIL_ITERM_VERSION', None)
+        self.apps = mock.patch.object(itermocil, 'ITERM_APP_PATHS', [self.app])
+        self.apps.start()
+
+    def tearDown(self):
+
+        self.apps.stop()
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def upgrade_iterm(self, version):
+        """ Install a different iTerm (as far as its Info.plist goes).
+        """
+
+        with open(os.path.join(self.app, 'Contents', 'Info.plist'), 'w') as f:
+            f.write('<plist><string>%s</string></plist>\n' % version)
+        os.environ['STUB_ITERM_VERSION'] = version
+
+    def write_layout(self, content, name='layout.yml'):
+
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+
+        return path
+
+    def launch(self, *args):
+        """ Run itermocil as a new process would (forgetting what it had
+            found out in memory), returning its exit status and output.
+        """
+
+        itermocil._memo.clear()
+        out = io.StringIO()
+        status = 0
+        with redirect_stdout(out):
+            try:
+                itermocil.main(list(args), cwd=self.tmp)
+            except SystemExit as e:
+                status = e.code or 0
+
+        return status, out.getvalue()
+
+    def runs(self, kind=None):
+        """ The stub's log of runs (of one kind, if given), in order.
+        """
+
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            entries = [json.loads(line) for line in f]
+
+        return [e for e in entries if kind is None or e['kind'] == kind]
+
+
+class VersionCacheTest(StubOsascriptTest):
+
+    def test_asks_for_the_version_once(self):
+
+        path = self.write_layout(layout(1))
+        for _ in range(3):
+            self.assertEqual(self.launch('--layout', path)[0], 0)
+
+        self.assertEqual(len(self.runs('version')), 1)
+        # The first launch asks for the version and runs the script; the
+        # others only run the (cached) script.
+        self.assertEqual(len(self.runs()), 4)
+
+    def test_asks_again_once_iterm_changes(self):
+
+        path = self.write_layout(layout(1))
+        self.launch('--layout', path)
+        self.upgrade_iterm('3.5.0beta')
+        self.launch('--layout', path)
+        self.launch('--layout', path)
+
+        self.assertEqual(len(self.runs('version')), 2)
+
+    def test_override_never_asks(self):
+
+        path = self.write_layout(layout(1))
+        for _ in range(2):
+            self.launch('--layout', path, '--iterm-version', '3.4')
+        os.environ['ITERMOCIL_ITERM_VERSION'] = '3.4'
+        self.launch('--layout', path, '--no-cache')
+
+        self.assertEqual(self.runs('version'), [])
+        self.assertEqual(len(self.runs()), 3)
+
+    def test_debug_with_override_never_spawns(self):
+
+        path = self.write_layout(layout(2))
+        status, out = self.launch('--debug', '--layout', path, '--iterm-version', '3.4')
+
+        self.assertEqual(status, 0)
+        self.assertIn('tell application "iTerm"', out)
+        self.assertEqual(self.runs(), [])
+
+
+class TraceTest(StubOsascriptTest):
+
+    def test_reports_each_step(self):
+
+        path = self.write_layout(layout(2, panes=3))
+        status, out = self.launch('--trace', '--layout', path, '--iterm-version', '3.4')
+
+        self.assertEqual(status, 0)
+        labels = self.runs('trace')[0]['labels']
+        for step in ['create tab for window 1 of layout.yml', 'split pane_2 vertically from pane_1',
+                     'write text to pane 3', 'create tab for window 2']:
+            self.assertIn(step, labels)
+
+        # Each step after the first took the 25ms the stub left between them.
+        lines = out.splitlines()
+        self.assertEqual(len(lines), len(labels))
+        for line, label in zip(lines, labels[1:]):
+            self.assertEqual(line.split(), label.split() + ['25.0ms'])
+        self.assertEqual(lines[-1].split(), ['total', '%.1fms' % ((len(labels) - 1) * 25)])
+
+    def test_timestamps_in_the_script(self):
+
+        # The steps are timed by the script itself, not a shell per step.
+        path = self.write_layout(layout(2, panes=3))
+        self.launch('--trace', '--layout', path, '--iterm-version', '3.4')
+        script = self.runs('trace')[0]['script']
+        self.assertTrue(script.startswith('use framework "Foundation"'))
+        self.assertNotIn('do shell script', script)
+        self.assertEqual(script.count('timeIntervalSinceNow()'),
+                         len(self.runs('trace')[0]['labels']))
+
+    def test_decimal_commas(self):
+
+        self.assertEqual(itermocil.parse_trace('start\t0,5\nsplit\t0,75\n'), [('split', 0.25)])
+
+    def test_reports_no_output(self):
+
+        self.assertEqual(itermocil.parse_trace(b''), [])
+        out = io.StringIO()
+        with redirect_stdout(out):
+            itermocil.report_trace([])
+        self.assertIn('No trace output', out.getvalue())
+
+
+class ParallelTest(StubOsascriptTest):
+
+    def setUp(self):
+
+        super(ParallelTest, self).setUp()
+        os.environ['STUB_DELAY'] = '0.3'
+        self.path = self.write_layout(layout(5))
+
+    def test_windows_go_in_their_own_tabs(self):
+
+        status, _ = self.launch('--layout', self.path, '--parallel', '2', '--iterm-version', '3.4')
+
+        self.assertEqual(status, 0)
+        runs = self.runs()
+        self.assertEqual(runs[0]['kind'], 'tabs')
+        windows = runs[1:]
+        self.assertEqual(len(windows), 5)
+        # The tabs are all made first, and each window's script sets up
+        # that window, in its own tab.
+        self.assertTrue(all(w['start'] >= runs[0]['end'] for w in windows))
+        for w in windows:
+            self.assertEqual(w['session'], 'tab-%s' % w['windows'][0])
+            self.assertEqual(set(w['windows']), set(w['windows'][:1]))
+
+    def test_runs_no_more_at_once_than_asked(self):
+
+        for workers in [1, 2, 3]:
+            if os.path.exists(self.log):
+                os.remove(self.log)
+            self.launch('--layout', self.path, '--parallel', str(workers),
+                        '--iterm-version', '3.4')
+
+            events = []
+            for w in self.runs('window'):
+                events += [(w['start'], 1), (w['end'], -1)]
+            running = peak = 0
+            for _, change in sorted(events):
+                running += change
+                peak = max(peak, running)
+            self.assertEqual(peak, workers)
+
+    def test_reports_each_failed_window(self):
+
+        os.environ['STUB_FAIL'] = 'tab-2 tab-4'
+        status, out = self.launch('--layout', self.path, '--parallel', '3',
+                                  '--iterm-version', '3.4')
+
+        self.assertEqual(status, 1)
+        self.assertEqual(out.splitlines(), ['ERROR: window 2 failed: stub failure in tab-2',
+                                            'ERROR: window 4 failed: stub failure in tab-4'])
+        # The other windows were still set up.
+        self.assertEqual(len(self.runs('window')), 5)
+
+
+class ReconcileTest(StubOsascriptTest):
+
+    def setUp(self):
+
+        super(ReconcileTest, self).setUp()
+        self.state = os.environ['STUB_STATE'] = os.path.join(self.tmp, 'state')
+        self.serve([])
+        self.path = self.write_layout(layout(3, panes=3))
+
+    def serve(self, tags):
+        """ Have iTerm report a session for each tag as open.
+        """
+
+        with open(self.state, 'w') as f:
+            for num, tag in enumerate(tags):
+                f.write('session-%d\t%s\n' % (num, tag))
+
+    def reconcile(self, path=None):
+        """ Launch with --reconcile, returning what the script made: how
+            many tabs and splits, and the tags of the panes typed into.
+        """
+
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        status, out = self.launch('--reconcile', '--layout', path or self.path,
+                                  '--iterm-version', '3.4')
+        self.assertEqual(status, 0, out)
+        self.assertEqual(len(self.runs('sessions')), 1)
+
+        script = ''.join(run['script'] for run in self.runs('script'))
+        return {
+            'tabs': script.count('create tab'),
+            'splits': len(re.findall(r'split (?:vertical|horizontal)ly', script)),
+            'tags': re.findall(r'set variable named "user.itermocil" to "([^"]*)"', script),
+        }
+
+    def test_nothing_open_makes_everything(self):
+
+        made = self.reconcile()
+        self.assertEqual((made['tabs'], made['splits'], len(made['tags'])), (3, 6, 9))
+        self.assertEqual(len(set(made['tags'])), 9)
+
+    def test_everything_open_makes_nothing(self):
+
+        self.serve(self.reconcile()['tags'])
+        for _ in range(2):
+            self.assertEqual(self.reconcile(), {'tabs': 0, 'splits': 0, 'tags': []})
+
+    def test_makes_only_the_closed_panes(self):
+
+        tags = self.reconcile()['tags']
+        closed = [tag for tag in tags if tag.endswith('/3')]
+        self.serve([tag for tag in tags if tag not in closed])
+
+        made = self.reconcile()
+        self.assertEqual((made['tabs'], made['splits']), (0, 3))
+        self.assertEqual(sorted(made['tags']), sorted(closed))
+
+    def test_makes_only_the_closed_windows(self):
+
+        tags = self.reconcile()['tags']
+        self.serve([tag for tag in tags if '/2/' not in tag])
+
+        made = self.reconcile()
+        self.assertEqual((made['tabs'], made['splits']), (1, 2))
+        self.assertEqual(sorted(made['tags']), sorted(tag for tag in tags if '/2/' in tag))
+
+    def test_clears_the_markers_of_panes_made_again(self):
+
+        # Panes made again mustn't find their own 'started' markers left
+        # from last time, but the ones still open keep theirs.
+        path = self.write_layout(json.dumps({'startup': {'max_concurrent': 1}, 'windows': [
+            {'name': 'deps', 'root': self.tmp, 'panes': [
+                {'name': 'db', 'commands': ['echo db']},
+                {'name': 'web', 'commands': ['echo web'], 'depends_on': 'db'}]}]}), 'deps.yml')
+        layout_id = itermocil.Itermocil(path, iterm_version='3.4').layout_id()
+        startup = os.path.join(os.environ['ITERMOCIL_CACHE_DIR'], 'startup', layout_id)
+
+        for open_pane, cleared, kept in [(1, ['layout/started.1'],
+                                          ['layout/started.0', 'ready/pane-1-1']),
+                                         (2, ['layout/started.0', 'ready/pane-1-1'],
+                                          ['layout/started.1'])]:
+            with self.subTest(open_pane=open_pane):
+                self.serve(['%s/1/%d' % (layout_id, open_pane)])
+                itermocil._memo.clear()
+                reset = ' '.join(itermocil.Itermocil(path, iterm_version='3.4',
+                                                     reconcile=True).shell_commands)
+                removed = reset.split('rm -f')[-1] if 'rm -f' in reset else ''
+                for marker in cleared:
+                    self.assertIn(os.path.join(startup, marker), removed)
+                for marker in kept:
+                    self.assertNotIn(os.path.join(startup, marker), removed)
+
+
+class TypedTextTest(StubOsascriptTest):
+
+    def typed(self):
+        """ The text the last script typed into panes, as the shell gets
+            it (with the Applescript strings' escapes undone).
+        """
+
+        script = self.runs('script')[-1]['script']
+        return [re.sub(r'\\(.)', r'\1', text)
+                for text in re.findall(r'write text "((?:[^"\\]|\\.)*)"', script)]
+
+    def test_root_with_a_space(self):
+
+        project = os.path.join(self.tmp, 'My Code')
+        os.makedirs(project)
+        commands = [': %s' % ('long setup command ' * 5)] * 3 + [
+            'pwd > out', 'echo \'back\\slash "quoted"\' >> out']
+        path = self.write_layout(json.dumps({'windows': [
+            {'name': 'spaces', 'root': '~/My Code', 'panes': [{'commands': commands}]}]}))
+
+        for options in [[], ['--source-commands']]:
+            with self.subTest(options=options):
+                status, _ = self.launch('--layout', path, '--iterm-version', '3.4', *options)
+                self.assertEqual(status, 0)
+
+                typed = self.typed()
+                self.assertEqual(len(typed), 1)
+                if options:
+                    self.assertTrue(typed[0].startswith(' source '))
+                subprocess.check_call(['bash', '-c', typed[0]], cwd=self.tmp,
+                                      env=dict(os.environ, HOME=self.tmp))
+                with open(os.path.join(project, 'out')) as f:
+                    self.assertEqual(f.read(), project + '\nback\\slash "quoted"\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+""" Tests for panes with a 'host' (itermocil.SshHosts): the ssh commands
+    typed into them run their commands as written, and, launched against
+    a stand-in ssh, all the panes on a host share one connection, or, if
+    the master connection can't be made, each connect for themselves
+    without stopping the launch.
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+# Stands in for ssh: a new connection takes a moment (and is logged),
+# one through an existing ControlPath socket is instant, and the last
+# argument (the command for the host) is run with sh, here. With
+# $FAKE_SSH_PASSWORD set, connecting needs a password, so it fails with
+# BatchMode.
+FAKE_SSH = """
+import os, subprocess, sys, time
+
+args = sys.argv[1:]
+options = {}
+while args[0].startswith('-'):
+    if args[0] == '-o':
+        key, value = args[1].split('=', 1)
+        options[key] = value
+        args = args[2:]
+    else:
+        args = args[1:]
+
+socket = options.get('ControlPath')
+if not (socket and os.path.exists(socket)):
+    if os.environ.get('FAKE_SSH_PASSWORD') and options.get('BatchMode') == 'yes':
+        sys.stderr.write('Permission denied (password).\\n')
+        sys.exit(255)
+    with open(os.environ['FAKE_SSH_LOG'], 'a') as f:
+        f.write(args[0] + '\\n')
+    time.sleep(0.2)
+    if socket and options.get('ControlMaster') in ('auto', 'yes') and 'ControlPersist' in options:
+        open(socket, 'w').close()
+
+sys.exit(subprocess.call(['sh', '-c', args[-1]]))
+"""
+
+
+def pane_texts(nodes):
+    """ The text typed into each pane, in order.
+    """
+
+    texts = []
+    for node in nodes:
+        if isinstance(node, itermocil.WriteText) and node.text:
+            texts.append(node.text)
+        if isinstance(node, itermocil.Tell):
+            texts.extend(pane_texts(node.body))
+
+    return texts
+
+
+class SshTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as f:
+            f.write('#!' + sys.executable + '\n' + FAKE_SSH)
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+
+        self.log = os.path.join(self.tmp, 'log')
+        self.env = mock.patch.dict(os.environ, {
+            'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+            'FAKE_SSH_LOG': self.log,
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+            # The login shell each pane is left in on its host.
+            'SHELL': '/bin/true',
+        })
+        self.env.start()
+        os.environ.pop('FAKE_SSH_PASSWORD', None)
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def handshakes(self):
+
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().split()
+
+    def launch(self, panes=12, hosts=3):
+        """ Launch a layout of panes spread over hosts, running each pane's
+            text as a local shell, all at once (as iTerm would). Returns
+            what was written to stderr.
+        """
+
+        config = {'ssh': {'control_dir': os.path.join(self.tmp, 'sockets')},
+                  'windows': [{'root': self.tmp, 'layout': 'tiled', 'panes': [
+                      {'host': 'host%d' % (n % hosts), 'commands': ['touch done-%d' % n]}
+                      for n in range(panes)]}]}
+        path = os.path.join(self.tmp, 'layout.yml')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+
+        errors = io.StringIO()
+        with redirect_stderr(errors):
+            instance = itermocil.Itermocil(path, iterm_version='3.4')
+            instance.wait_for_hooks()
+        for command in instance.shell_commands:
+            subprocess.check_call(['sh', '-c', command])
+        procs = [subprocess.Popen(['sh', '-c', text]) for text in pane_texts(instance.nodes())]
+        for proc in procs:
+            proc.wait()
+
+        return errors.getvalue()
+
+    def ran(self, panes=12):
+
+        return all(os.path.exists(os.path.join(self.tmp, 'done-%d' % n)) for n in range(panes))
+
+    def test_command_runs_as_written(self):
+
+        hosts = itermocil.SshHosts({'ssh': {'control_dir': self.tmp},
+                                    'windows': [{'host': 'example.com', 'panes': [None]}]})
+        command = hosts.command('example.com', ['cd %s' % self.tmp,
+                                                'echo \'back\\slash "quoted"\' $HOME > out'])
+        subprocess.check_call(['sh', '-c', command])
+        with open(os.path.join(self.tmp, 'out')) as f:
+            self.assertEqual(f.read(), 'back\\slash "quoted" %s\n' % os.environ['HOME'])
+
+    def test_hosts(self):
+
+        config = {'windows': [{'host': 'web1', 'panes': ['a', {'host': 'db1'}, {'host': ''}]},
+                              {'panes': ['b']}]}
+        self.assertEqual(itermocil.SshHosts.hosts_of(config), ['db1', 'web1'])
+        window = config['windows'][0]
+        self.assertEqual(itermocil.SshHosts.host_of(window, 'a'), 'web1')
+        self.assertEqual(itermocil.SshHosts.host_of(window, window['panes'][1]), 'db1')
+        self.assertIsNone(itermocil.SshHosts.host_of(window, window['panes'][2]))
+        self.assertIsNone(itermocil.SshHosts.host_of(config['windows'][1], 'b'))
+
+    def test_master_hooks(self):
+
+        hosts = itermocil.SshHosts({'ssh': {'control_dir': self.tmp}, 'windows': [
+            {'host': 'deploy@web1', 'panes': [None]}, {'host': 'db1', 'panes': [None]}]})
+        self.assertNotEqual(hosts.control_path('db1'), hosts.control_path('deploy@web1'))
+
+        hooks = itermocil.PreHooks.parse(hosts.master_hooks())
+        self.assertEqual([hook['name'] for hook in hooks], ['ssh db1', 'ssh deploy@web1'])
+        for hook, host in zip(hooks, ['db1', 'deploy@web1']):
+            # Waited for, so the panes find the master, but never stopping
+            # the launch, and never stuck at a prompt.
+            self.assertFalse(hook['required'])
+            self.assertTrue(hook['wait'])
+            self.assertIn('BatchMode=yes', hook['command'])
+            self.assertIn(hosts.control_path(host), hook['command'])
+
+    def test_one_handshake_per_host(self):
+
+        self.assertEqual(self.launch(), '')
+        self.assertTrue(self.ran())
+        self.assertEqual(sorted(self.handshakes()), ['host0', 'host1', 'host2'])
+
+    def test_panes_connect_themselves_if_the_master_fails(self):
+
+        os.environ['FAKE_SSH_PASSWORD'] = '1'
+        errors = self.launch()
+        for host in ['host0', 'host1', 'host2']:
+            self.assertIn("pre hook 'ssh %s' failed: Permission denied" % host, errors)
+        self.assertTrue(self.ran())
+        self.assertEqual(sorted(set(self.handshakes())), ['host0', 'host1', 'host2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+""" Tests for panes with 'startup' settings or dependencies, run as local
+    shells, all at once (as iTerm would), with workloads that log when
+    they start, finish or are ready: no more start at once than
+    max_concurrent, they take turns by priority, stagger spaces them out,
+    and panes wait for what they depend on to be ready, and no longer.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+# Logs when the pane named by its first argument starts and finishes,
+# taking the seconds given by its second.
+WORKLOAD = """
+import os, sys, time
+with open(os.environ['WORKLOAD_LOG'], 'a') as f:
+    f.write('start %s %f\\n' % (sys.argv[1], time.time()))
+time.sleep(float(sys.argv[2]))
+with open(os.environ['WORKLOAD_LOG'], 'a') as f:
+    f.write('end %s %f\\n' % (sys.argv[1], time.time()))
+"""
+
+# Logs when the pane named by its first argument starts and is ready: a
+# server taking the seconds given to listen on a port, or a service
+# taking them to log that it's listening, for a while.
+SERVICE = """
+import os, socket, sys, time
+
+def log(what):
+    with open(os.environ['WORKLOAD_LOG'], 'a') as f:
+        f.write('%s %s %f\\n' % (what, sys.argv[1], time.time()))
+
+log('start')
+if len(sys.argv) > 2:
+    time.sleep(float(sys.argv[3]))
+    if sys.argv[2] == 'server':
+        server = socket.socket()
+        server.bind(('127.0.0.1', int(sys.argv[4])))
+        server.listen(5)
+    else:
+        with open(sys.argv[4], 'a') as f:
+            f.write('Listening on 3000\\n')
+    log('ready')
+    time.sleep(1.5)
+"""
+
+
+class PanesTest(unittest.TestCase):
+    """ Launches layouts, running their panes' text as local shells.
+    """
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'log')
+        self.workload = os.path.join(self.tmp, 'workload.py')
+        with open(self.workload, 'w') as f:
+            f.write(WORKLOAD)
+        self.service = os.path.join(self.tmp, 'service.py')
+        with open(self.service, 'w') as f:
+            f.write(SERVICE)
+        self.env = mock.patch.dict(os.environ, {
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+            'WORKLOAD_LOG': self.log,
+        })
+        self.env.start()
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def work(self, name, seconds):
+
+        return '%s %s %s %s' % (sys.executable, self.workload, name, seconds)
+
+    def launch(self, config):
+        """ Run a layout's shell commands, then each pane's text as a local
+            shell, all at once, and wait for them all.
+        """
+
+        for window in config['windows']:
+            window.setdefault('root', self.tmp)
+        path = os.path.join(self.tmp, 'layout.yml')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+
+        instance = itermocil.Itermocil(path, iterm_version='3.4')
+        texts = []
+
+        def collect(nodes):
+            for node in nodes:
+                if isinstance(node, itermocil.WriteText) and node.text:
+                    texts.append(node.text)
+                if isinstance(node, itermocil.Tell):
+                    collect(node.body)
+
+        collect(instance.nodes())
+        for command in instance.shell_commands:
+            subprocess.check_call(['sh', '-c', command])
+        procs = [subprocess.Popen(['sh', '-c', text]) for text in texts]
+        for proc in procs:
+            proc.wait()
+
+        return instance
+
+    def events(self):
+        """ (when, what, pane) for each line of the log, in order.
+        """
+
+        with open(self.log) as f:
+            return sorted((float(when), what, name)
+                          for what, name, when in (line.split() for line in f))
+
+    def peak(self):
+        """ The most workloads running at once.
+        """
+
+        running = peak = 0
+        # Finishing sorts before starting at the same moment.
+        for _, what, _ in self.events():
+            running += 1 if what == 'start' else -1
+            peak = max(peak, running)
+
+        return peak
+
+
+class StartupTest(PanesTest):
+
+    def layout(self, panes, startup, work=0.2, priorities=None):
+
+        priorities = priorities or [0] * panes
+        return {'startup': startup, 'windows': [{'layout': 'tiled', 'panes': [
+            {'commands': [self.work(n, work)], 'priority': priorities[n]}
+            for n in range(panes)]}]}
+
+    def test_no_more_at_once_than_max_concurrent(self):
+
+        for max_concurrent in [1, 3]:
+            with self.subTest(max_concurrent=max_concurrent):
+                if os.path.exists(self.log):
+                    os.remove(self.log)
+                # Warming up for longer than the workloads take (with time
+                # for Python to start) means they never overlap.
+                self.launch(self.layout(6, {'max_concurrent': max_concurrent, 'warmup': 0.5}))
+                self.assertEqual(len(self.events()), 12)
+                self.assertLessEqual(self.peak(), max_concurrent)
+
+    def test_without_settings_all_start_at_once(self):
+
+        self.launch(self.layout(4, None))
+        self.assertEqual(self.peak(), 4)
+
+    def test_turns_by_priority(self):
+
+        self.launch(self.layout(4, {'max_concurrent': 1, 'warmup': 0.2}, work=0.1,
+                                priorities=[0, 5, 0, 9]))
+        started = [name for _, what, name in self.events() if what == 'start']
+        self.assertEqual(started, ['3', '1', '0', '2'])
+
+    def test_stagger(self):
+
+        self.launch(self.layout(3, {'stagger': 0.3}, work=0.1))
+        starts = [when for when, what, _ in self.events() if what == 'start']
+        # Give or take how long Python takes to start.
+        for before, after in zip(starts, starts[1:]):
+            self.assertGreaterEqual(after - before, 0.25)
+
+
+
+class DependsTest(PanesTest):
+
+    def run_services(self, *args):
+
+        return ' '.join([sys.executable, self.service] + [str(arg) for arg in args])
+
+    def free_port(self):
+
+        import socket
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def test_waits_until_ready(self):
+
+        port = self.free_port()
+        api_log = os.path.join(self.tmp, 'api.log')
+        # The api said it was listening last time too, which mustn't count.
+        with open(api_log, 'w') as f:
+            f.write('Listening on 3000\n')
+
+        launched = time.time()
+        self.launch({'windows': [{'layout': 'tiled', 'panes': [
+            {'name': 'db', 'ready': {'port': port},
+             'commands': [self.run_services('db', 'server', 0.5, port)]},
+            {'name': 'api', 'depends_on': 'db', 'ready': {'log': 'api.log', 'match': 'Listening'},
+             'commands': [self.run_services('api', 'service', 0.5, api_log)]},
+            {'name': 'frontend', 'depends_on': ['api'],
+             'commands': [self.run_services('frontend')]}]}]})
+
+        events = dict(((what, name), when) for when, what, name in self.events())
+        self.assertGreaterEqual(events[('start', 'api')], events[('ready', 'db')])
+        self.assertGreaterEqual(events[('start', 'frontend')], events[('ready', 'api')])
+        # Not much after the critical path (the two delays, and the probes
+        # polling every 0.1s, and Python starting).
+        self.assertLess(events[('start', 'frontend')] - launched, 1.0 + 1.5)
+
+    def graph(self, panes):
+
+        path = os.path.join(self.tmp, 'graph.yml')
+        with open(path, 'w') as f:
+            json.dump({'windows': [{'root': self.tmp, 'panes': panes}]}, f)
+
+        return itermocil.Itermocil(path, iterm_version='3.4')
+
+    def test_cycles(self):
+
+        for panes in [[{'name': 'a', 'depends_on': 'a'}],
+                      [{'name': 'a', 'depends_on': 'b'}, {'name': 'b', 'depends_on': ['c']},
+                       {'name': 'c', 'depends_on': ['d', 'a']}, {'name': 'd'}],
+                      [{'name': 'a', 'depends_on': 'nothing'}]]:
+            with self.subTest(panes=panes):
+                with mock.patch('sys.stdout') as stdout:
+                    with self.assertRaises(SystemExit):
+                        self.graph(panes).dependency_graph()
+                self.assertIn('ERROR', ''.join(c[0][0] for c in stdout.write.call_args_list))
+
+    def test_each_pane_visited_once(self):
+
+        # Every pane of a layer depends on both of the layer before's,
+        # which is 2 ** 24 routes from the last layer to the first.
+        panes = [{'name': 'a0'}, {'name': 'b0'}]
+        for layer in range(1, 25):
+            before = ['a%d' % (layer - 1), 'b%d' % (layer - 1)]
+            panes += [{'name': 'a%d' % layer, 'depends_on': before},
+                      {'name': 'b%d' % layer, 'depends_on': before}]
+        # And a long chain.
+        panes += [{'name': 'c0'}] + [{'name': 'c%d' % n, 'depends_on': 'c%d' % (n - 1)}
+                                     for n in range(1, 3000)]
+
+        instance = self.graph(panes)
+        start = time.time()
+        names, depends = instance.dependency_graph()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(len(names), 50 + 3000)
+
+
+if __name__ == '__main__':
+    unittest.main()
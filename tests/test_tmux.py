@@ -0,0 +1,100 @@
+""" Tests for TmuxBackend, launching layouts in a tmux server of their
+    own, with a stand-in ssh which runs the remote command locally.
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+
+# Stands in for ssh: runs its last argument (the command for the host)
+# with sh, here.
+FAKE_SSH = """#!/bin/sh
+for command; do :; done
+exec sh -c "$command"
+"""
+
+
+@unittest.skipUnless(shutil.which('tmux'), "needs tmux")
+class TmuxBackendTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+        # Panes run login shells, which set PATH again.
+        with open(os.path.join(self.tmp, '.profile'), 'w') as f:
+            f.write('PATH=%s:$PATH\n' % bin_dir)
+
+        # The tmux server (and so its panes) gets this environment.
+        self.env = mock.patch.dict(os.environ, {
+            'HOME': self.tmp,
+            'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+            'SHELL': '/bin/sh',
+            'TMUX_TMPDIR': self.tmp,
+            'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache'),
+            'COLUMNS': '200',
+            'LINES': '50',
+        })
+        self.env.start()
+        os.environ.pop('TMUX', None)
+
+    def tearDown(self):
+
+        subprocess.call(['tmux', 'kill-server'], stderr=subprocess.DEVNULL)
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def wait_for(self, path):
+
+        for _ in range(100):
+            if os.path.exists(path) and os.path.getsize(path):
+                break
+            time.sleep(0.1)
+        with open(path) as f:
+            return f.read()
+
+    def test_types_commands_as_written(self):
+
+        project = os.path.join(self.tmp, 'My Code')
+        os.makedirs(project)
+        path = os.path.join(self.tmp, 'layout.yml')
+        with open(path, 'w') as f:
+            f.write('windows:\n'
+                    '  - root: ~/My Code\n'
+                    '    panes:\n'
+                    '      - pwd > out\n'
+                    '      - echo \'back\\slash "quoted"\' > out2\n'
+                    '      - host: example.com\n'
+                    '        commands:\n'
+                    '          - pwd > out3\n')
+
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit) as raised:
+                itermocil.main(['--backend', 'tmux', '--layout', path], cwd=self.tmp)
+        self.assertEqual(raised.exception.code, 0)
+
+        self.assertEqual(self.wait_for(os.path.join(project, 'out')), project + '\n')
+        self.assertEqual(self.wait_for(os.path.join(project, 'out2')), 'back\\slash "quoted"\n')
+        # The pane on the host went to its root there.
+        self.assertEqual(self.wait_for(os.path.join(project, 'out3')), project + '\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
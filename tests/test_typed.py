@@ -0,0 +1,118 @@
+""" Tests for what --split-cwd and --source-commands type into panes, and
+    the size of the scripts they make, against the usual scripts (which
+    type 'cd', 'export' and every command into every pane).
+"""
+
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import itermocil  # noqa: E402
+
+TEST_LAYOUTS = sorted(glob.glob(os.path.join(os.path.dirname(HERE), 'test_layouts', '*.yml')))
+
+# Options that change what's typed into panes.
+VARIANTS = [
+    ('--split-cwd', {'split_cwd': True}),
+    ('--source-commands', {'source_commands': True}),
+    ('both', {'split_cwd': True, 'source_commands': True}),
+]
+
+# Two windows of four panes, each with a root, env and a few commands.
+PROJECT = {'windows': [
+    {'name': 'window-%d' % w, 'root': '~/Code/My Project/window-%d' % w, 'layout': 'tiled',
+     'env': {'RAILS_ENV': 'development'},
+     'panes': [{'commands': ['source venv/bin/activate', 'pip install -q -r requirements.txt',
+                             'python manage.py runserver %d' % p]} for p in range(4)]}
+    for w in range(2)]}
+
+
+def typed_text(nodes):
+    """ Return how many 'write text's the nodes do, and how many bytes
+        they type (including the newline each one sends).
+    """
+
+    count = size = 0
+    for node in nodes:
+        if isinstance(node, itermocil.WriteText) and node.text is not None:
+            count += 1
+            size += len(node.text.encode('utf-8')) + 1
+        if isinstance(node, itermocil.Tell):
+            c, b = typed_text(node.body)
+            count += c
+            size += b
+
+    return count, size
+
+
+class TypedTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ,
+                                   {'ITERMOCIL_CACHE_DIR': os.path.join(self.tmp, 'cache')})
+        self.env.start()
+        self.project = os.path.join(self.tmp, 'project.yml')
+        with open(self.project, 'w') as f:
+            json.dump(PROJECT, f)
+
+    def tearDown(self):
+
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def measure(self, path, **options):
+        """ The writes, bytes typed and script bytes of a layout's script.
+        """
+
+        instance = itermocil.Itermocil(path, iterm_version='3.4', **options)
+        script = instance.script()
+
+        return typed_text(instance.nodes()) + (len(script.encode('utf-8')),)
+
+    def test_options_never_type_more(self):
+
+        for path in TEST_LAYOUTS + [self.project]:
+            _, default, _ = self.measure(path)
+            for variant, options in VARIANTS:
+                with self.subTest(layout=os.path.basename(path), variant=variant):
+                    self.assertLessEqual(self.measure(path, **options)[1], default)
+
+    def test_project_sizes(self):
+
+        # What the usual script types, and what's left with --split-cwd
+        # (the commands themselves), and the scripts' sizes.
+        self.assertEqual(self.measure(self.project)[:2], (8, 1232))
+        self.assertLessEqual(self.measure(self.project)[2], 2340)
+        self.assertEqual(self.measure(self.project, split_cwd=True)[:2], (8, 728))
+        self.assertLessEqual(self.measure(self.project, split_cwd=True)[2], 2844)
+
+        # --source-commands types a line sourcing each pane's commands.
+        line = len(itermocil.CommandFiles().source_line(['command'], write=False)) + 1
+        for variant, options in VARIANTS[1:]:
+            with self.subTest(variant=variant):
+                self.assertEqual(self.measure(self.project, **options)[:2], (8, 8 * line))
+
+    def test_no_invalid_escapes(self):
+
+        # Escapes like the old root.replace(" ", "\\\ ") are errors to come.
+        path = os.path.join(os.path.dirname(HERE), 'itermocil.py')
+        with open(path) as f:
+            source = f.read()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            compile(source, path, 'exec')
+
+
+if __name__ == '__main__':
+    unittest.main()